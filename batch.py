@@ -0,0 +1,190 @@
+import atexit
+import getopt
+import sys
+import multiprocessing
+import time
+from cStringIO import StringIO
+from information_need import InformationNeed
+from scoring import SCORERS
+from search import check_model, has_statistics, load_dictionary, run_query
+import versions
+
+"""
+Batch search over many information need files on all cores.
+
+The dictionary, document metadata and, unless -D is given, the whole postings
+file are loaded once in the parent process, before a pool of worker
+processes is forked. The workers share them copy-on-write instead of each
+loading its own copy, and the query files are handed to them one at a time,
+so a slow query does not hold up a whole share of the batch. Results are
+written one line per query file, in the order the files were given.
+
+CPython's reference counting writes to every object a worker touches, so
+the pages of the dictionary and metadata a worker reads are still copied
+into it over time, while the postings, one large string, stay shared.
+"""
+
+WORKERS = multiprocessing.cpu_count()
+
+index = None  # loaded before the worker pool is forked
+postings = None  # postings file contents, or the file opened by each worker
+
+
+def open_postings(postings_file_name):
+    """Opens the postings file in a freshly forked worker process, when the
+    postings are not shared from the parent.
+
+    :param postings_file_name: The file path of the postings file
+    """
+    global postings
+    postings = open(postings_file_name)
+
+
+def search_query_file(args):
+    """Runs the search pipeline for one information need file in a worker
+    process.
+
+    :param args: Tuple of the query file path, the scoring model name,
+    whether to collapse families and the maximum number of results
+    :return: List of patent numbers in ranked order.
+    """
+    query_file, model, collapse, limit = args
+    q = InformationNeed(query_file).get_data()
+    if isinstance(postings, str):
+        # A file-like view of the shared contents, private to this query
+        postings_file = StringIO(postings)
+    else:
+        postings_file = postings
+    results = run_query(index, postings_file, q["title"], q["description"],
+                        model, collapse, limit)
+    # Remove .xml file extension
+    return [docID[:-4] for docID in results]
+
+
+def search_batch(dictionary_file, postings_file, query_files, output_file,
+                 workers=WORKERS, model="vsm", collapse=False, limit=None,
+                 share_postings=True):
+    """Searches every query file with a pool of worker processes, and writes
+    the results of each as one line of the output file, in input order.
+
+    :param dictionary_file: The file path of the dictionary file
+    :param postings_file: The file path of the postings file
+    :param query_files: List of file paths of information need files
+    :param output_file: The file path of the results file
+    :param workers: The number of worker processes
+    :param model: The name of the scoring model
+    :param collapse: Whether to keep only the best member of each family
+    :param limit: The maximum number of results per query, or None
+    :param share_postings: Whether to load the postings in the parent and
+    share them, instead of reading them from disk in each worker
+    :return: The time in ms taken to search the batch, after loading
+    """
+    global index, postings
+    index = load_dictionary(dictionary_file)
+    if share_postings:
+        with open(postings_file) as f:
+            postings = f.read()
+        pool = multiprocessing.Pool(workers)
+    else:
+        pool = multiprocessing.Pool(workers, open_postings, (postings_file,))
+    begin = time.time() * 1000.0
+    try:
+        with open(output_file, 'w') as output:
+            # imap hands out queries one at a time, but yields in input order
+            for results in pool.imap(search_query_file,
+                                     [(query_file, model, collapse, limit)
+                                      for query_file in query_files]):
+                output.write(" ".join(results) + "\n")
+    finally:
+        pool.close()
+        pool.join()
+    return time.time() * 1000.0 - begin
+
+
+def usage():
+    """Prints the proper format for calling this script."""
+    print "usage: " + sys.argv[0] + " (-d dictionary-file " \
+                                    "-p postings-file | -r index-root) " \
+                                    "-q file-of-query " \
+                                    "[-q file-of-query ...] " \
+                                    "-o output-file-of-results " \
+                                    "[-w workers] [-m vsm|bm25|bm25f] " \
+                                    "[-f] [-k max-results] [-D]"
+
+
+def parse_args():
+    """Attempts to parse command line arguments fed into the script when it was
+    called. Notifies the user of the correct format if parsing failed.
+    """
+    dictionary_file = postings_file = index_root = output_file = None
+    query_files = []
+    workers = WORKERS
+    model = "vsm"
+    collapse = False
+    limit = None
+    share_postings = True
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'd:p:r:q:o:w:m:fk:D')
+        for o, a in opts:
+            if o == '-d':
+                dictionary_file = a
+            elif o == '-p':
+                postings_file = a
+            elif o == '-r':
+                index_root = a
+            elif o == '-q':
+                query_files.append(a)
+            elif o == '-o':
+                output_file = a
+            elif o == '-w':
+                workers = int(a)
+            elif o == '-m':
+                model = a
+            elif o == '-f':
+                collapse = True
+            elif o == '-k':
+                limit = int(a)
+            elif o == '-D':
+                share_postings = False
+            else:
+                assert False, "unhandled option"
+    except (getopt.GetoptError, ValueError), err:
+        usage()
+        sys.exit(2)
+    if index_root is not None:
+        # Leased until the batch exits; forked workers never run atexit
+        version, lease = versions.lease_current_version(index_root)
+        atexit.register(versions.release_lease, lease)
+        dictionary_file = versions.version_file(index_root, version,
+                                                versions.DICTIONARY)
+        postings_file = versions.version_file(index_root, version,
+                                              versions.POSTINGS)
+    if dictionary_file is None or postings_file is None \
+            or not query_files or output_file is None \
+            or model not in SCORERS:
+        usage()
+        sys.exit(2)
+    problem = check_model(model, has_statistics(dictionary_file))
+    if problem is not None:
+        print problem
+        usage()
+        sys.exit(2)
+    return dictionary_file, postings_file, query_files, output_file, \
+        workers, model, collapse, limit, share_postings
+
+
+def main():
+    """Searches the batch of query files specified in the command line
+    arguments and prints the throughput."""
+    dictionary_file, postings_file, query_files, output_file, workers, \
+        model, collapse, limit, share_postings = parse_args()
+    elapsed = search_batch(dictionary_file, postings_file, query_files,
+                           output_file, workers, model, collapse, limit,
+                           share_postings)
+    print "{0} queries in {1:.1f} ms with {2} workers ({3:.1f} queries/s)" \
+        .format(len(query_files), elapsed, workers,
+                len(query_files) * 1000.0 / elapsed)
+
+
+if __name__ == "__main__":
+    main()
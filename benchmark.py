@@ -0,0 +1,305 @@
+import getopt
+import sys
+import subprocess
+import time
+from heapq import merge
+from itertools import groupby
+from information_need import InformationNeed
+from scoring import SCORERS
+from search import check_model, conjunctive_matches, has_statistics, \
+    load_dictionary, merge_intersection, normalize, prefetch_postings, \
+    read_field_postings, read_postings, score_query
+
+"""
+Latency benchmark of the scoring models selectable with search.py -m.
+
+The dictionary is loaded once, then every query file is normalized, its
+postings read and its documents scored by each model, repeatedly. Only the
+per-query scoring pipeline is timed, not loading the dictionary.
+
+With -c, it instead times reading the postings of each query, one term at a
+time in query order against the coalesced reads of prefetch_postings, with
+the page cache dropped before every run (which needs root on Linux).
+
+With -a, it instead times finding the documents containing every query title
+term, as search.py -a does, through the skip tables of the postings against
+a linear merge of the fully parsed postings.
+"""
+
+REPEATS = 5  # default number of timed runs per query and model
+DROP_CACHES = "/proc/sys/vm/drop_caches"
+
+
+def percentile(sorted_latencies, fraction):
+    """Returns the latency below which the given fraction of the sorted
+    latencies fall, using the nearest-rank method.
+
+    :param sorted_latencies: List of latencies in ascending order.
+    :param fraction: The fraction, between 0 and 1.
+    """
+    rank = max(int(round(fraction * len(sorted_latencies))), 1)
+    return sorted_latencies[rank - 1]
+
+
+def benchmark_models(dictionary_file, postings_file, query_files, models,
+                     repeats=REPEATS):
+    """Times the scoring of every query with every model.
+
+    :param dictionary_file: The file path of the dictionary file
+    :param postings_file: The file path of the postings file
+    :param query_files: List of file paths of information need files
+    :param models: List of scoring model names, keys of scoring.SCORERS
+    :param repeats: The number of timed runs per query and model
+    :return: Mapping of model name to its sorted list of latencies in ms
+    """
+    index = load_dictionary(dictionary_file)
+    stopwords, stems = index.stopwords, index.stems
+    queries = []
+    for query_file in query_files:
+        q = InformationNeed(query_file).get_data()
+        queries.append((q["title"], q["description"]))
+        # Warm up, so that one-off lazy loads such as the fallback stemmer
+        # are not attributed to whichever model runs first
+        normalize(q["title"], stopwords, stems)
+        normalize(q["description"], stopwords, stems)
+
+    latencies = {}
+    with open(postings_file) as postings:
+        for model in models:
+            scorer = SCORERS[model](index.docs_metadata, index.dictionary,
+                                    index.statistics)
+            latencies[model] = []
+            for query_title, query_description in queries:
+                for repeat in xrange(repeats):
+                    begin = time.time() * 1000.0
+                    title_terms = normalize(query_title, stopwords, stems)
+                    description_terms = normalize(query_description,
+                                                  stopwords, stems)
+                    score_query(scorer, index, postings, title_terms,
+                                description_terms)
+                    latencies[model].append(time.time() * 1000.0 - begin)
+            latencies[model].sort()
+    return latencies
+
+
+def drop_page_cache():
+    """Writes dirty pages back and evicts the page cache, so that the next
+    reads go to the disk.
+
+    :return: Whether the page cache could be dropped.
+    """
+    subprocess.call(["sync"])
+    try:
+        with open(DROP_CACHES, 'w') as drop_caches:
+            drop_caches.write("1\n")
+        return True
+    except IOError:
+        return False
+
+
+def benchmark_reads(dictionary_file, postings_file, query_files,
+                    repeats=REPEATS):
+    """Times reading the postings of every query term one at a time, and with
+    coalesced reads, on a cold page cache.
+
+    :param dictionary_file: The file path of the dictionary file
+    :param postings_file: The file path of the postings file
+    :param query_files: List of file paths of information need files
+    :param repeats: The number of timed runs per query and strategy
+    :return: Tuple of the mapping of strategy to its sorted list of latencies
+    in ms, and whether the page cache was dropped before each run
+    """
+    index = load_dictionary(dictionary_file)
+    dictionary = index.dictionary
+    stopwords, stems = index.stopwords, index.stems
+    queries = []
+    for query_file in query_files:
+        q = InformationNeed(query_file).get_data()
+        queries.append([("Title", term)
+                        for term in normalize(q["title"], stopwords, stems)]
+                       + [("Abstract", term)
+                          for term in normalize(q["description"],
+                                                stopwords, stems)])
+
+    def per_term(field_terms, postings):
+        for field, term in field_terms:
+            read_postings(term, dictionary, postings, field)
+
+    def coalesced(field_terms, postings):
+        prefetch_postings(field_terms, dictionary, postings)
+
+    strategies = {"per-term": per_term, "coalesced": coalesced}
+    latencies = dict((name, []) for name in strategies)
+    cold = True
+    for field_terms in queries:
+        for repeat in xrange(repeats):
+            for name, strategy in sorted(strategies.iteritems()):
+                cold = drop_page_cache() and cold
+                begin = time.time() * 1000.0
+                with open(postings_file) as postings:
+                    strategy(field_terms, postings)
+                latencies[name].append(time.time() * 1000.0 - begin)
+    for name in latencies:
+        latencies[name].sort()
+    return latencies, cold
+
+
+def linear_intersection(docID_lists):
+    """Intersects sorted lists of docIDs by walking all of them, shortest
+    first.
+
+    :param docID_lists: List of sorted lists of docIDs
+    :return: Sorted list of the docIDs in every list
+    """
+    docID_lists = sorted(docID_lists, key=len)
+    return reduce(merge_intersection, docID_lists[1:], docID_lists[0])
+
+
+def benchmark_intersections(dictionary_file, postings_file, query_files,
+                            repeats=REPEATS):
+    """Times finding the documents containing every query title term in
+    their title or abstract, with skip tables and with a linear merge.
+
+    :param dictionary_file: The file path of the dictionary file
+    :param postings_file: The file path of the postings file
+    :param query_files: List of file paths of information need files
+    :param repeats: The number of timed runs per query and strategy
+    :return: Mapping of strategy to its sorted list of latencies in ms
+    """
+    index = load_dictionary(dictionary_file)
+    stopwords, stems = index.stopwords, index.stems
+    queries = [normalize(InformationNeed(query_file).get_data()["title"],
+                         stopwords, stems)
+               for query_file in query_files]
+
+    def linear(terms, postings):
+        field_postings = read_field_postings(
+            {"Title": set(terms), "Abstract": set(terms)}, index, postings)
+        # A document contains a term if its title or its abstract does
+        return linear_intersection(
+            [[docID for docID, group in groupby(merge(
+                *[[posting[0] for posting in field_postings[field][term]]
+                  for field in field_postings]))]
+             for term in set(terms)])
+
+    def skips(terms, postings):
+        return conjunctive_matches(terms, index, postings)
+
+    strategies = {"linear": linear, "skips": skips}
+    latencies = dict((name, []) for name in strategies)
+    with open(postings_file) as postings:
+        for terms in queries:
+            if not terms:
+                continue
+            if linear(terms, postings) != skips(terms, postings):
+                raise AssertionError("intersections differ for %r" % terms)
+            for repeat in xrange(repeats):
+                for name, strategy in sorted(strategies.iteritems()):
+                    begin = time.time() * 1000.0
+                    strategy(terms, postings)
+                    latencies[name].append(time.time() * 1000.0 - begin)
+    for name in latencies:
+        latencies[name].sort()
+    return latencies
+
+
+def print_latencies(latencies, label="model"):
+    """Prints mean, median, 95th percentile and maximum latency per model.
+
+    :param latencies: Mapping of model name to its sorted list of latencies
+    :param label: The heading of the first column
+    """
+    print "%-9s %10s %10s %10s %10s" % (label, "mean ms", "p50 ms",
+                                        "p95 ms", "max ms")
+    for model in sorted(latencies):
+        model_latencies = latencies[model]
+        print "%-9s %10.3f %10.3f %10.3f %10.3f" % \
+            (model,
+             sum(model_latencies) / len(model_latencies),
+             percentile(model_latencies, 0.5),
+             percentile(model_latencies, 0.95),
+             model_latencies[-1])
+
+
+def usage():
+    """Prints the proper format for calling this script."""
+    print "usage: " + sys.argv[0] + " -d dictionary-file " \
+                                    "-p postings-file " \
+                                    "-q file-of-query " \
+                                    "[-q file-of-query ...] " \
+                                    "[-m model ...] [-n repeats] [-c | -a]"
+
+
+def parse_args():
+    """Attempts to parse command line arguments fed into the script when it was
+    called. Notifies the user of the correct format if parsing failed.
+    """
+    dictionary_file = postings_file = None
+    query_files = []
+    models = []
+    repeats = REPEATS
+    reads = False
+    intersections = False
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'd:p:q:m:n:ca')
+    except getopt.GetoptError, err:
+        usage()
+        sys.exit(2)
+    for o, a in opts:
+        if o == '-d':
+            dictionary_file = a
+        elif o == '-p':
+            postings_file = a
+        elif o == '-q':
+            query_files.append(a)
+        elif o == '-m':
+            models.append(a)
+        elif o == '-n':
+            repeats = int(a)
+        elif o == '-c':
+            reads = True
+        elif o == '-a':
+            intersections = True
+        else:
+            assert False, "unhandled option"
+    if dictionary_file is None or postings_file is None or not query_files \
+            or any(model not in SCORERS for model in models):
+        usage()
+        sys.exit(2)
+    statistics_stored = has_statistics(dictionary_file)
+    for model in models:
+        problem = check_model(model, statistics_stored)
+        if problem is not None:
+            print problem
+            usage()
+            sys.exit(2)
+    # By default, every model the index supports is benchmarked
+    models = models or [model for model in sorted(SCORERS)
+                        if check_model(model, statistics_stored) is None]
+    return dictionary_file, postings_file, query_files, models, repeats, \
+        reads, intersections
+
+
+def main():
+    """Benchmarks the scoring models, the postings reads or the
+    intersections, on the query files specified in the command line
+    arguments."""
+    dictionary_file, postings_file, query_files, models, repeats, reads, \
+        intersections = parse_args()
+    if intersections:
+        print_latencies(benchmark_intersections(dictionary_file,
+                                                postings_file, query_files,
+                                                repeats), "intersect")
+    elif reads:
+        latencies, cold = benchmark_reads(dictionary_file, postings_file,
+                                          query_files, repeats)
+        if not cold:
+            print "warning: could not drop the page cache, reads were warm"
+        print_latencies(latencies, "reads")
+    else:
+        print_latencies(benchmark_models(dictionary_file, postings_file,
+                                         query_files, models, repeats))
+
+
+if __name__ == "__main__":
+    main()
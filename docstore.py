@@ -0,0 +1,157 @@
+import json
+import os
+import struct
+import tempfile
+import unittest
+import zlib
+
+"""
+Compressed random-access document store, holding the fields shown with
+search results so that search.py never re-parses patent XML files.
+
+index.py adds the stored fields of every document in ordinal order. They are
+grouped in blocks of BLOCK_DOCS documents, each serialized as JSON and
+compressed with zlib. The file starts with a fixed size header, and ends with
+a table of the file offsets of all blocks. Documents are looked up by the
+ordinal stored in their metadata, so that fetching any document costs one
+seek and one block decompression.
+Running this python module on its own just runs the unit tests defined within.
+"""
+
+DOC_STORE_SUFFIX = ".docs"  # appended to the dictionary file path
+STORED_FIELDS = ("Title", "Abstract", "IPC Class", "Publication Date")
+BLOCK_DOCS = 16  # documents per compressed block
+MAGIC = "DST2"  # document stores written with their docIDs were DSTR
+# Magic, documents per block, document count, offset of the block offset
+# table
+HEADER = struct.Struct("<4sIIQ")
+
+
+def has_document_store(doc_store_file_name):
+    """Checks whether a document store file exists, written in the format
+    DocumentStore reads.
+
+    :param doc_store_file_name: The file path of the document store
+    """
+    try:
+        with open(doc_store_file_name, 'rb') as doc_store_file:
+            return doc_store_file.read(len(MAGIC)) == MAGIC
+    except IOError:
+        return False
+
+
+class DocumentStoreWriter:
+    """Writes a document store, one document at a time in ordinal order."""
+
+    def __init__(self, doc_store_file_name, block_docs=BLOCK_DOCS):
+        """Creates the document store file.
+
+        :param doc_store_file_name: The file path of the document store
+        :param block_docs: The number of documents per compressed block
+        """
+        self.doc_store_file = open(doc_store_file_name, 'wb')
+        self.doc_store_file.write(HEADER.pack(MAGIC, block_docs, 0, 0))
+        self.block_docs = block_docs
+        self.block = []
+        self.doc_count = 0
+        self.block_offsets = []
+
+    def add(self, fields):
+        """Adds the next document.
+
+        :param fields: Tuple of the values of the STORED_FIELDS
+        """
+        self.doc_count += 1
+        self.block.append(fields)
+        if len(self.block) == self.block_docs:
+            self.flush_block()
+
+    def flush_block(self):
+        """Compresses and writes the documents added since the last block."""
+        self.block_offsets.append(self.doc_store_file.tell())
+        self.doc_store_file.write(zlib.compress(json.dumps(self.block)))
+        self.block = []
+
+    def close(self):
+        """Writes the last block, the block offset table and the header, and
+        closes the file."""
+        if self.block:
+            self.flush_block()
+        # The offset table ends with the end of the last block
+        self.block_offsets.append(self.doc_store_file.tell())
+        table_offset = self.doc_store_file.tell()
+        self.doc_store_file.write(struct.pack("<%dQ" % len(self.block_offsets),
+                                              *self.block_offsets))
+        self.doc_store_file.seek(0)
+        self.doc_store_file.write(HEADER.pack(MAGIC, self.block_docs,
+                                              self.doc_count, table_offset))
+        self.doc_store_file.close()
+
+
+class DocumentStore:
+    """Document store file written by DocumentStoreWriter."""
+
+    def __init__(self, doc_store_file_name):
+        """Opens the document store and reads its block offset table.
+
+        :param doc_store_file_name: The file path of the document store
+        """
+        self.doc_store_file = open(doc_store_file_name, 'rb')
+        magic, self.block_docs, self.doc_count, self.table_offset = \
+            HEADER.unpack(self.doc_store_file.read(HEADER.size))
+        if magic != MAGIC:
+            raise IOError("not a document store: " + doc_store_file_name)
+        table_format = "<%dQ" % (-(-self.doc_count // self.block_docs) + 1)
+        self.doc_store_file.seek(self.table_offset)
+        self.block_offsets = struct.unpack(
+            table_format,
+            self.doc_store_file.read(struct.calcsize(table_format)))
+        self.cached_block = (None, None)
+
+    def get(self, ordinal):
+        """Returns the stored fields of a document, decompressing its block
+        unless it was the last block read.
+
+        :param ordinal: The ordinal of the document, stored in its metadata
+        :return: Dictionary of stored field name to value
+        """
+        block_number, offset = divmod(ordinal, self.block_docs)
+        if self.cached_block[0] != block_number:
+            start = self.block_offsets[block_number]
+            self.doc_store_file.seek(start)
+            block = json.loads(zlib.decompress(self.doc_store_file.read(
+                self.block_offsets[block_number + 1] - start)))
+            self.cached_block = (block_number, block)
+        return dict(zip(STORED_FIELDS, self.cached_block[1][offset]))
+
+    def close(self):
+        """Closes the document store file."""
+        self.doc_store_file.close()
+
+
+class TestDocumentStore(unittest.TestCase):
+    """Test case ensuring stored documents are read back by ordinal"""
+
+    def test_round_trip(self):
+        handle, doc_store_file_name = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            writer = DocumentStoreWriter(doc_store_file_name, block_docs=2)
+            for number in xrange(5):
+                writer.add((u"Washer %d" % number, u"Foam.", u"D06",
+                            u"2001-01-0%d" % (number + 1)))
+            writer.close()
+            self.assertTrue(has_document_store(doc_store_file_name))
+            store = DocumentStore(doc_store_file_name)
+            self.assertEqual(store.get(4)["Title"], u"Washer 4")
+            self.assertEqual(store.get(1)["Publication Date"], u"2001-01-02")
+            self.assertEqual(store.get(2)["IPC Class"], u"D06")
+            store.close()
+            self.assertFalse(has_document_store(doc_store_file_name
+                                                + ".missing"))
+        finally:
+            os.remove(doc_store_file_name)
+
+
+if __name__ == '__main__':
+    unittest.main()
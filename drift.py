@@ -0,0 +1,157 @@
+import getopt
+import sys
+from itertools import islice
+from information_need import InformationNeed
+from scoring import SCORERS
+from search import check_model, has_statistics, load_dictionary, run_query
+
+"""
+Top-k ranking drift between two indexes of the same corpus, e.g. an index
+built with index.py -P (static pruning) against the unpruned one.
+
+Every query file is run through the search pipeline of search.py on both
+indexes, and the top k results are compared: the overlap@k is the fraction of
+the reference top k also in the candidate top k, regardless of order.
+"""
+
+K = 10  # default number of top results compared
+
+
+def top_k(index, postings, query, model, k):
+    """Returns the top k docIDs of a query.
+
+    :param index: The Index returned by search.load_dictionary
+    :param postings: File object of the postings file
+    :param query: The information need, as returned by
+    InformationNeed.get_data
+    :param model: The name of the scoring model
+    :param k: The number of results
+    """
+    return list(islice(run_query(index, postings, query["title"],
+                                 query["description"], model, limit=k), k))
+
+
+def overlap_at_k(reference, candidate, k):
+    """Returns the fraction of the reference top k in the candidate top k.
+
+    :param reference: The reference ranking, a list of docIDs
+    :param candidate: The candidate ranking, a list of docIDs
+    :param k: The number of top results compared
+    """
+    reference_top = set(reference[:k])
+    if not reference_top:
+        return 1.0
+    return float(len(reference_top & set(candidate[:k]))) / len(reference_top)
+
+
+def ranking_drift(reference_files, candidate_files, query_files, model="vsm",
+                  k=K):
+    """Measures the drift of the top k of every query from the reference
+    index to the candidate index.
+
+    :param reference_files: Tuple of the dictionary and postings file paths
+    of the reference index
+    :param candidate_files: Tuple of the dictionary and postings file paths
+    of the candidate index
+    :param query_files: List of file paths of information need files
+    :param model: The name of the scoring model
+    :param k: The number of top results compared
+    :return: List of (query file, overlap@k, whether the top k is identical)
+    tuples
+    """
+    queries = [(query_file, InformationNeed(query_file).get_data())
+               for query_file in query_files]
+    rankings = []
+    for dictionary_file, postings_file in (reference_files, candidate_files):
+        index = load_dictionary(dictionary_file)
+        with open(postings_file) as postings:
+            rankings.append([top_k(index, postings, query, model, k)
+                             for query_file, query in queries])
+    return [(query_file, overlap_at_k(reference, candidate, k),
+             reference == candidate)
+            for (query_file, query), reference, candidate
+            in zip(queries, rankings[0], rankings[1])]
+
+
+def print_drift(drift, k):
+    """Prints the overlap@k of every query, and the mean.
+
+    :param drift: The drift, as returned by ranking_drift
+    :param k: The number of top results compared
+    """
+    for query_file, overlap, identical in drift:
+        print "%-40s overlap@%d %.3f%s" % (query_file, k, overlap,
+                                           "" if identical else " (changed)")
+    print "mean overlap@%d: %.3f, identical top %d: %d of %d" % \
+        (k, sum(overlap for query_file, overlap, identical in drift)
+         / max(len(drift), 1), k,
+         sum(1 for query_file, overlap, identical in drift if identical),
+         len(drift))
+
+
+def usage():
+    """Prints the proper format for calling this script."""
+    print "usage: " + sys.argv[0] + " -d reference-dictionary-file " \
+                                    "-p reference-postings-file " \
+                                    "-D dictionary-file " \
+                                    "-P postings-file " \
+                                    "-q file-of-query " \
+                                    "[-q file-of-query ...] " \
+                                    "[-m model] [-k top-k]"
+
+
+def parse_args():
+    """Attempts to parse command line arguments fed into the script when it was
+    called. Notifies the user of the correct format if parsing failed.
+    """
+    reference_dictionary = reference_postings = None
+    dictionary_file = postings_file = None
+    query_files = []
+    model = "vsm"
+    k = K
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'd:p:D:P:q:m:k:')
+        for o, a in opts:
+            if o == '-d':
+                reference_dictionary = a
+            elif o == '-p':
+                reference_postings = a
+            elif o == '-D':
+                dictionary_file = a
+            elif o == '-P':
+                postings_file = a
+            elif o == '-q':
+                query_files.append(a)
+            elif o == '-m':
+                model = a
+            elif o == '-k':
+                k = int(a)
+            else:
+                assert False, "unhandled option"
+    except (getopt.GetoptError, ValueError), err:
+        usage()
+        sys.exit(2)
+    if None in (reference_dictionary, reference_postings, dictionary_file,
+                postings_file) or not query_files or model not in SCORERS:
+        usage()
+        sys.exit(2)
+    for dictionary in (reference_dictionary, dictionary_file):
+        problem = check_model(model, has_statistics(dictionary))
+        if problem is not None:
+            print problem
+            usage()
+            sys.exit(2)
+    return (reference_dictionary, reference_postings), \
+        (dictionary_file, postings_file), query_files, model, k
+
+
+def main():
+    """Prints the top-k drift between the indexes specified in the command
+    line arguments."""
+    reference_files, candidate_files, query_files, model, k = parse_args()
+    print_drift(ranking_drift(reference_files, candidate_files, query_files,
+                              model, k), k)
+
+
+if __name__ == "__main__":
+    main()
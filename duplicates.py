@@ -0,0 +1,188 @@
+import unittest
+import zlib
+from array import array
+from itertools import izip
+
+"""
+Near-duplicate detection of patent abstracts with MinHash and LSH banding.
+
+index.py hands the normalized abstract tokens of every document, in ordinal
+order, to a DuplicateDetector, which keeps a MinHash signature of the set of
+SHINGLE_SIZE word shingles of each abstract. Signatures are computed with
+one permutation hashing: the shingle hashes are split into NUM_HASHES bins
+by value, and each bin keeps its minimum, so that a signature costs a
+single pass over the shingles. The signatures are then cut
+into BANDS bands: two documents whose signatures agree on a whole band are
+candidates, and candidates whose signatures agree on at least
+DUPLICATE_THRESHOLD of their positions, an estimate of the Jaccard
+similarity of their shingle sets, are near-duplicates. Each band is
+bucketed with one dictionary and every document is only compared with the
+first document of its bucket, so finding the groups takes time linear in the
+number of documents instead of comparing all pairs.
+
+Every document gets a near-duplicate group ID, stored with its metadata in
+the dictionary file, so that search.py can suppress or group near-duplicates
+while streaming through the ranked list.
+Running this python module on its own just runs the unit tests defined within.
+"""
+
+SHINGLE_SIZE = 3  # words per shingle
+BANDS = 16
+ROWS = 4  # signature positions per band
+NUM_HASHES = BANDS * ROWS
+# Signature agreement above which candidates are near-duplicates
+DUPLICATE_THRESHOLD = 0.8
+MAX_HASH = 0xffffffff
+# Knuth's multiplicative hash, spreading crc32 values evenly over the bins
+MULTIPLIER = 0x9e3779b1
+# Values within a bin are below BIN_RANGE, the offset added per bin an empty
+# bin borrows its value from
+BIN_RANGE = (MAX_HASH + 1) // NUM_HASHES
+# Signature of abstracts without shingles, which duplicate nothing
+EMPTY_SIGNATURE = array('I', [MAX_HASH]) * NUM_HASHES
+
+
+def shingle_hashes(words, size=SHINGLE_SIZE):
+    """Hashes the set of word shingles of a text. A text shorter than a
+    shingle is one shingle.
+
+    :param words: The normalized tokens of the text
+    :param size: The number of words per shingle
+    :return: Set of 32 bit shingle hashes.
+    """
+    return set(zlib.crc32(u" ".join(words[start:start + size])
+                          .encode("utf-8")) & MAX_HASH
+               for start in xrange(max(len(words) - size + 1,
+                                       min(len(words), 1))))
+
+
+def minhash(words):
+    """Computes the one permutation MinHash signature of the shingles of a
+    text. Empty bins are densified by rotation: they borrow the value of the
+    next non-empty bin, offset by how far away it is.
+
+    :param words: The normalized tokens of the text
+    :return: The signature, an array of NUM_HASHES unsigned ints.
+    """
+    hashes = shingle_hashes(words)
+    if not hashes:
+        return EMPTY_SIGNATURE
+    signature = [MAX_HASH] * NUM_HASHES
+    for shingle in hashes:
+        bin_number, value = divmod((shingle * MULTIPLIER) & MAX_HASH,
+                                   BIN_RANGE)
+        if value < signature[bin_number]:
+            signature[bin_number] = value
+    for bin_number in xrange(NUM_HASHES):
+        distance = 1
+        while signature[bin_number] == MAX_HASH:
+            value = signature[(bin_number + distance) % NUM_HASHES]
+            if value < BIN_RANGE:
+                signature[bin_number] = value + distance * BIN_RANGE
+            distance += 1
+    return array('I', signature)
+
+
+def find_group(parents, ordinal):
+    """Finds the representative ordinal of the group of a document in the
+    union-find forest of near-duplicate groups, halving paths along the way.
+
+    :param parents: List of the parent ordinal of every document, updated in
+    place.
+    :param ordinal: The ordinal of the document
+    """
+    while parents[ordinal] != ordinal:
+        parents[ordinal] = parents[parents[ordinal]]
+        ordinal = parents[ordinal]
+    return ordinal
+
+
+class DuplicateDetector:
+    """Collects the MinHash signatures of abstracts, one document at a time
+    in ordinal order, and groups near-duplicates."""
+
+    def __init__(self):
+        self.signatures = array('I')
+
+    def add(self, words):
+        """Adds the signature of the next document.
+
+        :param words: The normalized abstract tokens of the document
+        """
+        self.signatures.extend(minhash(words))
+
+    def signature(self, ordinal):
+        """Returns the signature of a document.
+
+        :param ordinal: The ordinal of the document
+        """
+        return self.signatures[ordinal * NUM_HASHES:
+                               (ordinal + 1) * NUM_HASHES]
+
+    def similarity(self, ordinal, other_ordinal):
+        """Estimates the Jaccard similarity of the shingles of two documents
+        as the fraction of their signatures which agree.
+
+        :param ordinal: The ordinal of a document
+        :param other_ordinal: The ordinal of the other document
+        """
+        return float(sum(1 for value, other_value
+                         in izip(self.signature(ordinal),
+                                 self.signature(other_ordinal))
+                         if value == other_value)) / NUM_HASHES
+
+    def group_IDs(self):
+        """Groups near-duplicates with LSH banding, and assigns every
+        document a compact integer group ID, shared by all documents of the
+        same near-duplicate group. IDs are numbered in order of the first
+        document of each group.
+
+        :return: The list of group IDs, indexed by ordinal
+        """
+        doc_count = len(self.signatures) // NUM_HASHES
+        parents = range(doc_count)
+        for band in xrange(BANDS):
+            buckets = {}
+            for ordinal in xrange(doc_count):
+                start = ordinal * NUM_HASHES + band * ROWS
+                if self.signatures[start] == MAX_HASH:
+                    continue  # no shingles
+                first = buckets.setdefault(
+                    tuple(self.signatures[start:start + ROWS]), ordinal)
+                if first != ordinal \
+                        and find_group(parents, first) \
+                        != find_group(parents, ordinal) \
+                        and self.similarity(first, ordinal) \
+                        >= DUPLICATE_THRESHOLD:
+                    parents[find_group(parents, ordinal)] = \
+                        find_group(parents, first)
+        root_IDs = {}
+        return [root_IDs.setdefault(find_group(parents, ordinal),
+                                    len(root_IDs))
+                for ordinal in xrange(doc_count)]
+
+
+class TestDuplicateDetector(unittest.TestCase):
+    """Test case ensuring near-duplicate abstracts, and only they, share a
+    group"""
+
+    def test_group_IDs(self):
+        words = [u"word%d" % number for number in xrange(60)]
+        detector = DuplicateDetector()
+        detector.add(words)
+        # Near-duplicate, one word changed out of 60
+        detector.add(words[:30] + [u"other"] + words[31:])
+        detector.add([u"unrelated%d" % number for number in xrange(60)])
+        detector.add([])
+        detector.add([])
+        self.assertEqual(detector.group_IDs(), [0, 0, 1, 2, 3])
+
+    def test_similarity(self):
+        detector = DuplicateDetector()
+        detector.add([u"washer", u"foam", u"pump", u"drum"])
+        detector.add([u"washer", u"foam", u"pump", u"drum"])
+        self.assertEqual(detector.similarity(0, 1), 1.0)
+
+
+if __name__ == '__main__':
+    unittest.main()
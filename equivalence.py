@@ -0,0 +1,525 @@
+import getopt
+import json
+import os
+import sys
+import tempfile
+import time
+from cStringIO import StringIO
+from itertools import islice
+from drift import overlap_at_k
+from forward import FORWARD_SUFFIX, has_forward_index
+from information_need import InformationNeed
+from scoring import FIELDS, SCORERS
+from search import check_model, has_statistics, load_dictionary, normalize, \
+    process_queries, rank_results, read_field_postings, \
+    required_query_terms, run_query, score_query
+
+"""
+Ranking-equivalence and latency regression harness.
+
+A query set is run under every setting, a scoring model combined with a
+variant of the search (plain, conjunctive with -a, reduced with -n,
+pseudo-relevance feedback with -F, or the LSI engine, which ignores the
+model). Under each setting the reference, search.py's process_queries on the
+reference index, is compared with every combination of an alternative engine
+and an index format. The run_query engine runs the same pipeline from a
+dictionary loaded once, the memory engine from postings held in memory as
+batch.py shares them. The exhaustive engine shares none of the postings
+lookups: it reads the whole postings of every term, scores every document
+and checks required terms against the whole postings, so it checks the skip
+table lookups and the restricted reads of the others, for the plain and
+conjunctive variants. Every index given with -D and -P, e.g. one written in
+another postings format, is searched by every engine. The top k of every
+combination must equal the reference top k, exactly or, given a tolerance,
+up to documents whose reference scores are within the tolerance of each
+other, which may swap places. Reduced, feedback and LSI rankings have no
+reference scores and are always compared exactly.
+
+The reference rankings and the latency of every combination on every query
+are stored in a baseline file with -w. Later runs also require the reference
+to still return the stored rankings, and report a regression for every query
+slower than its baseline latency by more than the latency threshold. The
+exit status is 1 on any divergence or regression.
+"""
+
+K = 100  # default number of top results compared
+REPEATS = 3  # default number of timed runs per query, the fastest is kept
+LATENCY_THRESHOLD = 0.25  # default slowdown beyond which latency regressed
+# Slowdowns below this many ms are timer noise, never regressions
+MIN_REGRESSION_MS = 1.0
+REFERENCE = "reference"
+REDUCED_TERMS = 8  # term budget of the reduced variant
+# Options of process_queries and run_query of every variant; the LSI prefix
+# of the lsi variant is given with -L
+VARIANTS = {"plain": {},
+            "conjunctive": {"conjunctive": True},
+            "reduced": {"max_terms": REDUCED_TERMS},
+            "feedback": {"feedback": True},
+            "lsi": {"lsi_prefix": None}}
+# Variants ranking by the scores of their model, which tolerances apply to
+SCORED_VARIANTS = ("plain", "conjunctive")
+
+
+def engine_process_queries(dictionary_file, postings_file, query_file, model,
+                           k, options):
+    """Runs one query the way search.py does, loading the dictionary and
+    writing the results file.
+
+    :param options: The options of the variant, passed to process_queries
+    :return: List of the top k patent numbers.
+    """
+    handle, output_file = tempfile.mkstemp()
+    os.close(handle)
+    try:
+        process_queries(dictionary_file, postings_file, query_file,
+                        output_file, model=model, limit=k, **options)
+        with open(output_file) as output:
+            return output.read().split()[:k]
+    finally:
+        os.remove(output_file)
+
+
+class LoadedEngine:
+    """Runs queries with run_query on a dictionary loaded once, reading the
+    postings from the postings file, or from its contents held in memory.
+    The exhaustive engine scores instead every document with the whole
+    postings of the query terms."""
+
+    def __init__(self, in_memory=False, exhaustive=False):
+        """:param in_memory: Whether the postings are read from memory
+        :param exhaustive: Whether to rank with exhaustive_query"""
+        self.in_memory = in_memory
+        self.exhaustive = exhaustive
+        self.loaded = {}
+
+    def __call__(self, dictionary_file, postings_file, query_file, model, k,
+                 options):
+        """Runs one query.
+
+        :param options: The options of the variant, passed to run_query
+        :return: List of the top k patent numbers.
+        """
+        if dictionary_file not in self.loaded:
+            with open(postings_file) as postings:
+                self.loaded[dictionary_file] = \
+                    (load_dictionary(dictionary_file),
+                     postings.read() if self.in_memory else None)
+        index, postings_contents = self.loaded[dictionary_file]
+        q = InformationNeed(query_file).get_data()
+        if self.in_memory:
+            postings = StringIO(postings_contents)
+        else:
+            postings = open(postings_file)
+        query = run_query if not self.exhaustive else exhaustive_query
+        try:
+            # Remove .xml file extension
+            return [docID[:-4] for docID in
+                    islice(query(index, postings, q["title"],
+                                 q["description"], model, limit=k,
+                                 **options), k)]
+        finally:
+            postings.close()
+
+
+def exhaustive_query(index, postings, query_title, query_description,
+                     model="vsm", limit=None, conjunctive=False):
+    """Ranks the documents of a query like run_query, from the whole postings
+    of every query term: every document is scored, and the documents
+    containing every required term are found by reading the whole postings
+    of the required terms, never through their skip tables.
+
+    :return: Iterable of docIDs in ranked order.
+    """
+    title_terms = normalize(query_title, index.stopwords, index.stems)
+    description_terms = normalize(query_description, index.stopwords,
+                                  index.stems)
+    required = required_query_terms(query_title + " " + query_description,
+                                    index.stopwords, index.stems)
+    if conjunctive:
+        required += title_terms
+    scorer = SCORERS[model](index.docs_metadata, index.dictionary,
+                            index.statistics)
+    doc_scores = score_query(scorer, index, postings, title_terms,
+                             description_terms)
+    docs_metadata = index.docs_metadata
+    if required:
+        field_postings = read_field_postings(
+            dict((field, set(required)) for field in FIELDS), index,
+            postings)
+        matches = set(docs_metadata)
+        for term in set(required):
+            matches &= set(posting[0] for field in FIELDS
+                           for posting in field_postings[field][term])
+        doc_scores = dict((docID, doc_scores.get(docID, 0))
+                          for docID in matches)
+        docs_metadata = dict((docID, docs_metadata[docID])
+                             for docID in matches)
+    return rank_results(doc_scores, docs_metadata, limit=limit)
+
+
+# Engines selectable with -e, besides the reference process_queries
+ENGINES = {"process_queries": engine_process_queries,
+           "run_query": LoadedEngine(),
+           "memory": LoadedEngine(in_memory=True),
+           "exhaustive": LoadedEngine(exhaustive=True)}
+# The variants each engine runs; only process_queries has the LSI engine
+ENGINE_VARIANTS = {"process_queries": tuple(VARIANTS),
+                   "run_query": ("plain", "conjunctive", "reduced",
+                                 "feedback"),
+                   "memory": ("plain", "conjunctive", "reduced", "feedback"),
+                   "exhaustive": SCORED_VARIANTS}
+
+
+def setting_name(model, variant):
+    """Returns the name of a setting; the LSI engine has no scoring
+    model."""
+    return variant if variant == "lsi" else "%s/%s" % (model, variant)
+
+
+def reference_scores(dictionary_file, postings_file, query_file, model):
+    """Scores every document against a query on the reference index.
+
+    :return: Dictionary mapping from patent number to score.
+    """
+    index = load_dictionary(dictionary_file)
+    stopwords, stems = index.stopwords, index.stems
+    q = InformationNeed(query_file).get_data()
+    scorer = SCORERS[model](index.docs_metadata, index.dictionary,
+                            index.statistics)
+    with open(postings_file) as postings:
+        doc_scores = score_query(scorer, index, postings,
+                                 normalize(q["title"], stopwords, stems),
+                                 normalize(q["description"], stopwords,
+                                           stems))
+    # Remove .xml file extension
+    return dict((docID[:-4], score) for docID, score in doc_scores.iteritems())
+
+
+def first_divergence(reference, candidate, scores=None, tolerance=None):
+    """Finds the first rank at which a ranking diverges from the reference.
+
+    :param reference: The reference ranking, a list of patent numbers
+    :param candidate: The candidate ranking, a list of patent numbers
+    :param scores: Dictionary of patent number to reference score, needed
+    with a tolerance
+    :param tolerance: The largest difference of reference scores of two
+    documents which may swap places, or None to compare rankings exactly
+    :return: The first diverging rank, counted from 0, or None if the
+    rankings are equivalent.
+    """
+    if len(reference) != len(candidate):
+        return min(len(reference), len(candidate))
+    for rank, (expected, actual) in enumerate(zip(reference, candidate)):
+        if expected == actual:
+            continue
+        if tolerance is None \
+                or abs(scores.get(expected, 0) - scores.get(actual, 0)) \
+                > tolerance:
+            return rank
+    return None
+
+
+def timed(engine, dictionary_file, postings_file, query_file, model, k,
+          options, repeats):
+    """Runs a query repeatedly with an engine.
+
+    :return: Tuple of the top k patent numbers and the fastest latency in ms
+    """
+    latencies = []
+    for repeat in xrange(repeats):
+        begin = time.time() * 1000.0
+        results = engine(dictionary_file, postings_file, query_file, model, k,
+                         options)
+        latencies.append(time.time() * 1000.0 - begin)
+    return results, min(latencies)
+
+
+def run_harness(reference_files, formats, query_files, engines, models,
+                variants, k=K, tolerance=None, repeats=REPEATS,
+                lsi_prefix=None):
+    """Runs every query through the reference and every combination of an
+    engine and an index format, under every setting.
+
+    :param reference_files: Tuple of the dictionary and postings file paths
+    of the reference index
+    :param formats: List of tuples of the dictionary and postings file paths
+    of alternative indexes
+    :param query_files: List of file paths of information need files
+    :param engines: List of engine names, keys of ENGINES
+    :param models: List of scoring model names
+    :param variants: List of variant names, keys of VARIANTS
+    :param k: The number of top results compared
+    :param tolerance: The score tolerance, or None to compare exactly
+    :param repeats: The number of timed runs per query and combination
+    :param lsi_prefix: The LSI prefix of the lsi variant, or None
+    :return: Dictionary of the reference rankings of every setting, the
+    latencies of every combination, the divergences and the reference scores
+    of every model (None without a tolerance), keyed by query file
+    """
+    settings = []
+    for variant in variants:
+        options = dict(VARIANTS[variant])
+        if variant == "lsi":
+            options["lsi_prefix"] = lsi_prefix
+        # The LSI engine runs once, whatever the models
+        for model in (models[:1] if variant == "lsi" else models):
+            settings.append((setting_name(model, variant), model, variant,
+                             options))
+    combinations = []
+    for setting, model, variant, options in settings:
+        combinations.append((setting, "%s %s" % (setting, REFERENCE), model,
+                             variant, options, "process_queries",
+                             reference_files))
+        for engine_name in engines:
+            if variant not in ENGINE_VARIANTS[engine_name]:
+                continue
+            for format_files in [reference_files] + list(formats):
+                if (engine_name, format_files) != ("process_queries",
+                                                   reference_files):
+                    combinations.append((setting, "%s %s@%s" % (
+                        setting, engine_name, format_files[0]), model,
+                        variant, options, engine_name, format_files))
+    results = {}
+    for query_file in query_files:
+        scores = dict((model, None) for model in models)
+        if tolerance is not None:
+            scores = dict((model, reference_scores(reference_files[0],
+                                                   reference_files[1],
+                                                   query_file, model))
+                          for model in models)
+        query_results = {"rankings": {}, "latency": {}, "divergences": {},
+                         "scores": scores}
+        for setting, name, model, variant, options, engine_name, \
+                (dictionary_file, postings_file) in combinations:
+            ranking, latency = timed(ENGINES[engine_name], dictionary_file,
+                                     postings_file, query_file, model, k,
+                                     options, repeats)
+            query_results["latency"][name] = latency
+            if name.endswith(" " + REFERENCE):
+                query_results["rankings"][setting] = ranking
+                continue
+            reference = query_results["rankings"][setting]
+            if variant in SCORED_VARIANTS:
+                rank = first_divergence(reference, ranking, scores[model],
+                                        tolerance)
+            else:
+                rank = first_divergence(reference, ranking)
+            if rank is not None:
+                query_results["divergences"][name] = \
+                    (rank, overlap_at_k(reference, ranking, k))
+        results[query_file] = query_results
+    return results
+
+
+def check_baseline(results, baseline, latency_threshold=LATENCY_THRESHOLD,
+                   tolerance=None):
+    """Compares the results with a stored baseline: the reference must still
+    return the stored rankings of every setting, and no combination may be
+    slower than its stored latency by more than the threshold.
+
+    :param results: The results, as returned by run_harness, updated in
+    place with the divergences from the baseline rankings
+    :param baseline: The baseline, results of an earlier run_harness
+    :param latency_threshold: The largest allowed slowdown, as a fraction
+    :param tolerance: The score tolerance the rankings are compared with,
+    or None to compare exactly
+    :return: List of (query file, combination, latency, baseline latency)
+    regressions
+    """
+    regressions = []
+    for query_file, query_results in sorted(results.iteritems()):
+        if query_file not in baseline:
+            continue
+        stored = baseline[query_file]
+        for setting, ranking in sorted(query_results["rankings"].iteritems()):
+            stored_ranking = stored["rankings"].get(setting)
+            if stored_ranking is None:
+                continue
+            model, slash, variant = setting.rpartition("/")
+            if variant in SCORED_VARIANTS:
+                rank = first_divergence(stored_ranking, ranking,
+                                        query_results["scores"][model],
+                                        tolerance)
+            else:
+                rank = first_divergence(stored_ranking, ranking)
+            if rank is not None:
+                query_results["divergences"]["%s baseline" % setting] = \
+                    (rank, overlap_at_k(stored_ranking, ranking,
+                                        len(stored_ranking)))
+        for name, latency in sorted(query_results["latency"].iteritems()):
+            baseline_latency = stored["latency"].get(name)
+            if baseline_latency is not None \
+                    and latency > baseline_latency * (1 + latency_threshold) \
+                    and latency - baseline_latency > MIN_REGRESSION_MS:
+                regressions.append((query_file, name, latency,
+                                    baseline_latency))
+    return regressions
+
+
+def print_results(results, regressions, k):
+    """Prints the latencies and divergences of every query, and every
+    regression.
+
+    :param results: The results, as returned by run_harness
+    :param regressions: The regressions, as returned by check_baseline
+    :param k: The number of top results compared
+    """
+    for query_file, query_results in sorted(results.iteritems()):
+        print "%s:" % query_file
+        for name, latency in sorted(query_results["latency"].iteritems()):
+            divergence = query_results["divergences"].get(name)
+            print "  %-60s %10.3f ms  %s" % (
+                name, latency, "same" if divergence is None
+                else "DIVERGES at rank %d, overlap@%d %.3f"
+                % (divergence[0] + 1, k, divergence[1]))
+        for setting in sorted(query_results["rankings"]):
+            divergence = query_results["divergences"].get(
+                "%s baseline" % setting)
+            if divergence is not None:
+                print "  %s reference DIVERGES from the baseline at rank " \
+                      "%d, overlap %.3f" % (setting, divergence[0] + 1,
+                                            divergence[1])
+    for query_file, name, latency, baseline_latency in regressions:
+        print "REGRESSION %s %s: %.3f ms, baseline %.3f ms (%+.0f%%)" % \
+            (query_file, name, latency, baseline_latency,
+             100.0 * (latency - baseline_latency) / baseline_latency)
+
+
+def usage():
+    """Prints the proper format for calling this script."""
+    print "usage: " + sys.argv[0] + " -d dictionary-file " \
+                                    "-p postings-file " \
+                                    "-q file-of-query " \
+                                    "[-q file-of-query ...] " \
+                                    "[-D dictionary-file " \
+                                    "-P postings-file ...] " \
+                                    "[-e engine ...] [-m model ...] " \
+                                    "[-v variant ...] [-L lsi-prefix] " \
+                                    "[-k top-k] [-t score-tolerance] " \
+                                    "[-b baseline-file [-w]] " \
+                                    "[-l latency-threshold] [-n repeats]"
+
+
+def parse_args():
+    """Attempts to parse command line arguments fed into the script when it was
+    called. Notifies the user of the correct format if parsing failed.
+    """
+    dictionary_file = postings_file = baseline_file = lsi_prefix = None
+    query_files = []
+    format_dictionaries = []
+    format_postings = []
+    engines = []
+    models = []
+    variants = []
+    k = K
+    tolerance = None
+    write_baseline = False
+    latency_threshold = LATENCY_THRESHOLD
+    repeats = REPEATS
+    try:
+        opts, args = getopt.getopt(sys.argv[1:],
+                                   'd:p:q:D:P:e:m:v:L:k:t:b:wl:n:')
+        for o, a in opts:
+            if o == '-d':
+                dictionary_file = a
+            elif o == '-p':
+                postings_file = a
+            elif o == '-q':
+                query_files.append(a)
+            elif o == '-D':
+                format_dictionaries.append(a)
+            elif o == '-P':
+                format_postings.append(a)
+            elif o == '-e':
+                engines.append(a)
+            elif o == '-m':
+                models.append(a)
+            elif o == '-v':
+                variants.append(a)
+            elif o == '-L':
+                lsi_prefix = a
+            elif o == '-k':
+                k = int(a)
+            elif o == '-t':
+                tolerance = float(a)
+            elif o == '-b':
+                baseline_file = a
+            elif o == '-w':
+                write_baseline = True
+            elif o == '-l':
+                latency_threshold = float(a)
+            elif o == '-n':
+                repeats = int(a)
+            else:
+                assert False, "unhandled option"
+    except (getopt.GetoptError, ValueError), err:
+        usage()
+        sys.exit(2)
+    if dictionary_file is None or postings_file is None or not query_files \
+            or len(format_dictionaries) != len(format_postings) \
+            or any(engine not in ENGINES for engine in engines) \
+            or any(model not in SCORERS for model in models) \
+            or any(variant not in VARIANTS for variant in variants) \
+            or ("lsi" in variants and lsi_prefix is None) \
+            or (write_baseline and baseline_file is None):
+        usage()
+        sys.exit(2)
+    dictionaries = [dictionary_file] + format_dictionaries
+    statistics_stored = all(has_statistics(dictionary)
+                            for dictionary in dictionaries)
+    forward_stored = all(has_forward_index(dictionary + FORWARD_SUFFIX)
+                         for dictionary in dictionaries)
+    for model in models:
+        problem = check_model(model, statistics_stored)
+        if problem is not None:
+            print problem
+            usage()
+            sys.exit(2)
+    if "feedback" in variants and not forward_stored:
+        print "the feedback variant needs indexes built with a forward " \
+              "index, rebuild them with index.py"
+        usage()
+        sys.exit(2)
+    # By default, every model and variant the indexes support is compared
+    models = models or [model for model in sorted(SCORERS)
+                        if check_model(model, statistics_stored) is None]
+    variants = variants or [
+        variant for variant in sorted(VARIANTS)
+        if (variant != "feedback" or forward_stored)
+        and (variant != "lsi" or lsi_prefix is not None)]
+    return (dictionary_file, postings_file), \
+        zip(format_dictionaries, format_postings), query_files, \
+        engines or sorted(ENGINES), models, variants, lsi_prefix, k, \
+        tolerance, baseline_file, write_baseline, latency_threshold, repeats
+
+
+def main():
+    """Runs the harness with the command line arguments, and exits with
+    status 1 on any divergence or latency regression."""
+    reference_files, formats, query_files, engines, models, variants, \
+        lsi_prefix, k, tolerance, baseline_file, write_baseline, \
+        latency_threshold, repeats = parse_args()
+    results = run_harness(reference_files, formats, query_files, engines,
+                          models, variants, k, tolerance, repeats,
+                          lsi_prefix)
+    regressions = []
+    if baseline_file is not None and not write_baseline:
+        with open(baseline_file) as baseline:
+            regressions = check_baseline(results, json.load(baseline),
+                                         latency_threshold, tolerance)
+    print_results(results, regressions, k)
+    if write_baseline:
+        with open(baseline_file, 'w') as baseline:
+            json.dump(dict((query_file,
+                            {"rankings": query_results["rankings"],
+                             "latency": query_results["latency"]})
+                           for query_file, query_results
+                           in results.iteritems()),
+                      baseline, indent=2, sort_keys=True)
+    if regressions or any(query_results["divergences"]
+                          for query_results in results.itervalues()):
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,249 @@
+import os
+import struct
+import tempfile
+import unittest
+from array import array
+from collections import Counter
+from math import log10, sqrt
+
+"""
+Forward index, mapping each document to its term vector, for pseudo-relevance
+feedback in search.py.
+
+index.py adds the normalized title and abstract tokens of every document in
+ordinal order. Each term of each field gets a term ID on first sight, and a
+document's vector is written as two packed arrays, its term IDs (unsigned
+ints) followed by their cosine normalized lnc weights (floats). The file
+starts with a fixed size header, and ends with the term table, which holds
+the field and the UTF-8 term of every term ID in records of the same width,
+and the table of the file offsets of all vectors. Documents are looked up by
+the ordinal stored in their metadata, so reading the vector of a document
+costs a few small reads, one per term not read before, and opening the
+file only reads its header.
+Running this python module on its own just runs the unit tests defined within.
+"""
+
+FORWARD_SUFFIX = ".forward"  # appended to the dictionary file path
+FIELDS = ("Title", "Abstract")
+MAGIC = "FWD2"  # forward indexes written before the term table were FWDX
+# Magic, document count, term count, width of a term record, offset of the
+# term table, offset of the vector offset table
+HEADER = struct.Struct("<4sIIIQQ")
+FIELD_ID = struct.Struct("<B")  # starts every term record
+OFFSET = struct.Struct("<Q")  # entry of the vector offset table
+
+
+def has_forward_index(forward_file_name):
+    """Checks whether a forward index file exists, written in the format
+    ForwardIndex reads.
+
+    :param forward_file_name: The file path of the forward index
+    """
+    try:
+        with open(forward_file_name, 'rb') as forward_file:
+            return forward_file.read(len(MAGIC)) == MAGIC
+    except IOError:
+        return False
+
+
+class ForwardIndexWriter:
+    """Writes a forward index, one document at a time in ordinal order."""
+
+    def __init__(self, forward_file_name):
+        """Creates the forward index file.
+
+        :param forward_file_name: The file path of the forward index
+        """
+        self.forward_file = open(forward_file_name, 'wb')
+        self.forward_file.write(HEADER.pack(MAGIC, 0, 0, 0, 0, 0))
+        self.term_IDs = {}
+        self.vector_offsets = []
+
+    def add(self, field_words):
+        """Adds the vector of the next document.
+
+        :param field_words: Mapping of field to the normalized tokens of the
+        document's field
+        """
+        self.vector_offsets.append(self.forward_file.tell())
+        IDs = array('I')
+        weights = array('f')
+        for field in FIELDS:
+            lnc_weights = dict((term, 1 + log10(tf)) for term, tf
+                               in Counter(field_words[field]).iteritems())
+            length = sqrt(sum(weight * weight
+                              for weight in lnc_weights.itervalues()))
+            for term, weight in lnc_weights.iteritems():
+                IDs.append(self.term_IDs.setdefault((field, term),
+                                                    len(self.term_IDs)))
+                weights.append(weight / length)
+        IDs.tofile(self.forward_file)
+        weights.tofile(self.forward_file)
+
+    def close(self):
+        """Writes the term table, the vector offset table and the header, and
+        closes the file."""
+        doc_count = len(self.vector_offsets)
+        # The offset table ends with the end of the last vector
+        self.vector_offsets.append(self.forward_file.tell())
+        terms = [None] * len(self.term_IDs)
+        for (field, term), term_ID in self.term_IDs.iteritems():
+            terms[term_ID] = (FIELDS.index(field), term.encode("utf-8"))
+        term_width = max([len(term) for field_ID, term in terms] or [0])
+        terms_offset = self.forward_file.tell()
+        for field_ID, term in terms:
+            self.forward_file.write(FIELD_ID.pack(field_ID)
+                                    + term.ljust(term_width, "\0"))
+        table_offset = self.forward_file.tell()
+        self.forward_file.write(struct.pack("<%dQ" % len(self.vector_offsets),
+                                            *self.vector_offsets))
+        self.forward_file.seek(0)
+        self.forward_file.write(HEADER.pack(MAGIC, doc_count, len(terms),
+                                            term_width, terms_offset,
+                                            table_offset))
+        self.forward_file.close()
+
+
+class ForwardIndex:
+    """Forward index file written by ForwardIndexWriter, opened on first use
+    so that queries without feedback never pay for it. Indexes built before
+    forward indexes were written have no document vectors. Terms are read
+    from the term table as vectors need them, and kept for later vectors."""
+
+    def __init__(self, forward_file_name):
+        """Remembers the path of the forward index file.
+
+        :param forward_file_name: The file path of the forward index
+        """
+        self.forward_file_name = forward_file_name
+        self.forward_file = None
+        self.term_width = None
+        self.terms_offset = None
+        self.table_offset = None
+        self.terms = {}
+
+    def open(self):
+        """Reads the header.
+
+        :return: Whether the forward index file exists.
+        """
+        if self.forward_file is None:
+            try:
+                self.forward_file = open(self.forward_file_name, 'rb')
+            except IOError:
+                return False
+            magic, doc_count, term_count, self.term_width, \
+                self.terms_offset, self.table_offset = \
+                HEADER.unpack(self.forward_file.read(HEADER.size))
+            if magic != MAGIC:
+                raise IOError("not a forward index: " +
+                              self.forward_file_name)
+        return True
+
+    def term(self, term_ID):
+        """Returns the (field, term) pair of a term ID, read from the term
+        table the first time it is asked for.
+
+        :param term_ID: The term ID
+        """
+        if term_ID not in self.terms:
+            record_width = FIELD_ID.size + self.term_width
+            self.forward_file.seek(self.terms_offset + term_ID * record_width)
+            record = self.forward_file.read(record_width)
+            self.terms[term_ID] = (
+                FIELDS[FIELD_ID.unpack(record[:FIELD_ID.size])[0]],
+                record[FIELD_ID.size:].rstrip("\0").decode("utf-8"))
+        return self.terms[term_ID]
+
+    def vector(self, ordinal):
+        """Returns the term vector of a document.
+
+        :param ordinal: The ordinal of the document, stored in its metadata
+        :return: List of (field, term, weight) tuples, or an empty list if
+        there is no forward index.
+        """
+        if not self.open():
+            return []
+        # The vector ends where the vector of the next ordinal starts
+        self.forward_file.seek(self.table_offset + ordinal * OFFSET.size)
+        start, end = struct.unpack("<2Q",
+                                   self.forward_file.read(2 * OFFSET.size))
+        self.forward_file.seek(start)
+        data = self.forward_file.read(end - start)
+        IDs = array('I')
+        weights = array('f')
+        # Both arrays have 4 byte items, the IDs come first
+        IDs.fromstring(data[:len(data) // 2])
+        weights.fromstring(data[len(data) // 2:])
+        return [self.term(term_ID) + (weight,)
+                for term_ID, weight in zip(IDs, weights)]
+
+
+class TestForwardIndex(unittest.TestCase):
+    """Test case ensuring document vectors are read back by ordinal"""
+
+    def test_round_trip(self):
+        handle, forward_file_name = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            writer = ForwardIndexWriter(forward_file_name)
+            writer.add({"Title": [u"washer"],
+                        "Abstract": [u"foam", u"foam", u"pump"]})
+            writer.add({"Title": [], "Abstract": [u"pump"]})
+            writer.add({"Title": [u"r\xf6hre"], "Abstract": []})
+            writer.close()
+            self.assertTrue(has_forward_index(forward_file_name))
+            forward_index = ForwardIndex(forward_file_name)
+            self.assertEqual(forward_index.vector(1),
+                             [(u"Abstract", u"pump", 1.0)])
+            vector = dict(((field, term), weight) for field, term, weight
+                          in forward_index.vector(0))
+            self.assertEqual(vector[(u"Title", u"washer")], 1.0)
+            self.assertTrue(vector[(u"Abstract", u"foam")] >
+                            vector[(u"Abstract", u"pump")])
+            # Terms are padded to the longest in UTF-8 bytes
+            self.assertEqual(forward_index.vector(2),
+                             [(u"Title", u"r\xf6hre", 1.0)])
+            self.assertFalse(ForwardIndex(forward_file_name + ".missing")
+                             .vector(0))
+            self.assertFalse(has_forward_index(forward_file_name
+                                               + ".missing"))
+        finally:
+            os.remove(forward_file_name)
+
+
+class TestFeedbackTerms(unittest.TestCase):
+    """Test case ensuring feedback picks discriminative terms of the top
+    documents over frequent ones"""
+
+    def test_rare_shared_term_beats_common_term(self):
+        # Imported here, as search.py imports this module
+        from search import feedback_terms
+        handle, forward_file_name = tempfile.mkstemp()
+        os.close(handle)
+        try:
+            writer = ForwardIndexWriter(forward_file_name)
+            # "method" is in more of both documents than "impel"
+            writer.add({"Title": [], "Abstract": [
+                u"pump", u"method", u"method", u"method", u"impel"]})
+            writer.add({"Title": [], "Abstract": [
+                u"pump", u"method", u"method", u"impel"]})
+            writer.close()
+            # Only the ordinal, last, is read from the metadata
+            docs_metadata = {"a.xml": (0,) * 7 + (0,),
+                             "b.xml": (0,) * 7 + (1,)}
+            dictionary = {"Title": {},
+                          "Abstract": {u"pump": (0, 0, 1.0),
+                                       u"method": (0, 0, 0.05),
+                                       u"impel": (0, 0, 2.5)}}
+            expansion = feedback_terms({"a.xml": 2.0, "b.xml": 1.0},
+                                       {"Title": [], "Abstract": [u"pump"]},
+                                       ForwardIndex(forward_file_name),
+                                       dictionary, docs_metadata)
+            self.assertEqual(expansion["Abstract"], [u"impel", u"method"])
+        finally:
+            os.remove(forward_file_name)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -3,17 +3,37 @@ import sys
 import nltk
 import json
 import string
-from collections import defaultdict
+from array import array
+from collections import Counter
+from heapq import nlargest
 from math import log10, sqrt
 import os
 from patent import Patent
-from itertools import groupby
+from tokenizer import tokenize
+from wildcard import WILDCARD_SUFFIX, build_wildcard_index
+from memory import MB, MemoryCeilingExceeded, MemoryTracker
+from docstore import DOC_STORE_SUFFIX, STORED_FIELDS, DocumentStoreWriter
+from forward import FORWARD_SUFFIX, ForwardIndexWriter
+from skips import join_postings
+from search import DICTIONARY_FORMAT
+from duplicates import DuplicateDetector
+import versions
+from itertools import islice, izip
 try:
     import cPickle as pickle
 except:
     import pickle
 
 LANG = "english"
+STOPWORDS = frozenset(nltk.corpus.stopwords.words(LANG))
+STEMMER = nltk.stem.porter.PorterStemmer()
+# Bump whenever the tokens stored in the token cache would change, so that
+# stale caches are discarded instead of silently reused.
+TOKEN_CACHE_VERSION = 4
+MEMORY_CHECK_INTERVAL = 1000  # documents indexed between memory checks
+# Static pruning keeps the postings scoring at least the pruning threshold
+# times the PRUNE_K-th highest score of their term
+PRUNE_K = 10
 
 
 def load_all_doc_names(docs_dir):
@@ -36,82 +56,298 @@ def load_all_doc_names(docs_dir):
     return joined_files
 
 
-def normalize(text):
+def stem(word, stems):
+    """Stems a lowercased word, memoizing the result in the stem table. The
+    stem table is written to the dictionary file, so that search.py can
+    normalize queries without loading nltk.
+
+    :param word: The lowercased surface form of the word.
+    :param stems: Mapping of surface form to stem, updated in place.
+    """
+    if word not in stems:
+        stems[word] = STEMMER.stem(word)
+    return stems[word]
+
+
+def normalize(text, stems):
     """Converts text into a list of normalized tokens of the text.
 
     :param text: List of lowercased, stemmed tokens of the text, minus
     punctuation and stopwords.
+    :param stems: Mapping of surface form to stem, updated in place.
     """
-    words = nltk.tokenize.word_tokenize(text)
+    words = tokenize(text)
     punctuation_removed = [word for word in words
                            if word not in string.punctuation]
     stopwords_removed = [word.lower() for word in punctuation_removed
-                         if word.lower()
-                         not in set(nltk.corpus.stopwords.words(LANG))]
-    stemmer = nltk.stem.porter.PorterStemmer()
-    return [stemmer.stem(word) for word in stopwords_removed]
+                         if word.lower() not in STOPWORDS]
+    return [stem(word, stems) for word in stopwords_removed]
 
 
-def get_doc_content(doc_name):
+def get_doc_content(doc_name, stems):
     """Extracts all tokens in the given document as elements in lists.
-    Also extracts the IPC subclass of the patent.
+    Also extracts the IPC subclass of the patent, the patent numbers of its
+    family members, and the values of the fields kept in the document store.
 
     :param doc_name: A tuple containing the docID, and doc_path which is the
     filepath to the document.
+    :param stems: Mapping of surface form to stem, updated in place.
     """
     docID, doc_path = doc_name
     p = Patent(doc_path).get_data()
     title = p.get("Title", "")
     abstract = p.get("Abstract", "")
     ipc = p.get("IPC Class", "")
+    family_members = [member.strip()
+                      for member in p.get("Family Members", "").split("|")
+                      if member.strip()]
+
+    stored_fields = tuple(p.get(field, u"") for field in STORED_FIELDS)
 
     # Tokenize to doc content to sentences, then to words.
-    return normalize(title), normalize(abstract), ipc
+    return normalize(title, stems), normalize(abstract, stems), ipc, \
+        family_members, stored_fields
+
+
+def load_token_cache(cache_file_name):
+    """Loads the token cache written by a previous build, or returns an empty
+    one if the file is missing, unreadable or written by an incompatible
+    version of this script. The cache holds the stem table and, for every
+    document path, the file's (mtime, size) and its normalized title tokens,
+    abstract tokens, IPC, family members and document store fields.
+
+    :param cache_file_name: The file path of the token cache
+    :return: A dictionary with "version", "stems" and "docs" keys
+    """
+    empty_cache = {"version": TOKEN_CACHE_VERSION, "stems": {}, "docs": {}}
+    try:
+        with open(cache_file_name, 'rb') as cache_file:
+            cache = pickle.load(cache_file)
+    except (IOError, EOFError, pickle.UnpicklingError):
+        return empty_cache
+    if cache.get("version") != TOKEN_CACHE_VERSION:
+        return empty_cache
+    return cache
+
+
+def save_token_cache(token_cache, docs, cache_file_name):
+    """Writes the token cache to disk, dropping entries of documents which are
+    no longer in the corpus. The cache is written to a temporary file which
+    is then renamed over the old cache, so an interrupted build never leaves
+    a truncated cache behind.
+
+    :param token_cache: The token cache, as returned by load_token_cache
+    :param docs: The list of (docID, file path) tuples indexed in this build
+    :param cache_file_name: The file path of the token cache
+    """
+    doc_paths = set(doc_path for docID, doc_path in docs)
+    cached_docs = token_cache["docs"]
+    for doc_path in cached_docs.keys():
+        if doc_path not in doc_paths:
+            del cached_docs[doc_path]
+    temp_file_name = cache_file_name + ".tmp"
+    with open(temp_file_name, 'wb') as cache_file:
+        pickle.dump(token_cache, cache_file, pickle.HIGHEST_PROTOCOL)
+    os.rename(temp_file_name, cache_file_name)
+
+
+def cached_doc_content(doc_name, stems, cached_docs):
+    """Same as get_doc_content, but reuses the tokens of the document from
+    the token cache if the file's mtime and size are unchanged since they were
+    cached. Otherwise, the document is parsed and its tokens are cached.
+    Tokens are cached as space separated strings, as tokens never contain
+    whitespace and these pickle far more compactly than lists of strings.
+
+    :param doc_name: A tuple containing the docID, and doc_path which is the
+    filepath to the document.
+    :param stems: Mapping of surface form to stem, updated in place.
+    :param cached_docs: Mapping of document path to its cached entry, updated
+    in place.
+    """
+    docID, doc_path = doc_name
+    doc_stat = os.stat(doc_path)
+    file_key = (doc_stat.st_mtime, doc_stat.st_size)
+    cached_entry = cached_docs.get(doc_path)
+    if cached_entry is not None and cached_entry[0] == file_key:
+        title, abstract, ipc, family_members, stored_fields = cached_entry[1]
+        return title.split(), abstract.split(), ipc, \
+            family_members.split(), stored_fields
+    title_words, abstract_words, ipc, family_members, stored_fields = \
+        get_doc_content(doc_name, stems)
+    cached_docs[doc_path] = (file_key, (u" ".join(title_words),
+                                        u" ".join(abstract_words),
+                                        ipc,
+                                        u" ".join(family_members),
+                                        stored_fields))
+    return title_words, abstract_words, ipc, family_members, stored_fields
+
+
+def add_postings(postings_list, ordinal, words):
+    """Adds one (ordinal, tf) pair per distinct word of a document to the
+    postings buffers of those words. Each buffer is an array of unsigned ints
+    holding the pairs flattened, i.e. [ordinal1, tf1, ordinal2, tf2, ...].
+    No need to sort the buffers if we call this in increasing ordinal order.
+
+    :param postings_list: Mapping of term to its postings buffer, updated in
+    place.
+    :param ordinal: The ordinal of the document, i.e. its position in the
+    sorted list of all documents.
+    :param words: The normalized tokens of the document's field.
+    """
+    for word, tf in Counter(words).iteritems():
+        if word not in postings_list:
+            postings_list[word] = array('I')
+        postings_list[word].extend((ordinal, tf))
+
+
+def postings_pairs(postings):
+    """Iterates over the (ordinal, tf) pairs of a flattened postings buffer.
+
+    :param postings: A postings buffer as built by add_postings.
+    """
+    return izip(islice(postings, 0, None, 2), islice(postings, 1, None, 2))
+
+
+def find_family(family_parents, patent_number):
+    """Finds the representative patent number of the family of a patent in
+    the union-find forest of patent families, halving paths along the way.
+
+    :param family_parents: Mapping of patent number to its parent in the
+    union-find forest, updated in place.
+    :param patent_number: The patent number to look up.
+    """
+    family_parents.setdefault(patent_number, patent_number)
+    while family_parents[patent_number] != patent_number:
+        grandparent = family_parents[family_parents[patent_number]]
+        family_parents[patent_number] = grandparent
+        patent_number = grandparent
+    return patent_number
+
+
+def union_family(family_parents, patent_number, family_members):
+    """Merges the families of a patent and each of its family members.
+
+    :param family_parents: Mapping of patent number to its parent in the
+    union-find forest, updated in place.
+    :param patent_number: The patent number of the document.
+    :param family_members: The patent numbers listed as its family members.
+    """
+    root = find_family(family_parents, patent_number)
+    for member in family_members:
+        member_root = find_family(family_parents, member)
+        if member_root != root:
+            family_parents[member_root] = root
+
+
+def family_IDs(family_parents, docs):
+    """Assigns every document a compact integer family ID, shared by all
+    documents of the same patent family. IDs are numbered in order of the
+    first document of each family.
+
+    :param family_parents: The union-find forest of patent families.
+    :param docs: The list of (docID, file path) tuples, indexed by ordinal
+    :return: The list of family IDs, indexed by ordinal
+    """
+    root_IDs = {}
+    IDs = []
+    for docID, doc_path in docs:
+        root = find_family(family_parents, patent_number(docID))
+        IDs.append(root_IDs.setdefault(root, len(root_IDs)))
+    return IDs
+
+
+def patent_number(docID):
+    """Returns the patent number of a document, i.e. its docID without the
+    .xml file extension.
+
+    :param docID: The docID of the document.
+    """
+    return os.path.splitext(docID)[0]
 
 
-def index_doc(doc_name, title_postings_list, abstract_postings_list):
+def index_doc(doc_name, ordinal, title_postings_list, abstract_postings_list,
+              family_parents, stems, cached_docs=None, doc_store=None,
+              forward_index=None, duplicates=None):
     """Indexes a single doc in corpus. Makes use of stemming & tokenization.
     Returns metadata of the doc.
 
-    :param doc_name: A tuple containing the docID (to be stored as a posting)
-    and doc_path which is the filepath to the document.
+    :param doc_name: A tuple containing the docID and doc_path which is the
+    filepath to the document.
+    :param ordinal: The ordinal of the document (to be stored as a posting).
+    :param family_parents: The union-find forest of patent families, updated
+    in place.
+    :param stems: Mapping of surface form to stem, updated in place.
+    :param cached_docs: Mapping of document path to its token cache entry, or
+    None if no token cache is used.
+    :param doc_store: The DocumentStoreWriter the stored fields are added to,
+    or None.
+    :param forward_index: The ForwardIndexWriter the document's term vector
+    is added to, or None.
+    :param duplicates: The DuplicateDetector the document's abstract is added
+    to, or None.
     """
     docID, doc_path = doc_name
-    title_words, abstract_words, ipc = get_doc_content(doc_name)
-    # Append doc to postings list.
-    # No need to sort the list if we call index_doc in sorted docID order.
-    for word in title_words:
-        if word in title_postings_list:
-            title_postings_list[word].append(docID)
-        else:
-            title_postings_list[word] = [docID]
-    for word in abstract_words:
-        if word in abstract_postings_list:
-            abstract_postings_list[word].append(docID)
-        else:
-            abstract_postings_list[word] = [docID]
+    if cached_docs is None:
+        title_words, abstract_words, ipc, family_members, stored_fields = \
+            get_doc_content(doc_name, stems)
+    else:
+        title_words, abstract_words, ipc, family_members, stored_fields = \
+            cached_doc_content(doc_name, stems, cached_docs)
+    if doc_store is not None:
+        doc_store.add(stored_fields)
+    if forward_index is not None:
+        forward_index.add({"Title": title_words, "Abstract": abstract_words})
+    if duplicates is not None:
+        duplicates.add(abstract_words)
+    add_postings(title_postings_list, ordinal, title_words)
+    add_postings(abstract_postings_list, ordinal, abstract_words)
+    union_family(family_parents, patent_number(docID), family_members)
     return ipc
 
 
-def index_all_docs(docs):
+def index_all_docs(docs, stems, cached_docs=None, memory=None,
+                   doc_store=None, forward_index=None, duplicates=None):
     """Calls index_doc on all documents in their order in the list passed as
-    argument. Maintaining this order is important as this results in sorted
+    argument. Documents are interned as their position (ordinal) in this
+    list, and maintaining this order is important as this results in sorted
     postings without having to manually sort the postings for each term at the
     end of the indexing step.
 
     :param docs: The list of tuples containing the docID and file path to all
     documents, sorted by docID
+    :param stems: Mapping of surface form to stem, updated in place.
+    :param cached_docs: Mapping of document path to its token cache entry, or
+    None if no token cache is used.
+    :param memory: The MemoryTracker checking memory use every
+    MEMORY_CHECK_INTERVAL documents, or None. Close to its ceiling, the token
+    cache is emptied and no longer filled, and its low_memory flag is set.
+    :param doc_store: The DocumentStoreWriter the stored fields of every
+    document are added to, or None.
+    :param forward_index: The ForwardIndexWriter the term vector of every
+    document is added to, or None.
+    :param duplicates: The DuplicateDetector the abstract of every document
+    is added to, or None.
     :return: The inverted indices constructed from the given documents' titles
-    and abstracts
+    and abstracts, as postings buffers of (ordinal, tf) pairs, and the lists
+    of IPC classes and family IDs indexed by ordinal
     """
     title_postings_list = {}
     abstract_postings_list = {}
-    IPC_dict = {}
-    for doc in docs:
-        docID, doc_path = doc
-        ipc = index_doc(doc, title_postings_list, abstract_postings_list)
-        IPC_dict[docID] = ipc
-    return title_postings_list, abstract_postings_list, IPC_dict
+    IPC_list = []
+    family_parents = {}
+    for ordinal, doc in enumerate(docs):
+        if memory is not None and ordinal % MEMORY_CHECK_INTERVAL == 0:
+            memory.check("index_all_docs")
+            if cached_docs is not None and memory.near_ceiling():
+                cached_docs.clear()
+                cached_docs = None
+                memory.low_memory = True
+        ipc = index_doc(doc, ordinal, title_postings_list,
+                        abstract_postings_list, family_parents, stems,
+                        cached_docs, doc_store, forward_index, duplicates)
+        IPC_list.append(ipc)
+    return title_postings_list, abstract_postings_list, IPC_list, \
+        family_IDs(family_parents, docs)
 
 
 def lnc_from_tf(tf):
@@ -123,53 +359,60 @@ def lnc_from_tf(tf):
     return 1 + log10(tf)
 
 
-def convert_preliminary_postings(preliminary_postings):
-    """Converts postings in the form of [docID1, docID2, docID2, docID3,
-    docID4,...] to [(docID1, 1), (docID2, 2), (docID3, 1), (docID3, 1),...]
-    and then to [(docID1, 0.968), (docID2, 0.232),...] (from term frequency
-    to lnc_weight)
+def field_lengths(postings_list, big_N):
+    """Calculates the VSM lnc vector length and the length in tokens of every
+    document for one field.
 
-    :param preliminary_postings: Ungrouped document ID postings
+    :param postings_list: The inverted index of the field, with postings
+    buffers of (ordinal, tf) pairs.
+    :param big_N: The total number of documents
+    :return: A tuple of arrays of vector lengths and of token counts, both
+    indexed by ordinal.
     """
-    converted_postings = {}
-    for word in preliminary_postings:
-        docIDs = preliminary_postings[word]
-        groupedDocIDs = [(docID, lnc_from_tf(len(list(group))))
-                         for docID, group in groupby(docIDs)]
-        converted_postings[word] = groupedDocIDs
-    return converted_postings
-
-
-def calculate_metadata(title_postings_list, abstract_postings_list, IPC_dict):
+    sum_squares = array('d', [0.0]) * big_N
+    token_counts = array('I', [0]) * big_N
+    for postings in postings_list.itervalues():
+        for ordinal, tf in postings_pairs(postings):
+            sum_squares[ordinal] += pow(lnc_from_tf(tf), 2)
+            token_counts[ordinal] += tf
+    return array('d', [sqrt(sum_square) for sum_square in sum_squares]), \
+        token_counts
+
+
+def calculate_metadata(title_postings_list, abstract_postings_list, IPC_list,
+                       family_list, docs, duplicate_list):
     """Calculates VSM lnc vector length for each document, given postings lists,
-    and add the IPC values.
-
-    :param title_postings_list: The postings list which contains (docID, lnc_weight)
-    tuples as term postings for titles.
-    :param abstract_postings_list: The inverted index of abstracts to be stored
+    and add the IPC values, family IDs, field lengths in tokens,
+    near-duplicate group IDs and ordinals.
+
+    :param title_postings_list: The inverted index of titles, with postings
+    buffers of (ordinal, tf) pairs.
+    :param abstract_postings_list: The inverted index of abstracts, with
+    postings buffers of (ordinal, tf) pairs.
+    :param IPC_list: The IPC class of each document, indexed by ordinal
+    :param family_list: The family ID of each document, indexed by ordinal
+    :param docs: The list of (docID, file path) tuples, indexed by ordinal
+    :param duplicate_list: The near-duplicate group ID of each document,
+    indexed by ordinal
+    :return: A mapping from docID to its metadata.
     """
-    title_sum_squares = defaultdict(float)
-    abstract_sum_squares = defaultdict(float)
-    for term in title_postings_list:
-        for docID, weight in title_postings_list[term]:
-            title_sum_squares[docID] += pow(weight, 2)
-    for term in abstract_postings_list:
-        for docID, weight in abstract_postings_list[term]:
-            abstract_sum_squares[docID] += pow(weight, 2)
-    
-    title_lengths = {}
-    abstract_lengths = {}
-    for docID in title_sum_squares:
-        title_lengths[docID] = sqrt(title_sum_squares[docID])
-    for docID in abstract_sum_squares:
-        abstract_lengths[docID] = sqrt(abstract_sum_squares[docID])
-    
+    big_N = len(docs)
+    title_lengths, title_token_counts = \
+        field_lengths(title_postings_list, big_N)
+    abstract_lengths, abstract_token_counts = \
+        field_lengths(abstract_postings_list, big_N)
+
     docs_metadata = {}
-    for docID in IPC_dict:
-        docs_metadata[docID] = (title_lengths[docID],
-                                abstract_lengths.get(docID, 0),
-                                IPC_dict[docID])
-    
+    for ordinal, (docID, doc_path) in enumerate(docs):
+        docs_metadata[docID] = (title_lengths[ordinal],
+                                abstract_lengths[ordinal],
+                                IPC_list[ordinal],
+                                family_list[ordinal],
+                                title_token_counts[ordinal],
+                                abstract_token_counts[ordinal],
+                                duplicate_list[ordinal],
+                                ordinal)
+
     return docs_metadata
 
 
@@ -183,8 +426,107 @@ def idf_docs(df, big_N):
     return log10(float(big_N)/df)
 
 
+def prune_postings(postings, vector_lengths, prune_threshold, k=PRUNE_K):
+    """Term-centric static pruning: keeps the postings of a term whose
+    score, the cosine normalized lnc weight, is at least prune_threshold
+    times the k-th highest score of the term, so that every query of at most
+    1 / prune_threshold terms keeps its top k documents. The idf of the term
+    scales all its scores alike, so it is left out.
+
+    :param postings: A postings buffer as built by add_postings.
+    :param vector_lengths: The vector lengths of the field, indexed by
+    ordinal
+    :param prune_threshold: The pruning threshold, between 0 and 1
+    :param k: The number of top postings of each term which are always kept
+    :return: The list of (ordinal, tf) pairs kept, in ordinal order
+    """
+    pairs = list(postings_pairs(postings))
+    if len(pairs) <= k:
+        return pairs
+    scores = [lnc_from_tf(tf) / vector_lengths[ordinal]
+              for ordinal, tf in pairs]
+    cutoff = prune_threshold * nlargest(k, scores)[-1]
+    return [pair for pair, score in izip(pairs, scores) if score >= cutoff]
+
+
+def format_posting(docID, tf):
+    """Formats one posting as written in the postings file,
+    docID,lnc_weight,tf.
+    """
+    return ",".join([docID, "%.9f" % lnc_from_tf(tf), str(tf)])
+
+
+def postings_text(pairs, docs):
+    """Returns the text of a postings list as written in the postings file.
+
+    :param pairs: The (ordinal, tf) pairs of the postings, in ordinal order
+    :param docs: The list of (docID, file path) tuples, indexed by ordinal
+    """
+    pairs = list(pairs)
+    return join_postings([format_posting(docs[ordinal][0], tf)
+                          for ordinal, tf in pairs],
+                         [docs[ordinal][0] for ordinal, tf in pairs])
+
+
+def write_field_postings(postings_file, postings_list, docs,
+                         vector_lengths=None, prune_threshold=None,
+                         pruning=None):
+    """Writes the postings of every term of one field onto the postings file.
+    Each posting is written as docID,lnc_weight,tf, and long postings lists
+    start with a skip table. Term frequencies are only converted to lnc
+    weights here. The idf of a term always counts all of its
+    postings, pruned or not. Given the vector lengths, the dictionary entry
+    of a term also holds its largest cosine normalized lnc weight, which
+    bounds its contribution to the score of any document.
+
+    :param postings_file: The postings file object, opened for writing
+    :param postings_list: The inverted index of the field, with postings
+    buffers of (ordinal, tf) pairs.
+    :param docs: The list of (docID, file path) tuples, indexed by ordinal
+    :param vector_lengths: The vector lengths of the field, indexed by
+    ordinal, needed for pruning and for the largest weights
+    :param prune_threshold: The static pruning threshold, or None to write
+    every posting
+    :param pruning: Counter of the postings and bytes before and after
+    pruning, updated in place, or None
+    :return: A dictionary object with term as key and a tuple of (postings
+    pointer, postings run length in the file, idf[, largest weight]) as value
+    """
+    big_N = len(docs)
+    field_terms = {}
+    for term, postings in postings_list.iteritems():
+        if prune_threshold is None:
+            kept_pairs = list(postings_pairs(postings))
+        else:
+            kept_pairs = prune_postings(postings, vector_lengths,
+                                        prune_threshold)
+        posting_pointer = postings_file.tell()
+        postings_file.write(postings_text(kept_pairs, docs))
+        write_length = postings_file.tell() - posting_pointer
+        postings_file.write("\n")
+        field_terms[term] = (posting_pointer,
+                             write_length,
+                             idf_docs(len(postings) // 2, big_N))
+        if vector_lengths is not None:
+            field_terms[term] += (max(lnc_from_tf(tf) / vector_lengths[ordinal]
+                                      for ordinal, tf in kept_pairs),)
+        if pruning is not None and prune_threshold is not None:
+            pruning["postings"] += len(postings) // 2
+            pruning["kept_postings"] += len(kept_pairs)
+            # Measured like the kept postings, skip table included
+            if len(kept_pairs) == len(postings) // 2:
+                unpruned_length = write_length
+            else:
+                unpruned_length = len(postings_text(postings_pairs(postings),
+                                                    docs))
+            pruning["bytes"] += unpruned_length + 1
+            pruning["kept_bytes"] += write_length + 1
+    return field_terms
+
+
 def write_postings(title_postings_list, abstract_postings_list,
-                   postings_file_name, big_N):
+                   postings_file_name, docs, docs_metadata=None,
+                   prune_threshold=None, pruning=None):
     """Given inverted indices for patent title and abstract, write each term
     onto disk, while keeping track of the pointer to the start of postings for
     each term, together with the run length of said postings on the file, which
@@ -193,29 +535,45 @@ def write_postings(title_postings_list, abstract_postings_list,
     :param title_postings_list: The inverted index of titles to be stored
     :param abstract_postings_list: The inverted index of abstracts to be stored
     :param postings_file_name: The name of the postings file
+    :param docs: The list of (docID, file path) tuples, indexed by ordinal
+    :param docs_metadata: A mapping from docID to its metadata, needed for
+    pruning and for the largest weights of the terms
+    :param prune_threshold: The static pruning threshold, or None to write
+    every posting
+    :param pruning: Counter of the postings and bytes before and after
+    pruning, updated in place, or None
     :return: A dictionary object with term as key and a tuple of (postings
-    pointer, postings run length in the file) as value
+    pointer, postings run length in the file, idf[, largest weight, number
+    of documents containing the term in either field]) as value
     """
+    title_lengths = abstract_lengths = None
+    if docs_metadata is not None:
+        # [0] is title vector length, [1] abstract vector length
+        title_lengths = [docs_metadata[docID][0] for docID, path in docs]
+        abstract_lengths = [docs_metadata[docID][1] for docID, path in docs]
     with open(postings_file_name, 'w') as postings_file:
-        dict_terms = {"Title":{}, "Abstract":{}}
-        for term, postings in title_postings_list.iteritems():
-            posting_pointer = postings_file.tell()
-            postings_file.write(" ".join([",".join([docID, "%.9f" % weight])
-                                          for docID, weight in postings]))
-            write_length = postings_file.tell() - posting_pointer
-            postings_file.write("\n")
-            dict_terms["Title"][term] = (posting_pointer,
-                                write_length,
-                                idf_docs(len(postings), big_N))
-        for term, postings in abstract_postings_list.iteritems():
-            posting_pointer = postings_file.tell()
-            postings_file.write(" ".join([",".join([docID, "%.9f" % weight])
-                                          for docID, weight in postings]))
-            write_length = postings_file.tell() - posting_pointer
-            postings_file.write("\n")
-            dict_terms["Abstract"][term] = (posting_pointer,
-                                write_length,
-                                idf_docs(len(postings), big_N))
+        dict_terms = {}
+        dict_terms["Title"] = write_field_postings(postings_file,
+                                                   title_postings_list, docs,
+                                                   title_lengths,
+                                                   prune_threshold, pruning)
+        dict_terms["Abstract"] = write_field_postings(postings_file,
+                                                      abstract_postings_list,
+                                                      docs, abstract_lengths,
+                                                      prune_threshold,
+                                                      pruning)
+    if docs_metadata is not None:
+        # BM25F matches terms against both fields, so its document frequency
+        # counts the documents containing the term in either of them
+        for term in set(title_postings_list) | set(abstract_postings_list):
+            ordinals = set()
+            for postings_list in (title_postings_list,
+                                  abstract_postings_list):
+                if term in postings_list:
+                    ordinals.update(islice(postings_list[term], 0, None, 2))
+            for field in ("Title", "Abstract"):
+                if term in dict_terms[field]:
+                    dict_terms[field][term] += (len(ordinals),)
     return dict_terms
 
 
@@ -231,91 +589,242 @@ def all_doc_IDs(docs):
     return [docID for docID, doc_path in docs]
 
 
-def create_dictionary(docs_metadata, dict_terms, dict_file_name):
-    """Combines the metadata dictionary - keyed by docID, and
-    the dictionary itself, to create the dictionary file, and then writes the
-    resulting list to the specified file path as a JSON data structure.
+def collection_statistics(docs_metadata):
+    """Calculates the collection-wide statistics needed by probabilistic
+    scoring models such as BM25: the number of documents and the average
+    length in tokens of each field.
+
+    :param docs_metadata: A mapping from docID to its metadata.
+    """
+    big_N = len(docs_metadata)
+    # [4] is title length in tokens, [5] abstract length in tokens
+    title_tokens = sum(metadata[4] for metadata in docs_metadata.itervalues())
+    abstract_tokens = sum(metadata[5]
+                          for metadata in docs_metadata.itervalues())
+    return {"doc_count": big_N,
+            "average_lengths": {"Title": float(title_tokens) / max(big_N, 1),
+                                "Abstract":
+                                    float(abstract_tokens) / max(big_N, 1)}}
+
+
+def create_dictionary(docs_metadata, dict_terms, stems, dict_file_name):
+    """Combines the metadata dictionary - keyed by docID, the dictionary
+    itself, the normalization tables (stopwords and the surface form to
+    stem table) needed to normalize queries without nltk, and the collection
+    statistics, to create the dictionary file, and then writes the resulting
+    list to the specified file path as a JSON data structure, after a header
+    line giving the format of the file.
 
     :param docs_metadata: A mapping from docID to its metadata.
     :param dict_terms: The dictionary, with term as key and tuple of (postings
     pointer, postings run length in the file) as value
+    :param stems: Mapping of every surface form seen in the corpus to its stem
     :param dict_file_name: The file path of the resultant dictionary file
     """
+    normalization = {"stopwords": sorted(STOPWORDS), "stems": stems}
     with open(dict_file_name, 'w') as dict_file:
-        json.dump((docs_metadata, dict_terms), dict_file)
+        json.dump({"format": DICTIONARY_FORMAT, "statistics": True},
+                  dict_file)
+        dict_file.write("\n")
+        json.dump((docs_metadata, dict_terms, normalization,
+                   collection_statistics(docs_metadata)), dict_file)
+
+
+def create_wildcard_index(dict_terms, wildcard_file_name):
+    """Builds the wildcard index (sorted term array and k-gram index) of each
+    field's terms, and writes it to the specified file path as a JSON data
+    structure.
+
+    :param dict_terms: The dictionary, with field as key and mapping of term to
+    its entry as value
+    :param wildcard_file_name: The file path of the resultant wildcard index
+    """
+    with open(wildcard_file_name, 'w') as wildcard_file:
+        json.dump(dict((field, build_wildcard_index(terms))
+                       for field, terms in dict_terms.iteritems()),
+                  wildcard_file)
 
 
 def usage():
     """Prints the proper format for calling this script."""
     print "usage: " + sys.argv[0] + " -i directory-of-documents " \
-                                    "-d dictionary-file " \
-                                    "-p postings-file"
+                                    "(-d dictionary-file " \
+                                    "-p postings-file | -r index-root) " \
+                                    "[-c token-cache-file] " \
+                                    "[-P prune-threshold] " \
+                                    "[-m max-memory-MB] " \
+                                    "[-j memory-report-file]"
 
 
 def parse_args():
     """Attempts to parse command line arguments fed into the script when it was
     called. Notifies the user of the correct format if parsing failed.
     """
-    docs_dir = dict_file = postings_file = None
+    docs_dir = dict_file = postings_file = cache_file = index_root = None
+    memory_ceiling = memory_report_file = prune_threshold = None
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'i:d:p:')
-    except getopt.GetoptError, err:
+        opts, args = getopt.getopt(sys.argv[1:], 'i:d:p:c:r:m:j:P:')
+        for o, a in opts:
+            if o == '-i':
+                docs_dir = a
+            elif o == '-d':
+                dict_file = a
+            elif o == '-p':
+                postings_file = a
+            elif o == '-c':
+                cache_file = a
+            elif o == '-r':
+                index_root = a
+            elif o == '-m':
+                memory_ceiling = int(float(a) * MB)
+            elif o == '-j':
+                memory_report_file = a
+            elif o == '-P':
+                prune_threshold = float(a)
+            else:
+                assert False, "unhandled option"
+    except (getopt.GetoptError, ValueError), err:
         usage()
         sys.exit(2)
-    for o, a in opts:
-        if o == '-i':
-            docs_dir = a
-        elif o == '-d':
-            dict_file = a
-        elif o == '-p':
-            postings_file = a
-        else:
-            assert False, "unhandled option"
-    if docs_dir is None or dict_file is None or postings_file is None:
+    if docs_dir is None or (index_root is None) == \
+            (dict_file is None or postings_file is None):
         usage()
         sys.exit(2)
-    return docs_dir, dict_file, postings_file
+    return docs_dir, dict_file, postings_file, cache_file, index_root, \
+        memory_ceiling, memory_report_file, prune_threshold
 
 
 def main():
     """Constructs the inverted index from all documents in the specified file
     path, then writes dictionary to the specified dictionary file in the
     command line arguments, and postings to the specified postings file.
+    Given an index root instead, both are written to a new version of it,
+    which is only published once complete. Memory use is tracked per stage,
+    and the build stops once it goes above the memory ceiling, if any.
+    """
+    docs_dir, dict_file, postings_file, cache_file, index_root, \
+        memory_ceiling, memory_report_file, prune_threshold = parse_args()
+    # Sizing structures is only worth its memory when they are reported
+    memory = MemoryTracker(memory_ceiling, memory_report_file is not None)
+    try:
+        build_index(docs_dir, dict_file, postings_file, cache_file,
+                    index_root, memory, prune_threshold)
+    except MemoryCeilingExceeded, err:
+        print
+        print "Stopped: {0}".format(err)
+        if memory_report_file is not None:
+            memory.write_report(memory_report_file, str(err))
+        sys.exit(1)
+    print "Peak RSS: {0:.1f} MB".format(float(memory.report()["peak_rss"])
+                                        / MB)
+    if memory_report_file is not None:
+        memory.write_report(memory_report_file)
+
+
+def build_index(docs_dir, dict_file, postings_file, cache_file, index_root,
+                memory, prune_threshold=None):
+    """Runs every stage of the index build, recording memory use after each
+    in the memory tracker, and statically pruning the postings written if a
+    pruning threshold is given.
     """
-    docs_dir, dict_file, postings_file = parse_args()
+    if index_root is not None:
+        version = versions.create_version(index_root)
+        dict_file = versions.version_file(index_root, version,
+                                          versions.DICTIONARY)
+        postings_file = versions.version_file(index_root, version,
+                                              versions.POSTINGS)
 
     print "Searching for all documents in {0}...".format(docs_dir),
     sys.stdout.flush()
     docs = load_all_doc_names(docs_dir)
-    big_N = len(docs)
     print "DONE"
+    memory.stage("listing", docs=docs)
+
+    if cache_file is None:
+        stems = {}
+        token_cache = cached_docs = None
+    else:
+        print "Loading token cache from {0}...".format(cache_file),
+        sys.stdout.flush()
+        token_cache = load_token_cache(cache_file)
+        stems = token_cache["stems"]
+        cached_docs = token_cache["docs"]
+        print "DONE"
+        memory.stage("load_token_cache", stems=stems,
+                     cached_docs=cached_docs)
 
     print "Constructing the inverted index...",
     sys.stdout.flush()
-    title_postings_list, abstract_postings_list, IPC_dict = \
-        index_all_docs(docs)
-    converted_title_postings_list = \
-        convert_preliminary_postings(title_postings_list)
-    converted_abstract_postings_list = \
-        convert_preliminary_postings(abstract_postings_list)
-    docs_metadata = \
-        calculate_metadata(converted_title_postings_list,
-                           converted_abstract_postings_list,
-                           IPC_dict)
+    doc_store = DocumentStoreWriter(dict_file + DOC_STORE_SUFFIX)
+    forward_index = ForwardIndexWriter(dict_file + FORWARD_SUFFIX)
+    duplicates = DuplicateDetector()
+    title_postings_list, abstract_postings_list, IPC_list, family_list = \
+        index_all_docs(docs, stems, cached_docs, memory, doc_store,
+                       forward_index, duplicates)
+    doc_store.close()
+    forward_index.close()
+    memory.stage("index_all_docs",
+                 title_postings_list=title_postings_list,
+                 abstract_postings_list=abstract_postings_list,
+                 stems=stems, signatures=duplicates.signatures)
+    duplicate_list = duplicates.group_IDs()
+    del duplicates
+    memory.stage("find_duplicates")
+    docs_metadata = calculate_metadata(title_postings_list,
+                                       abstract_postings_list,
+                                       IPC_list,
+                                       family_list,
+                                       docs,
+                                       duplicate_list)
     print "DONE"
+    group_sizes = [size for size in Counter(duplicate_list).itervalues()
+                   if size > 1]
+    print "Found {0} near-duplicate documents in {1} groups".format(
+        sum(group_sizes), len(group_sizes))
+    memory.stage("calculate_metadata", docs_metadata=docs_metadata)
 
     print "Writing postings to {0}...".format(postings_file),
     sys.stdout.flush()
-    dict_terms = write_postings(converted_title_postings_list,
-                                converted_abstract_postings_list,
+    pruning = Counter()
+    dict_terms = write_postings(title_postings_list,
+                                abstract_postings_list,
                                 postings_file,
-                                big_N)
+                                docs,
+                                docs_metadata,
+                                prune_threshold,
+                                pruning)
+    # The postings are on disk now, free them for the remaining stages
+    del title_postings_list, abstract_postings_list
     print "DONE"
+    if prune_threshold is not None:
+        print "Pruned {0} of {1} postings, {2} of {3} bytes ({4:.1%})".format(
+            pruning["postings"] - pruning["kept_postings"],
+            pruning["postings"], pruning["bytes"] - pruning["kept_bytes"],
+            pruning["bytes"],
+            1 - float(pruning["kept_bytes"]) / max(pruning["bytes"], 1))
+    memory.stage("write_postings", dict_terms=dict_terms)
 
     print "Writing dictionary to {0}...".format(dict_file),
     sys.stdout.flush()
-    create_dictionary(docs_metadata, dict_terms, dict_file)
+    create_dictionary(docs_metadata, dict_terms, stems, dict_file)
+    create_wildcard_index(dict_terms, dict_file + WILDCARD_SUFFIX)
     print "DONE"
+    memory.stage("create_dictionary")
+
+    if index_root is not None:
+        print "Publishing version {0} of {1}...".format(version, index_root),
+        sys.stdout.flush()
+        versions.publish_version(index_root, version, len(docs))
+        versions.remove_old_versions(index_root)
+        print "DONE"
+
+    if token_cache is not None and memory.low_memory:
+        print "Not writing token cache, it was dropped to save memory"
+    elif token_cache is not None:
+        print "Writing token cache to {0}...".format(cache_file),
+        sys.stdout.flush()
+        save_token_cache(token_cache, docs, cache_file)
+        print "DONE"
 
 
 if __name__ == "__main__":
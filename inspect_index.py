@@ -0,0 +1,298 @@
+import getopt
+import sys
+import json
+from collections import Counter
+from heapq import nlargest
+from information_need import InformationNeed
+from scoring import FIELDS, IDF_INDEX, LENGTH_INDEX, TOKEN_LENGTH_INDEX, \
+    VECTOR_LENGTH_INDEX
+from search import load_dictionary, normalize
+
+"""
+Index inspection tool, reporting the shape of the index written by index.py.
+
+Reports, for each field, the vocabulary size, the document frequency
+distribution, the terms with the largest postings in bytes, and the document
+length distribution, plus the sizes of the IPC classes and of the
+near-duplicate groups. Given an information
+need file, it also estimates the cost of the query: the postings bytes read
+and postings scored per field. The report is printed for humans, or as JSON
+with -j.
+"""
+
+HEAVIEST_TERMS = 20  # default number of heaviest terms reported per field
+PERCENTILES = (0.5, 0.9, 0.99)
+
+
+def distribution(values):
+    """Summarizes a list of numbers.
+
+    :param values: The numbers to summarize.
+    :return: Dictionary of count, min, max, mean and percentiles.
+    """
+    if not values:
+        return {"count": 0}
+    values = sorted(values)
+    summary = {"count": len(values),
+               "min": values[0],
+               "max": values[-1],
+               "mean": float(sum(values)) / len(values)}
+    for fraction in PERCENTILES:
+        rank = max(int(round(fraction * len(values))), 1)
+        summary["p%d" % int(fraction * 100)] = values[rank - 1]
+    return summary
+
+
+def df_histogram(dfs):
+    """Counts terms in power-of-two document frequency buckets, i.e. terms
+    with df 1, 2-3, 4-7, and so on.
+
+    :param dfs: List of document frequencies.
+    :return: List of [bucket lower bound, number of terms] pairs.
+    """
+    buckets = Counter()
+    for df in dfs:
+        bucket = 1
+        while bucket * 2 <= df:
+            bucket *= 2
+        buckets[bucket] += 1
+    return [[bucket, buckets[bucket]] for bucket in sorted(buckets)]
+
+
+def document_frequency(term_entry, big_N):
+    """Recovers the document frequency of a term from the idf stored in its
+    dictionary entry, without reading its postings.
+
+    :param term_entry: The dictionary entry of the term, (postings pointer,
+    postings length in bytes, idf, ...)
+    :param big_N: The total number of documents
+    """
+    return int(round(big_N / 10 ** term_entry[IDF_INDEX]))
+
+
+def inspect_fields(docs_metadata, dictionary, heaviest_count):
+    """Reports vocabulary, document frequencies, heaviest terms and document
+    lengths of each field.
+
+    :param docs_metadata: Dictionary of document metadata
+    :param dictionary: Dictionary of field to term to postings pointer
+    :param heaviest_count: The number of heaviest terms to report
+    :return: Mapping of field to its report.
+    """
+    big_N = len(docs_metadata)
+    report = {}
+    for field in FIELDS:
+        terms = dictionary[field]
+        dfs = [document_frequency(entry, big_N)
+               for entry in terms.itervalues()]
+        heaviest = nlargest(
+            heaviest_count, terms.iteritems(),
+            key=lambda term_entry: term_entry[1][LENGTH_INDEX])
+        field_report = {
+            "vocabulary": len(terms),
+            "postings_bytes": sum(entry[LENGTH_INDEX]
+                                  for entry in terms.itervalues()),
+            "df": distribution(dfs),
+            "df_histogram": df_histogram(dfs),
+            "heaviest_terms": [[term, entry[LENGTH_INDEX],
+                                document_frequency(entry, big_N)]
+                               for term, entry in heaviest],
+            "vector_length": distribution(
+                [metadata[VECTOR_LENGTH_INDEX[field]]
+                 for metadata in docs_metadata.itervalues()])}
+        token_index = TOKEN_LENGTH_INDEX[field]
+        token_lengths = [metadata[token_index]
+                         for metadata in docs_metadata.itervalues()
+                         if len(metadata) > token_index]
+        if token_lengths:
+            field_report["token_length"] = distribution(token_lengths)
+        report[field] = field_report
+    return report
+
+
+def inspect_IPCs(docs_metadata):
+    """Reports the number of documents in each IPC class.
+
+    :param docs_metadata: Dictionary of document metadata
+    :return: List of [IPC class, size] pairs, largest first.
+    """
+    # [2] is IPC
+    sizes = Counter(metadata[2] for metadata in docs_metadata.itervalues())
+    return [[ipc, size] for ipc, size in sizes.most_common()]
+
+
+def inspect_duplicates(docs_metadata):
+    """Reports the sizes of the near-duplicate groups of more than one
+    document.
+
+    :param docs_metadata: Dictionary of document metadata
+    :return: List of group sizes, largest first.
+    """
+    # [6] is near-duplicate group ID
+    sizes = Counter(metadata[6] for metadata in docs_metadata.itervalues()
+                    if len(metadata) > 6)
+    return sorted((size for size in sizes.itervalues() if size > 1),
+                  reverse=True)
+
+
+def estimate_query_cost(index, query_file):
+    """Estimates the cost of a query: for each field, the query terms found
+    in the dictionary, the postings bytes read and the postings scored.
+
+    :param index: The Index returned by search.load_dictionary
+    :param query_file: The file path of the information need file
+    :return: Mapping of field to its cost estimate.
+    """
+    docs_metadata, dictionary = index.docs_metadata, index.dictionary
+    big_N = len(docs_metadata)
+    q = InformationNeed(query_file).get_data()
+    field_terms = {"Title": normalize(q["title"], index.stopwords,
+                                      index.stems),
+                   "Abstract": normalize(q["description"], index.stopwords,
+                                         index.stems)}
+    report = {}
+    for field in FIELDS:
+        terms = field_terms[field]
+        entries = [(term, dictionary[field][term]) for term in terms
+                   if term in dictionary[field]]
+        report[field] = {
+            "query_terms": len(terms),
+            "indexed_terms": len(entries),
+            "postings_bytes": sum(entry[LENGTH_INDEX]
+                                  for term, entry in entries),
+            "postings": sum(document_frequency(entry, big_N)
+                            for term, entry in entries),
+            "terms": [[term, entry[LENGTH_INDEX],
+                       document_frequency(entry, big_N)]
+                      for term, entry in entries]}
+    return report
+
+
+def inspect_index(dictionary_file, query_files=(),
+                  heaviest_count=HEAVIEST_TERMS):
+    """Builds the full report of the index.
+
+    :param dictionary_file: The file path of the dictionary file
+    :param query_files: File paths of information need files to estimate
+    :param heaviest_count: The number of heaviest terms to report per field
+    :return: The report as a dictionary.
+    """
+    index = load_dictionary(dictionary_file)
+    docs_metadata, dictionary = index.docs_metadata, index.dictionary
+    report = {"documents": len(docs_metadata),
+              "fields": inspect_fields(docs_metadata, dictionary,
+                                       heaviest_count),
+              "ipc_classes": inspect_IPCs(docs_metadata),
+              "duplicate_groups": inspect_duplicates(docs_metadata)}
+    if index.statistics is not None:
+        report["statistics"] = index.statistics
+    if query_files:
+        report["queries"] = dict((query_file,
+                                  estimate_query_cost(index, query_file))
+                                 for query_file in query_files)
+    return report
+
+
+def format_distribution(summary):
+    """Formats a distribution summary on one line."""
+    if summary["count"] == 0:
+        return "empty"
+    return "min %g, p50 %g, p90 %g, p99 %g, max %g, mean %.2f" % \
+        (summary["min"], summary["p50"], summary["p90"], summary["p99"],
+         summary["max"], summary["mean"])
+
+
+def print_report(report):
+    """Prints the report for humans.
+
+    :param report: The report, as returned by inspect_index
+    """
+    print "documents: %d" % report["documents"]
+    for field in FIELDS:
+        field_report = report["fields"][field]
+        print
+        print "[%s]" % field
+        print "vocabulary: %d terms, %d postings bytes" % \
+            (field_report["vocabulary"], field_report["postings_bytes"])
+        print "df: " + format_distribution(field_report["df"])
+        print "df histogram: " + ", ".join(
+            "%d+: %d" % (bucket, count)
+            for bucket, count in field_report["df_histogram"])
+        print "vector length: " + \
+            format_distribution(field_report["vector_length"])
+        if "token_length" in field_report:
+            print "length in tokens: " + \
+                format_distribution(field_report["token_length"])
+        print "heaviest terms (bytes, df):"
+        for term, postings_bytes, df in field_report["heaviest_terms"]:
+            print "  %-24s %10d %8d" % (term, postings_bytes, df)
+    print
+    print "IPC classes: %d" % len(report["ipc_classes"])
+    for ipc, size in report["ipc_classes"]:
+        print "  %-8s %8d" % (ipc, size)
+    print
+    print "near-duplicate groups: %d, %d documents" % \
+        (len(report["duplicate_groups"]), sum(report["duplicate_groups"]))
+    for query_file, cost in sorted(report.get("queries", {}).iteritems()):
+        print
+        print "query %s:" % query_file
+        for field in FIELDS:
+            field_cost = cost[field]
+            print "  %s: %d/%d terms indexed, %d postings bytes, " \
+                  "%d postings" % (field, field_cost["indexed_terms"],
+                                   field_cost["query_terms"],
+                                   field_cost["postings_bytes"],
+                                   field_cost["postings"])
+
+
+def usage():
+    """Prints the proper format for calling this script."""
+    print "usage: " + sys.argv[0] + " -d dictionary-file " \
+                                    "[-q file-of-query ...] " \
+                                    "[-n heaviest-terms] [-j]"
+
+
+def parse_args():
+    """Attempts to parse command line arguments fed into the script when it was
+    called. Notifies the user of the correct format if parsing failed.
+    """
+    dictionary_file = None
+    query_files = []
+    heaviest_count = HEAVIEST_TERMS
+    as_json = False
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'd:q:n:j')
+        for o, a in opts:
+            if o == '-d':
+                dictionary_file = a
+            elif o == '-q':
+                query_files.append(a)
+            elif o == '-n':
+                heaviest_count = int(a)
+            elif o == '-j':
+                as_json = True
+            else:
+                assert False, "unhandled option"
+    except (getopt.GetoptError, ValueError), err:
+        usage()
+        sys.exit(2)
+    if dictionary_file is None:
+        usage()
+        sys.exit(2)
+    return dictionary_file, query_files, heaviest_count, as_json
+
+
+def main():
+    """Prints the report of the index specified in the command line
+    arguments."""
+    dictionary_file, query_files, heaviest_count, as_json = parse_args()
+    report = inspect_index(dictionary_file, query_files, heaviest_count)
+    if as_json:
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,158 @@
+import getopt
+import sys
+import json
+import socket
+import threading
+import time
+from collections import Counter
+from information_need import InformationNeed
+from benchmark import percentile
+
+"""
+Local load generator for server.py.
+
+Opens a number of concurrent client connections, each sending queries built
+from the given information need files back to back until the total number of
+requests is reached, then reports throughput, the latency distribution of
+answered requests, and how many requests were rejected as busy, timed out or
+failed.
+"""
+
+ADDRESS = ("localhost", 8245)
+CLIENTS = 8  # default number of concurrent connections
+REQUESTS = 200  # default total number of requests
+
+
+def run_client(address, requests, statuses, latencies, lock):
+    """Sends requests over one connection, one at a time, recording the status
+    and latency of each response.
+
+    :param address: Tuple of host and port of the server
+    :param requests: List of request lines for this client to send
+    :param statuses: Counter of response statuses, updated in place
+    :param latencies: List of latencies in ms of answered requests, updated in
+    place
+    :param lock: Lock guarding statuses and latencies
+    """
+    connection = socket.create_connection(address)
+    reader = connection.makefile('r')
+    try:
+        for request in requests:
+            begin = time.time() * 1000.0
+            connection.sendall(request)
+            response = json.loads(reader.readline())
+            latency = time.time() * 1000.0 - begin
+            with lock:
+                statuses[response["status"]] += 1
+                if response["status"] == "ok":
+                    latencies.append(latency)
+    finally:
+        reader.close()
+        connection.close()
+
+
+def generate_load(address, query_files, clients=CLIENTS, total=REQUESTS,
+                  model="vsm"):
+    """Sends total requests to the server from concurrent clients.
+
+    :param address: Tuple of host and port of the server
+    :param query_files: List of file paths of information need files, used
+    round robin
+    :param clients: The number of concurrent connections
+    :param total: The total number of requests
+    :param model: The scoring model requested
+    :return: Tuple of wall clock time in ms, Counter of response statuses and
+    sorted list of latencies in ms of answered requests
+    """
+    lines = []
+    for query_file in query_files:
+        q = InformationNeed(query_file).get_data()
+        lines.append(json.dumps({"title": q["title"],
+                                 "description": q["description"],
+                                 "model": model}) + "\n")
+    requests = [lines[i % len(lines)] for i in xrange(total)]
+    statuses = Counter()
+    latencies = []
+    lock = threading.Lock()
+    threads = [threading.Thread(target=run_client,
+                                args=(address, requests[i::clients],
+                                      statuses, latencies, lock))
+               for i in xrange(clients)]
+    begin = time.time() * 1000.0
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.time() * 1000.0 - begin
+    latencies.sort()
+    return elapsed, statuses, latencies
+
+
+def print_report(elapsed, statuses, latencies):
+    """Prints throughput, latency percentiles and response statuses.
+
+    :param elapsed: Wall clock time of the run in ms
+    :param statuses: Counter of response statuses
+    :param latencies: Sorted list of latencies in ms of answered requests
+    """
+    print "requests: %d in %.1f ms" % (sum(statuses.values()), elapsed)
+    print "throughput: %.1f queries/s" % (statuses["ok"] * 1000.0 / elapsed)
+    for status in ("ok", "busy", "timeout", "error"):
+        print "%s: %d" % (status, statuses[status])
+    if latencies:
+        print "latency ms: p50 %.3f p95 %.3f p99 %.3f max %.3f" % \
+            (percentile(latencies, 0.5), percentile(latencies, 0.95),
+             percentile(latencies, 0.99), latencies[-1])
+
+
+def usage():
+    """Prints the proper format for calling this script."""
+    print "usage: " + sys.argv[0] + " -q file-of-query " \
+                                    "[-q file-of-query ...] " \
+                                    "[-a host:port] [-c clients] " \
+                                    "[-n requests] [-m model]"
+
+
+def parse_args():
+    """Attempts to parse command line arguments fed into the script when it was
+    called. Notifies the user of the correct format if parsing failed.
+    """
+    query_files = []
+    address = ADDRESS
+    clients = CLIENTS
+    total = REQUESTS
+    model = "vsm"
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'q:a:c:n:m:')
+        for o, a in opts:
+            if o == '-q':
+                query_files.append(a)
+            elif o == '-a':
+                host, port = a.rsplit(":", 1)
+                address = (host, int(port))
+            elif o == '-c':
+                clients = int(a)
+            elif o == '-n':
+                total = int(a)
+            elif o == '-m':
+                model = a
+            else:
+                assert False, "unhandled option"
+    except (getopt.GetoptError, ValueError), err:
+        usage()
+        sys.exit(2)
+    if not query_files:
+        usage()
+        sys.exit(2)
+    return query_files, address, clients, total, model
+
+
+def main():
+    """Runs the load specified in the command line arguments against a
+    running server.py and prints the report."""
+    query_files, address, clients, total, model = parse_args()
+    print_report(*generate_load(address, query_files, clients, total, model))
+
+
+if __name__ == "__main__":
+    main()
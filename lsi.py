@@ -0,0 +1,297 @@
+import getopt
+import sys
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from array import array
+from collections import Counter
+from math import log10
+import numpy
+try:
+    from scipy.sparse import csr_matrix
+    from scipy.sparse.linalg import svds
+except ImportError:
+    # Falls back to a dense SVD with numpy, which only suits small corpora
+    csr_matrix = svds = None
+from scoring import FIELD_WEIGHTS, IDF_INDEX
+from search import read_dictionary_header, read_postings
+
+"""
+Latent semantic indexing (LSI) retrieval engine.
+
+Offline, a sparse document-term matrix is built from the lnc-weighted title
+and abstract postings written by index.py, with one column per (field, term),
+and its truncated SVD is computed. The document vectors of the reduced space
+are stored in a .npy file which is memory-mapped at query time, so serving a
+query only touches the rows being scored. Queries are projected into the same
+space and scored by cosine similarity with blocked matrix-vector products.
+Running this python module with command line arguments builds the LSI files
+from an existing dictionary and postings file; running it on its own without
+arguments just runs the unit tests defined within.
+"""
+
+RANK = 100  # default number of singular values kept
+TOP_K = 1000  # default number of documents returned for a query
+BLOCK_SIZE = 4096  # number of document vectors scored per matrix product
+
+
+def build_matrix(dictionary_file, postings_file):
+    """Builds the sparse document-term matrix from the dictionary and postings
+    files. Each entry is the document's lnc weight for the term, normalized by
+    the document's vector length for the field and scaled by the term's idf
+    and the field weight.
+
+    :param dictionary_file: The file path of the dictionary file
+    :param postings_file: The file path of the postings file
+    :return: Tuple of the list of docIDs (one per row), the mapping of field
+    to term to column, and the (rows, columns, values, shape) of the matrix
+    """
+    with open(dictionary_file) as dict_file:
+        read_dictionary_header(dict_file)
+        temp = json.load(dict_file)
+        docs_metadata = temp[0]
+        dictionary = temp[1]
+    docIDs = sorted(docs_metadata)
+    rows = dict((docID, row) for row, docID in enumerate(docIDs))
+    columns = {"Title": {}, "Abstract": {}}
+    row_indices = array('i')
+    column_indices = array('i')
+    values = array('d')
+    column_count = 0
+    with open(postings_file) as postings:
+        # [0] is title_length, [1] abstract_length
+        for field, length_index in (("Title", 0), ("Abstract", 1)):
+            for term in sorted(dictionary[field]):
+                columns[field][term] = column_count
+                term_idf = dictionary[field][term][IDF_INDEX]
+                for docID, weight, tf in read_postings(term, dictionary,
+                                                       postings, field):
+                    length = docs_metadata[docID][length_index]
+                    row_indices.append(rows[docID])
+                    column_indices.append(column_count)
+                    values.append(FIELD_WEIGHTS[field] * term_idf
+                                  * weight / length)
+                column_count += 1
+    shape = (len(docIDs), column_count)
+    return docIDs, columns, (row_indices, column_indices, values, shape)
+
+
+def truncated_svd(matrix, rank):
+    """Computes the truncated SVD of the document-term matrix.
+
+    :param matrix: Tuple of (rows, columns, values, shape) of the matrix
+    :param rank: The number of singular values to keep
+    :return: Tuple of (U, sigma, V) for the kept singular values, in
+    descending order of singular value
+    """
+    row_indices, column_indices, values, shape = matrix
+    rank = max(1, min(rank, min(shape) - 1))
+    # svds only keeps fewer singular values than the matrix has, so a matrix
+    # of a single document or term takes the dense path
+    if svds is not None and rank < min(shape):
+        sparse = csr_matrix((numpy.frombuffer(values, dtype=numpy.float64),
+                             (numpy.frombuffer(row_indices, dtype=numpy.int32),
+                              numpy.frombuffer(column_indices,
+                                               dtype=numpy.int32))),
+                            shape=shape)
+        u, sigma, vt = svds(sparse, k=rank)
+    else:
+        dense = numpy.zeros(shape)
+        dense[numpy.frombuffer(row_indices, dtype=numpy.int32),
+              numpy.frombuffer(column_indices, dtype=numpy.int32)] = \
+            numpy.frombuffer(values, dtype=numpy.float64)
+        u, sigma, vt = numpy.linalg.svd(dense, full_matrices=False)
+    order = numpy.argsort(sigma)[::-1][:rank]
+    return u[:, order], sigma[order], vt[order].T
+
+
+def build_lsi(dictionary_file, postings_file, lsi_prefix, rank=RANK):
+    """Builds the LSI files from the dictionary and postings files. Three files
+    are written: lsi_prefix.docs.npy holds the unit-length document vectors
+    (rows of U * sigma), lsi_prefix.terms.npy the term vectors (rows of V)
+    used to project queries, and lsi_prefix.json the docID of each row and the
+    column of each (field, term).
+
+    :param dictionary_file: The file path of the dictionary file
+    :param postings_file: The file path of the postings file
+    :param lsi_prefix: The file path prefix of the LSI files
+    :param rank: The number of singular values to keep
+    """
+    docIDs, columns, matrix = build_matrix(dictionary_file, postings_file)
+    u, sigma, v = truncated_svd(matrix, rank)
+    doc_vectors = u * sigma
+    lengths = numpy.sqrt((doc_vectors ** 2).sum(axis=1))
+    lengths[lengths == 0] = 1
+    doc_vectors /= lengths[:, numpy.newaxis]
+    numpy.save(lsi_prefix + ".docs.npy", doc_vectors.astype(numpy.float32))
+    numpy.save(lsi_prefix + ".terms.npy", v.astype(numpy.float32))
+    with open(lsi_prefix + ".json", 'w') as lsi_file:
+        json.dump({"docIDs": docIDs, "columns": columns}, lsi_file)
+
+
+class LatentSemanticIndex:
+    """LSI files written by build_lsi, with document vectors memory-mapped."""
+
+    def __init__(self, lsi_prefix):
+        """Loads the LSI files with the given prefix.
+
+        :param lsi_prefix: The file path prefix of the LSI files
+        """
+        with open(lsi_prefix + ".json") as lsi_file:
+            temp = json.load(lsi_file)
+        self.docIDs = temp["docIDs"]
+        self.columns = temp["columns"]
+        self.doc_vectors = numpy.load(lsi_prefix + ".docs.npy", mmap_mode='r')
+        self.term_vectors = numpy.load(lsi_prefix + ".terms.npy",
+                                       mmap_mode='r')
+
+    def project(self, title_terms, description_terms):
+        """Projects the query into the reduced space. Query terms are weighted
+        by 1 + log(tf) and the field weight; the idf is already part of the
+        document-term matrix. Terms missing from the index are ignored.
+
+        :param title_terms: Normalized query title terms
+        :param description_terms: Normalized query description terms
+        :return: The unit-length query vector, or None if no term is indexed
+        """
+        query_vector = numpy.zeros(self.term_vectors.shape[1],
+                                   dtype=numpy.float32)
+        for field, terms in (("Title", title_terms),
+                             ("Abstract", description_terms)):
+            for term, tf in Counter(terms).iteritems():
+                column = self.columns[field].get(term)
+                if column is not None:
+                    query_vector += FIELD_WEIGHTS[field] * (1 + log10(tf)) \
+                        * self.term_vectors[column]
+        length = numpy.sqrt(query_vector.dot(query_vector))
+        if length == 0:
+            return None
+        return query_vector / length
+
+    def search(self, title_terms, description_terms, top_k=TOP_K):
+        """Returns the top_k documents with a positive cosine similarity to the
+        query in the reduced space.
+
+        :param title_terms: Normalized query title terms
+        :param description_terms: Normalized query description terms
+        :param top_k: The maximum number of documents to return
+        :return: List of (docID, score) tuples in descending score
+        """
+        query_vector = self.project(title_terms, description_terms)
+        doc_count = len(self.docIDs)
+        if query_vector is None or doc_count == 0:
+            return []
+        scores = numpy.empty(doc_count, dtype=numpy.float32)
+        for start in xrange(0, doc_count, BLOCK_SIZE):
+            end = min(start + BLOCK_SIZE, doc_count)
+            scores[start:end] = self.doc_vectors[start:end].dot(query_vector)
+        top_k = min(top_k, doc_count)
+        top = numpy.argpartition(-scores, top_k - 1)[:top_k]
+        top = top[numpy.argsort(-scores[top], kind='mergesort')]
+        return [(self.docIDs[row], float(scores[row]))
+                for row in top if scores[row] > 0]
+
+
+class TestLatentSemanticIndex(unittest.TestCase):
+    """Test case ensuring LSI files are built and queried as expected"""
+
+    def setUp(self):
+        """Writes a tiny dictionary and postings file in the format written by
+        index.py into a temporary directory."""
+        self.directory = tempfile.mkdtemp()
+        postings = [("Title", "washer", "a.xml,1.0"),
+                    ("Title", "pump", "b.xml,1.0"),
+                    ("Abstract", "bubbl", "a.xml,1.301029996"),
+                    ("Abstract", "foam", "a.xml,1.0 c.xml,1.0"),
+                    ("Abstract", "valv", "b.xml,1.0 c.xml,1.0")]
+        dictionary = {"Title": {}, "Abstract": {}}
+        self.postings_file = os.path.join(self.directory, "postings.txt")
+        with open(self.postings_file, 'w') as postings_file:
+            for field, term, line in postings:
+                pointer = postings_file.tell()
+                postings_file.write(line + "\n")
+                df = len(line.split())
+                dictionary[field][term] = (pointer, len(line), log10(3.0 / df))
+        docs_metadata = {"a.xml": (1.0, 1.6423, "D06", 0),
+                         "b.xml": (1.0, 1.0, "F16", 1),
+                         "c.xml": (0.0, 1.4142, "D06", 2)}
+        self.dictionary_file = os.path.join(self.directory, "dictionary.txt")
+        with open(self.dictionary_file, 'w') as dict_file:
+            json.dump((docs_metadata, dictionary), dict_file)
+        self.lsi_prefix = os.path.join(self.directory, "lsi")
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_search(self):
+        """Ensures the document sharing the most query terms ranks first."""
+        build_lsi(self.dictionary_file, self.postings_file, self.lsi_prefix,
+                  rank=2)
+        lsi = LatentSemanticIndex(self.lsi_prefix)
+        results = lsi.search(["washer"], ["bubbl", "foam"])
+        self.assertEqual(results[0][0], "a.xml")
+        self.assertEqual(lsi.search(["unknown"], []), [])
+
+    def test_single_row(self):
+        """Ensures a matrix of a single document keeps its singular value."""
+        u, sigma, v = truncated_svd((array('i', [0, 0]), array('i', [0, 2]),
+                                     array('d', [3.0, 4.0]), (1, 3)), 10)
+        self.assertEqual(u.shape, (1, 1))
+        self.assertAlmostEqual(sigma[0], 5.0)
+        self.assertEqual(v.shape, (3, 1))
+
+
+def usage():
+    """Prints the proper format for calling this script."""
+    print "usage: " + sys.argv[0] + " -d dictionary-file " \
+                                    "-p postings-file " \
+                                    "-o lsi-prefix " \
+                                    "[-k rank]"
+
+
+def parse_args():
+    """Attempts to parse command line arguments fed into the script when it was
+    called. Notifies the user of the correct format if parsing failed.
+    """
+    dict_file = postings_file = lsi_prefix = None
+    rank = RANK
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'd:p:o:k:')
+    except getopt.GetoptError, err:
+        usage()
+        sys.exit(2)
+    for o, a in opts:
+        if o == '-d':
+            dict_file = a
+        elif o == '-p':
+            postings_file = a
+        elif o == '-o':
+            lsi_prefix = a
+        elif o == '-k':
+            rank = int(a)
+        else:
+            assert False, "unhandled option"
+    if dict_file is None or postings_file is None or lsi_prefix is None:
+        usage()
+        sys.exit(2)
+    return dict_file, postings_file, lsi_prefix, rank
+
+
+def main():
+    """Builds the LSI files from the dictionary and postings files specified
+    in the command line arguments."""
+    dict_file, postings_file, lsi_prefix, rank = parse_args()
+
+    print "Building rank {0} LSI to {1}...".format(rank, lsi_prefix),
+    sys.stdout.flush()
+    build_lsi(dict_file, postings_file, lsi_prefix, rank)
+    print "DONE"
+
+
+if __name__ == "__main__":
+    if len(sys.argv) > 1:
+        main()
+    else:
+        unittest.main()
@@ -0,0 +1,188 @@
+import json
+import resource
+import sys
+import time
+import unittest
+from array import array
+
+"""
+Memory tracking of index builds.
+
+A MemoryTracker records, at the end of every stage of index.py, the resident
+set size (RSS) and the peak RSS so far, and writes them as a JSON report.
+Only when the report is wanted are the structures the stage built sized too,
+as walking them takes memory of its own. Given a memory ceiling, it raises
+MemoryCeilingExceeded as soon as a check finds the RSS above it, so that a
+build that will not fit fails with a report instead of being killed by the
+OOM killer, and it tells index.py when the RSS gets close enough to the
+ceiling to drop its token cache, the only memory index.py can give up.
+Running this python module on its own just runs the unit tests defined within.
+"""
+
+MB = 1024 * 1024
+# Fraction of the ceiling beyond which index.py saves memory where it can
+LOW_MEMORY_FRACTION = 0.75
+
+
+class MemoryCeilingExceeded(Exception):
+    """Raised when the RSS of the build goes above the memory ceiling."""
+    pass
+
+
+def peak_rss():
+    """Returns the peak RSS of this process in bytes."""
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on OS X, but in kilobytes on Linux
+    return maxrss if sys.platform == "darwin" else maxrss * 1024
+
+
+def current_rss():
+    """Returns the current RSS of this process in bytes, or the peak RSS
+    where /proc is not available."""
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * resource.getpagesize()
+    except (IOError, IndexError, ValueError):
+        return peak_rss()
+
+
+def approximate_size(structure):
+    """Approximates the memory used by a structure in bytes: the container
+    itself and everything it holds, through any depth of dictionaries, lists,
+    tuples and sets. Arrays count their buffers. Objects held more than once,
+    such as interned strings, are only counted once.
+
+    :param structure: A dictionary, list, tuple, set or array
+    """
+    size = 0
+    seen = set()
+    pending = [structure]
+    while pending:
+        value = pending.pop()
+        if id(value) in seen:
+            continue
+        seen.add(id(value))
+        size += sys.getsizeof(value)
+        if isinstance(value, dict):
+            pending.extend(value.iterkeys())
+            pending.extend(value.itervalues())
+        elif isinstance(value, (list, tuple, set, frozenset)):
+            pending.extend(value)
+    return size
+
+
+class MemoryTracker:
+    """Records memory use per stage of a build, against an optional
+    ceiling."""
+
+    def __init__(self, ceiling=None, size_structures=False):
+        """Starts tracking.
+
+        :param ceiling: The memory ceiling in bytes, or None for no ceiling
+        :param size_structures: Whether to record the approximate sizes of
+        the structures of every stage, for the report
+        """
+        self.ceiling = ceiling
+        self.size_structures = size_structures
+        self.stages = []
+        self.low_memory = False
+        self.start_time = time.time()
+
+    def check(self, stage_name):
+        """Raises MemoryCeilingExceeded if the RSS is above the ceiling.
+
+        :param stage_name: The name of the running stage, for the message
+        """
+        rss = current_rss()
+        if self.ceiling is not None and rss > self.ceiling:
+            raise MemoryCeilingExceeded(
+                "RSS of %.1f MB is above the ceiling of %.1f MB during %s"
+                % (float(rss) / MB, float(self.ceiling) / MB, stage_name))
+
+    def near_ceiling(self):
+        """Returns whether the RSS is close enough to the ceiling for the
+        build to drop its token cache."""
+        return self.ceiling is not None \
+            and current_rss() > LOW_MEMORY_FRACTION * self.ceiling
+
+    def stage(self, stage_name, **structures):
+        """Records the memory use at the end of a stage and checks it against
+        the ceiling, before sizing the structures of the stage if wanted.
+
+        :param stage_name: The name of the stage
+        :param structures: The structures built by the stage, by name
+        """
+        rss = current_rss()
+        sizes = {}
+        self.stages.append({
+            "stage": stage_name,
+            "seconds": time.time() - self.start_time,
+            "rss": rss,
+            # The two are sampled separately, the peak must cover the RSS
+            "peak_rss": max(peak_rss(), rss),
+            "structures": sizes})
+        self.check(stage_name)
+        if self.size_structures:
+            for name, structure in structures.iteritems():
+                sizes[name] = approximate_size(structure)
+
+    def report(self, error=None):
+        """Returns the report of the build as a dictionary.
+
+        :param error: The message of the error that stopped the build, if any
+        """
+        return {"ceiling": self.ceiling,
+                "peak_rss": peak_rss(),
+                "low_memory": self.low_memory,
+                "error": error,
+                "stages": self.stages}
+
+    def write_report(self, report_file_name, error=None):
+        """Writes the report of the build as JSON.
+
+        :param report_file_name: The file path of the report
+        :param error: The message of the error that stopped the build, if any
+        """
+        with open(report_file_name, 'w') as report_file:
+            json.dump(self.report(error), report_file, indent=2,
+                      sort_keys=True)
+
+
+class TestMemoryTracker(unittest.TestCase):
+    """Test case ensuring memory use is recorded and the ceiling enforced"""
+
+    def test_stage(self):
+        tracker = MemoryTracker(size_structures=True)
+        postings = {"pump": array('I', range(1000))}
+        tracker.stage("index_all_docs", postings=postings)
+        stage = tracker.report()["stages"][0]
+        self.assertEqual(stage["stage"], "index_all_docs")
+        self.assertTrue(stage["structures"]["postings"] > 4000)
+        self.assertTrue(0 < stage["rss"] <= stage["peak_rss"])
+
+    def test_structures_not_sized(self):
+        tracker = MemoryTracker()
+        tracker.stage("listing", docs=range(1000))
+        self.assertEqual(tracker.report()["stages"][0]["structures"], {})
+
+    def test_nested_structures(self):
+        terms = dict((u"term%d" % number, [number, 1.5])
+                     for number in xrange(1000))
+        nested = {"Title": terms, "Abstract": dict(terms)}
+        self.assertTrue(approximate_size(nested) >
+                        approximate_size(terms) > 1000 * 100)
+        # The second dictionary shares its keys and values with the first
+        self.assertTrue(approximate_size(nested)
+                        < 2 * approximate_size(terms))
+
+    def test_ceiling(self):
+        tracker = MemoryTracker(ceiling=1)
+        self.assertTrue(tracker.near_ceiling())
+        self.assertRaises(MemoryCeilingExceeded, tracker.stage, "listing")
+        # The stage stopping the build is reported, without sizes
+        self.assertEqual(tracker.report()["stages"][0]["stage"], "listing")
+        self.assertFalse(MemoryTracker(ceiling=1 << 50).near_ceiling())
+
+
+if __name__ == '__main__':
+    unittest.main()
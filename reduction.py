@@ -0,0 +1,214 @@
+import getopt
+import sys
+import time
+from collections import Counter
+from itertools import islice
+from benchmark import percentile
+from drift import overlap_at_k
+from information_need import InformationNeed
+from scoring import SCORERS
+from search import check_model, has_statistics, load_dictionary, normalize, \
+    reduce_query, run_query
+
+"""
+Latency against overlap@k of query reduction budgets, to choose the budget
+of search.py -n (term budget) or -M (score mass budget) on evidence.
+
+Every query file is run through the search pipeline of search.py without
+query reduction, as the reference, and then with every budget. For each
+budget, it reports the mean number of distinct query terms kept, the mean
+and 95th percentile latency of the queries, and the mean overlap@k of their
+top k with the reference top k.
+"""
+
+K = 10  # default number of top results compared
+REPEATS = 3  # default number of timed runs per query and budget
+# Budgets reported when none is given, as (max terms, score mass) pairs
+DEFAULT_BUDGETS = [(5, None), (10, None), (20, None),
+                   (None, 0.5), (None, 0.8), (None, 0.9), (None, 0.95)]
+
+
+def time_query(index, postings, query, model, k, budget, repeats):
+    """Runs a query repeatedly with a reduction budget.
+
+    :param index: The Index returned by search.load_dictionary
+    :param postings: File object of the postings file
+    :param query: The information need, as returned by
+    InformationNeed.get_data
+    :param model: The name of the scoring model
+    :param k: The number of results
+    :param budget: Tuple of the term budget and the score mass budget
+    :param repeats: The number of timed runs
+    :return: Tuple of the top k docIDs and the fastest latency in ms
+    """
+    max_terms, score_mass = budget
+    latencies = []
+    for repeat in xrange(repeats):
+        begin = time.time() * 1000.0
+        results = list(islice(run_query(index, postings, query["title"],
+                                        query["description"], model,
+                                        limit=k, max_terms=max_terms,
+                                        score_mass=score_mass), k))
+        latencies.append(time.time() * 1000.0 - begin)
+    return results, min(latencies)
+
+
+def kept_terms(index, query, model, budget):
+    """Returns the number of distinct (field, term) pairs of a query kept by
+    a reduction budget.
+
+    :param index: The Index returned by search.load_dictionary
+    :param query: The information need, as returned by
+    InformationNeed.get_data
+    :param model: The name of the scoring model
+    :param budget: Tuple of the term budget and the score mass budget
+    """
+    stopwords, stems = index.stopwords, index.stems
+    field_terms = {"Title": normalize(query["title"], stopwords, stems),
+                   "Abstract": normalize(query["description"], stopwords,
+                                         stems)}
+    if budget != (None, None):
+        scorer = SCORERS[model](index.docs_metadata, index.dictionary,
+                                index.statistics)
+        field_terms = reduce_query(field_terms, scorer, *budget)
+    return sum(len(Counter(terms)) for terms in field_terms.itervalues())
+
+
+def reduction_report(dictionary_file, postings_file, query_files,
+                     budgets=DEFAULT_BUDGETS, model="vsm", k=K,
+                     repeats=REPEATS):
+    """Measures latency and overlap@k of every reduction budget.
+
+    :param dictionary_file: The file path of the dictionary file
+    :param postings_file: The file path of the postings file
+    :param query_files: List of file paths of information need files
+    :param budgets: List of (max terms, score mass) budgets
+    :param model: The name of the scoring model
+    :param k: The number of top results compared
+    :param repeats: The number of timed runs per query and budget
+    :return: List of (budget, mean terms kept, sorted latencies, mean
+    overlap@k) tuples, starting with the unreduced reference.
+    """
+    index = load_dictionary(dictionary_file)
+    queries = [InformationNeed(query_file).get_data()
+               for query_file in query_files]
+    report = []
+    with open(postings_file) as postings:
+        # Warm up, so that one-off lazy loads are not attributed to the
+        # reference
+        for query in queries:
+            time_query(index, postings, query, model, k, (None, None), 1)
+        references = []
+        for budget in [(None, None)] + list(budgets):
+            latencies = []
+            overlaps = []
+            for number, query in enumerate(queries):
+                results, latency = time_query(index, postings, query, model,
+                                              k, budget, repeats)
+                if budget == (None, None):
+                    references.append(results)
+                latencies.append(latency)
+                overlaps.append(overlap_at_k(references[number], results, k))
+            report.append((budget,
+                           float(sum(kept_terms(index, query, model, budget)
+                                     for query in queries)) / len(queries),
+                           sorted(latencies),
+                           sum(overlaps) / len(overlaps)))
+    return report
+
+
+def format_budget(budget):
+    """Formats a (max terms, score mass) budget for the report."""
+    max_terms, score_mass = budget
+    if max_terms is None and score_mass is None:
+        return "full"
+    return " ".join((["n=%d" % max_terms] if max_terms is not None else [])
+                    + (["M=%g" % score_mass] if score_mass is not None
+                       else []))
+
+
+def print_report(report, k):
+    """Prints the latency and overlap@k of every budget.
+
+    :param report: The report, as returned by reduction_report
+    :param k: The number of top results compared
+    """
+    print "%-12s %8s %10s %10s %12s" % ("budget", "terms", "mean ms",
+                                        "p95 ms", "overlap@%d" % k)
+    for budget, terms, latencies, overlap in report:
+        print "%-12s %8.1f %10.3f %10.3f %12.3f" % \
+            (format_budget(budget), terms,
+             sum(latencies) / len(latencies), percentile(latencies, 0.95),
+             overlap)
+
+
+def usage():
+    """Prints the proper format for calling this script."""
+    print "usage: " + sys.argv[0] + " -d dictionary-file " \
+                                    "-p postings-file " \
+                                    "-q file-of-query " \
+                                    "[-q file-of-query ...] " \
+                                    "[-n max-terms ...] " \
+                                    "[-M score-mass ...] " \
+                                    "[-m model] [-k top-k] [-r repeats]"
+
+
+def parse_args():
+    """Attempts to parse command line arguments fed into the script when it was
+    called. Notifies the user of the correct format if parsing failed.
+    """
+    dictionary_file = postings_file = None
+    query_files = []
+    budgets = []
+    model = "vsm"
+    k = K
+    repeats = REPEATS
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'd:p:q:n:M:m:k:r:')
+        for o, a in opts:
+            if o == '-d':
+                dictionary_file = a
+            elif o == '-p':
+                postings_file = a
+            elif o == '-q':
+                query_files.append(a)
+            elif o == '-n':
+                budgets.append((int(a), None))
+            elif o == '-M':
+                budgets.append((None, float(a)))
+            elif o == '-m':
+                model = a
+            elif o == '-k':
+                k = int(a)
+            elif o == '-r':
+                repeats = int(a)
+            else:
+                assert False, "unhandled option"
+    except (getopt.GetoptError, ValueError), err:
+        usage()
+        sys.exit(2)
+    if dictionary_file is None or postings_file is None or not query_files \
+            or model not in SCORERS:
+        usage()
+        sys.exit(2)
+    problem = check_model(model, has_statistics(dictionary_file))
+    if problem is not None:
+        print problem
+        usage()
+        sys.exit(2)
+    return dictionary_file, postings_file, query_files, \
+        budgets or DEFAULT_BUDGETS, model, k, repeats
+
+
+def main():
+    """Prints the reduction report of the query files specified in the
+    command line arguments."""
+    dictionary_file, postings_file, query_files, budgets, model, k, \
+        repeats = parse_args()
+    print_report(reduction_report(dictionary_file, postings_file,
+                                  query_files, budgets, model, k, repeats),
+                 k)
+
+
+if __name__ == "__main__":
+    main()
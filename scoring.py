@@ -0,0 +1,475 @@
+import unittest
+from collections import Counter, defaultdict
+from math import log, log10
+
+"""
+Pluggable scoring models for the title and abstract fields.
+
+Every model implements the Scorer interface: search.py asks it which postings
+it needs for a query with required_terms, reads those postings, and hands them
+to score, which returns the score of every document. All statistics a model
+needs (idf, vector lengths, field lengths in tokens, average field lengths and
+raw tf) are precomputed by index.py, so no model recomputes anything from the
+corpus per query.
+Running this python module on its own just runs the unit tests defined within.
+"""
+
+FIELDS = ("Title", "Abstract")
+# Weights of the title and abstract scores in the combined document score
+FIELD_WEIGHTS = {"Title": 0.05, "Abstract": 0.95}
+# Indices of the vector length and length in tokens of each field in the
+# documents' metadata
+VECTOR_LENGTH_INDEX = {"Title": 0, "Abstract": 1}
+TOKEN_LENGTH_INDEX = {"Title": 4, "Abstract": 5}
+# Index of the ordinal of the document in its metadata, by which the files
+# written in ordinal order, such as the forward index, look it up
+ORDINAL_INDEX = 7
+# Indices of the postings pointer, postings length in bytes, idf, largest
+# lnc weight and document frequency in either field of a dictionary entry;
+# the last two are missing from entries written without vector lengths
+POINTER_INDEX = 0
+LENGTH_INDEX = 1
+IDF_INDEX = 2
+MAX_WEIGHT_INDEX = 3
+ANY_FIELD_DF_INDEX = 4
+
+K1 = 1.2  # BM25 term frequency saturation
+B = 0.75  # BM25 length normalization
+# BM25F per-field boosts and length normalization
+BM25F_BOOSTS = {"Title": 2.0, "Abstract": 1.0}
+BM25F_B = {"Title": 0.75, "Abstract": 0.75}
+
+
+class Scorer(object):
+    """Interface of scoring models. Subclasses implement score, and override
+    required_terms if they need postings beyond each field's own terms."""
+
+    # Whether the score of a document only depends on its own postings, so
+    # that a conjunctive query may read postings for its matches only
+    restrictable = True
+    # Whether the model needs the collection statistics and the field
+    # lengths in tokens, which dictionary files written before them lack
+    needs_statistics = False
+
+    def __init__(self, docs_metadata, dictionary, statistics):
+        """Initializes the scorer with the index it scores documents from.
+
+        :param docs_metadata: Dictionary of document metadata
+        :param dictionary: Dictionary of field to term to postings pointer
+        :param statistics: Collection statistics stored by index.py, or None
+        if the dictionary file predates them
+        """
+        self.docs_metadata = docs_metadata
+        self.dictionary = dictionary
+        self.statistics = statistics
+        # Document frequencies of wildcard terms, estimated by search.py
+        # from the stored frequencies of the terms they expand to
+        self.wildcard_dfs = {}
+
+    def required_terms(self, field_terms):
+        """Returns the terms whose postings are needed to score the query.
+
+        :param field_terms: Mapping of field to the normalized query terms
+        matched against that field
+        :return: Mapping of field to the set of terms to read postings for
+        """
+        return dict((field, set(terms))
+                    for field, terms in field_terms.iteritems())
+
+    def score(self, field_terms, field_postings):
+        """Scores every document against the query.
+
+        :param field_terms: Mapping of field to the normalized query terms
+        matched against that field
+        :param field_postings: Mapping of field to term to its postings, a list
+        of [docID, lnc_weight, tf] sorted by docID, for the terms from
+        required_terms. A wildcard term has the union of the postings of the
+        terms it expands to.
+        :return: Dictionary mapping from document ID to score.
+        """
+        raise NotImplementedError
+
+    def term_bound(self, field, term, tf_in_query):
+        """Returns an upper bound of the contribution of a query term to the
+        score of any document, from the dictionary alone, which query
+        reduction ranks terms by. Terms outside the dictionary contribute
+        nothing.
+
+        :param field: The field the term is matched against
+        :param term: The normalized query term, not a wildcard
+        :param tf_in_query: The number of times the term is in the query
+        field
+        """
+        raise NotImplementedError
+
+    def idf(self, field, term, postings):
+        """Returns the idf of a query term. Terms outside the dictionary, such
+        as expanded wildcards, get theirs from their document frequency.
+
+        :param field: The field the term is matched against
+        :param term: The query term
+        :param postings: The postings of the term
+        """
+        if term in self.dictionary[field]:
+            return self.dictionary[field][term][IDF_INDEX]
+        return log10(float(len(self.docs_metadata))
+                     / self.document_frequency(field, term, postings))
+
+    def document_frequency(self, field, term, postings):
+        """Returns the document frequency of a query term, recovered from its
+        idf, which unlike its postings is never statically pruned. Wildcard
+        terms get the estimate in wildcard_dfs, other terms outside the
+        dictionary count their postings.
+
+        :param field: The field the term is matched against
+        :param term: The query term
+        :param postings: The postings of the term
+        """
+        if term in self.dictionary[field]:
+            idf = self.dictionary[field][term][IDF_INDEX]
+            return int(round(len(self.docs_metadata) / 10 ** idf))
+        return self.wildcard_dfs.get((field, term), len(postings))
+
+    def combine(self, field_scores):
+        """Combines per-field scores of documents with the field weights.
+
+        :param field_scores: Mapping of field to dictionary of docID to score
+        :return: Dictionary mapping from every document ID to its score.
+        """
+        doc_scores = {}
+        for docID in self.docs_metadata:
+            doc_scores[docID] = \
+                (field_scores["Title"].get(docID, 0)
+                 * FIELD_WEIGHTS["Title"]) \
+                + (field_scores["Abstract"].get(docID, 0)
+                   * FIELD_WEIGHTS["Abstract"])
+        return doc_scores
+
+
+class VectorSpaceScorer(Scorer):
+    """lnc.ltc cosine similarity, scored separately for each field. A single
+    term query is scored by the document's lnc weight alone."""
+
+    def score(self, field_terms, field_postings):
+        field_scores = {}
+        for field in FIELDS:
+            terms = field_terms[field]
+            single_term_query = len(terms) == 1
+            scores = {}
+            for term in terms:
+                self.update_relevance(scores, field_postings[field][term],
+                                      terms, term, single_term_query, field)
+            for docID in scores:
+                scores[docID] /= \
+                    self.docs_metadata[docID][VECTOR_LENGTH_INDEX[field]]
+            field_scores[field] = scores
+        return self.combine(field_scores)
+
+    def term_bound(self, field, term, tf_in_query):
+        """The lnc.ltc weight of the term in the query times its largest
+        cosine normalized weight in any document, scaled by the weight of
+        its field, and added once for every time the term is in the query.
+        Dictionary files written without the largest weights bound these
+        by 1."""
+        if term not in self.dictionary[field]:
+            return 0.0
+        entry = self.dictionary[field][term]
+        max_weight = entry[MAX_WEIGHT_INDEX] \
+            if len(entry) > MAX_WEIGHT_INDEX else 1.0
+        return FIELD_WEIGHTS[field] * tf_in_query \
+            * (1 + log10(tf_in_query)) * entry[IDF_INDEX] * max_weight
+
+    def update_relevance(self, doc_scores, postings, query_terms, term,
+                         single_term_query, field):
+        """Accumulates the contribution of one query term to the scores of the
+        documents in its postings.
+
+        :param doc_scores: Dictionary of docID to score, updated in place
+        :param postings: The postings of the term
+        :param query_terms: All normalized query terms of the field
+        :param term: The query term
+        :param single_term_query: Whether the query only has one term
+        :param field: The field the term is matched against
+        """
+        if not postings:
+            return
+        tf_in_query = query_terms.count(term)
+        term_idf = self.idf(field, term, postings)
+        weight_of_term_in_query = 1 \
+            if single_term_query \
+            else (1 + log10(tf_in_query)) * term_idf
+        for docID, weight_of_term_in_doc, tf in postings:
+            if docID not in doc_scores:
+                doc_scores[docID] = 0
+            doc_scores[docID] += weight_of_term_in_doc \
+                if single_term_query \
+                else weight_of_term_in_doc * weight_of_term_in_query
+
+
+class BM25Scorer(Scorer):
+    """Okapi BM25, scored separately for each field with that field's lengths
+    in tokens and average length."""
+
+    needs_statistics = True
+
+    def score(self, field_terms, field_postings):
+        big_N = self.statistics["doc_count"]
+        field_scores = {}
+        for field in FIELDS:
+            average_length = self.statistics["average_lengths"][field]
+            length_index = TOKEN_LENGTH_INDEX[field]
+            scores = defaultdict(float)
+            for term, tf_in_query in Counter(field_terms[field]).iteritems():
+                postings = field_postings[field][term]
+                term_idf = bm25_idf(
+                    self.document_frequency(field, term, postings), big_N)
+                for docID, weight, tf in postings:
+                    length = self.docs_metadata[docID][length_index]
+                    normalization = K1 * (1 - B + B * length / average_length)
+                    scores[docID] += tf_in_query * term_idf \
+                        * tf * (K1 + 1) / (tf + normalization)
+            field_scores[field] = scores
+        return self.combine(field_scores)
+
+    def term_bound(self, field, term, tf_in_query):
+        """The saturated tf of a term stays below K1 + 1, whatever the tf and
+        length of the field."""
+        if term not in self.dictionary[field]:
+            return 0.0
+        df = self.document_frequency(field, term, ())
+        return FIELD_WEIGHTS[field] * tf_in_query \
+            * bm25_idf(df, self.statistics["doc_count"]) * (K1 + 1)
+
+
+class BM25FScorer(Scorer):
+    """BM25F: the tf of each query term is length normalized and boosted per
+    field, summed over the title and abstract, and then saturated once. All
+    query terms, from both the query title and description, are matched
+    against both fields."""
+
+    # The idf of a term counts the documents of all its postings
+    restrictable = False
+    needs_statistics = True
+
+    def required_terms(self, field_terms):
+        all_terms = set()
+        for terms in field_terms.itervalues():
+            all_terms.update(terms)
+        return dict((field, all_terms) for field in FIELDS)
+
+    def score(self, field_terms, field_postings):
+        big_N = self.statistics["doc_count"]
+        query_terms = Counter()
+        for terms in field_terms.itervalues():
+            query_terms.update(terms)
+        doc_scores = dict((docID, 0) for docID in self.docs_metadata)
+        for term, tf_in_query in query_terms.iteritems():
+            pseudo_tfs = defaultdict(float)
+            for field in FIELDS:
+                average_length = self.statistics["average_lengths"][field]
+                length_index = TOKEN_LENGTH_INDEX[field]
+                b = BM25F_B[field]
+                for docID, weight, tf in field_postings[field][term]:
+                    length = self.docs_metadata[docID][length_index]
+                    pseudo_tfs[docID] += BM25F_BOOSTS[field] * tf \
+                        / (1 - b + b * length / average_length)
+            term_idf = bm25_idf(
+                self.any_field_frequency(term, field_postings, pseudo_tfs),
+                big_N)
+            for docID, pseudo_tf in pseudo_tfs.iteritems():
+                doc_scores[docID] += tf_in_query * term_idf \
+                    * pseudo_tf * (K1 + 1) / (pseudo_tf + K1)
+        return doc_scores
+
+    def term_bound(self, field, term, tf_in_query):
+        """The saturated pseudo tf of a term stays below K1 + 1, and the term
+        is matched against both fields, whichever field of the query it is
+        in. Without the stored document frequency in either field, the
+        largest one of a single field, which is not larger, bounds the
+        idf."""
+        dfs = [self.document_frequency(other_field, term, ())
+               for other_field in FIELDS
+               if term in self.dictionary[other_field]]
+        if not dfs:
+            return 0.0
+        df = self.stored_frequency(term) or max(dfs)
+        return tf_in_query * bm25_idf(df, self.statistics["doc_count"]) \
+            * (K1 + 1)
+
+    def stored_frequency(self, term):
+        """Returns the number of documents containing a query term in any
+        field, as stored by index.py, or None if the dictionary file was
+        written without it.
+
+        :param term: The query term
+        """
+        for field in FIELDS:
+            entry = self.dictionary[field].get(term)
+            if entry is not None and len(entry) > ANY_FIELD_DF_INDEX:
+                return entry[ANY_FIELD_DF_INDEX]
+        return None
+
+    def any_field_frequency(self, term, field_postings, pseudo_tfs):
+        """Returns the number of documents containing a query term in any
+        field, as stored by index.py. Dictionary files written without it,
+        and wildcard terms, fall back to the largest document frequency of
+        the term in one field, or to the number of documents its postings
+        cover, if that is larger.
+
+        :param term: The query term
+        :param field_postings: Mapping of field to term to its postings
+        :param pseudo_tfs: Dictionary of the docIDs the postings of the term
+        cover, in any field
+        """
+        stored = self.stored_frequency(term)
+        if stored is not None:
+            return stored
+        return max([len(pseudo_tfs)] +
+                   [self.document_frequency(field, term,
+                                            field_postings[field][term])
+                    for field in FIELDS if field_postings[field][term]])
+
+
+def bm25_idf(df, big_N):
+    """Calculates the BM25 idf of a term, log(1 + (N - df + 0.5)/(df + 0.5)),
+    which unlike the classic Robertson-Sparck Jones idf is never negative.
+
+    :param df: The document frequency of the term
+    :param big_N: The total number of documents
+    """
+    return log(1 + (big_N - df + 0.5) / (df + 0.5))
+
+
+# Scoring models selectable by name from the search.py command line
+SCORERS = {"vsm": VectorSpaceScorer,
+           "bm25": BM25Scorer,
+           "bm25f": BM25FScorer}
+
+
+class TestScorers(unittest.TestCase):
+    """Test case ensuring scoring models rank documents as expected"""
+
+    def setUp(self):
+        """Builds a tiny index in memory, in the format loaded by search.py."""
+        self.docs_metadata = {"a.xml": (1.0, 1.3, "D06", 0, 1, 3),
+                              "b.xml": (1.0, 1.0, "F16", 1, 1, 1),
+                              "c.xml": (0.0, 1.0, "D06", 2, 0, 1)}
+        self.dictionary = {"Title": {"washer": (0, 0, log10(3.0)),
+                                     "pump": (0, 0, log10(3.0))},
+                           "Abstract": {"foam": (0, 0, log10(1.5)),
+                                        "valv": (0, 0, log10(3.0))}}
+        self.statistics = {"doc_count": 3,
+                           "average_lengths": {"Title": 2.0 / 3,
+                                               "Abstract": 5.0 / 3}}
+        self.field_postings = {
+            "Title": {"washer": [["a.xml", 1.0, 1]],
+                      "pump": [["b.xml", 1.0, 1]],
+                      "foam": [], "valv": []},
+            "Abstract": {"foam": [["a.xml", 1.301029996, 2],
+                                  ["c.xml", 1.0, 1]],
+                         "valv": [["b.xml", 1.0, 1]],
+                         "washer": [], "pump": []}}
+
+    def score(self, model, field_terms):
+        scorer = SCORERS[model](self.docs_metadata, self.dictionary,
+                                self.statistics)
+        required = scorer.required_terms(field_terms)
+        field_postings = dict((field, dict((term,
+                                            self.field_postings[field][term])
+                                           for term in terms))
+                              for field, terms in required.iteritems())
+        return scorer.score(field_terms, field_postings)
+
+    def rank(self, model, field_terms):
+        doc_scores = self.score(model, field_terms)
+        return sorted(doc_scores, key=lambda docID: doc_scores[docID],
+                      reverse=True)
+
+    def test_models_rank_best_match_first(self):
+        """Ensures every model ranks the document matching the query title and
+        description first."""
+        field_terms = {"Title": ["washer"], "Abstract": ["foam"]}
+        for model in SCORERS:
+            self.assertEqual(self.rank(model, field_terms)[0], "a.xml")
+
+    def test_bm25f_document_frequency_ignores_pruning(self):
+        """Ensures the BM25F document frequency is the stored one, not the
+        number of postings left after static pruning."""
+        scorer = SCORERS["bm25f"](self.docs_metadata, self.dictionary,
+                                  self.statistics)
+        pruned = {"Title": {"washer": [["a.xml", 1.0, 1]]},
+                  "Abstract": {"washer": []}}
+        # Recovered from the idf of the title, log10(3 / 1)
+        self.assertEqual(scorer.any_field_frequency("washer", pruned,
+                                                    {"a.xml": 1.0}), 1)
+        self.dictionary["Title"]["washer"] += (1.0, 3)
+        self.assertEqual(scorer.any_field_frequency("washer", pruned,
+                                                    {"a.xml": 1.0}), 3)
+
+    def test_term_bounds_cover_contributions(self):
+        """Ensures no document scores above the bound of a query term, for
+        every model, with and without the largest weights stored."""
+        for max_weights in (False, True):
+            if max_weights:
+                # The largest cosine normalized lnc weight of each term
+                for field, terms in self.dictionary.iteritems():
+                    for term in terms:
+                        terms[term] += (max(
+                            weight / self.docs_metadata[docID][
+                                VECTOR_LENGTH_INDEX[field]]
+                            for docID, weight, tf
+                            in self.field_postings[field][term]),)
+            for model in SCORERS:
+                scorer = SCORERS[model](self.docs_metadata, self.dictionary,
+                                        self.statistics)
+                for field in FIELDS:
+                    for term in self.dictionary[field]:
+                        # Twice, as a single term query is scored by its
+                        # document weights alone
+                        field_terms = {"Title": [], "Abstract": []}
+                        field_terms[field] = [term, term]
+                        scores = self.score(model, field_terms)
+                        # The vector lengths of the tiny index are rounded
+                        self.assertTrue(max(scores.values()) <=
+                                        scorer.term_bound(field, term, 2)
+                                        * 1.001, (model, field, term))
+                self.assertEqual(scorer.term_bound("Title", "impel", 1), 0.0)
+
+    def test_reduce_query(self):
+        """Ensures query reduction keeps the terms of largest bound, in query
+        order, within the budget, and always keeps wildcard terms."""
+        # Imported here, as search.py imports this module
+        from search import reduce_query
+        scorer = VectorSpaceScorer(self.docs_metadata, self.dictionary,
+                                   self.statistics)
+        # Bounds: valv 0.45, foam 0.17, washer and pump 0.02 each
+        field_terms = {"Title": ["pump", "was*", "washer"],
+                       "Abstract": ["foam", "valv", "impel"]}
+        self.assertEqual(reduce_query(field_terms, scorer), field_terms)
+        self.assertEqual(reduce_query(field_terms, scorer, max_terms=1),
+                         {"Title": ["was*"], "Abstract": ["valv"]})
+        self.assertEqual(reduce_query(field_terms, scorer, max_terms=3),
+                         {"Title": ["was*", "washer"],
+                          "Abstract": ["foam", "valv"]})
+        # valv alone is 0.68 of the bounds
+        self.assertEqual(reduce_query(field_terms, scorer, score_mass=0.6),
+                         {"Title": ["was*"], "Abstract": ["valv"]})
+        self.assertEqual(reduce_query(field_terms, scorer, max_terms=1,
+                                      score_mass=0.9),
+                         {"Title": ["was*"], "Abstract": ["valv"]})
+        # BM25F matches title terms against abstracts too: foam, in more
+        # documents, is the one dropped
+        scorer = BM25FScorer(self.docs_metadata, self.dictionary,
+                             self.statistics)
+        self.assertEqual(reduce_query(field_terms, scorer, max_terms=3),
+                         {"Title": ["pump", "was*", "washer"],
+                          "Abstract": ["valv"]})
+
+    def test_bm25f_matches_terms_across_fields(self):
+        """Ensures BM25F matches query description terms against titles."""
+        field_terms = {"Title": [], "Abstract": ["pump"]}
+        self.assertEqual(self.rank("bm25f", field_terms)[0], "b.xml")
+
+
+if __name__ == '__main__':
+    unittest.main()
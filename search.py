@@ -1,62 +1,553 @@
-import nltk
+import time
+# Taken before any other import, so that cold-start time covers module loading
+start_time = time.time() * 1000.0
 import sys
+import atexit
 import getopt
 import json
-import time
 import math
+import re
 import string
+from bisect import bisect_left, bisect_right
+from collections import Counter, namedtuple
+from fnmatch import fnmatchcase
+from heapq import merge, nlargest
+from itertools import chain, groupby, islice
+from operator import itemgetter
 from information_need import InformationNeed
+from scoring import FIELDS, IDF_INDEX, LENGTH_INDEX, ORDINAL_INDEX, \
+    POINTER_INDEX, SCORERS
+from tokenizer import tokenize
+from wildcard import WILDCARD_SUFFIX, WildcardIndex, is_wildcard
+from docstore import DOC_STORE_SUFFIX, DocumentStore, has_document_store
+from forward import FORWARD_SUFFIX, ForwardIndex, has_forward_index
+from skips import split_skip_table
+from lib.porter import PorterStemmer
+import versions
 
 show_time = False
 LANG = "english"
+# Dictionary files start with a header line giving their format and
+# whether they hold the collection statistics; files written before the
+# header, format 1, start straight with their contents. Format 3 adds the
+# ordinal of every document to its metadata.
+DICTIONARY_FORMAT = 3
+# Only used for words missing from the stem table
+FALLBACK_STEMMER = PorterStemmer()
+# The contents of a dictionary file; statistics is None for dictionary files
+# written without them, the wildcard index is only read once a query uses a
+# wildcard and the forward index once a query uses feedback
+Index = namedtuple("Index", ["docs_metadata", "dictionary", "stopwords",
+                             "stems", "statistics", "wildcard_index",
+                             "forward_index"])
 
-k = 10  # number of results to return
+EXPANSION_DOCS = 20  # number of top documents whose IPC classes are added
+# Postings ranges at most this many bytes apart are fetched in one read
+COALESCE_GAP = 32 * 1024
+MAX_READ = 4 * 1024 * 1024  # bytes beyond which ranges are not coalesced
+SNIPPET_WORDS = 30  # words of the abstract shown per result
+# Pseudo-relevance feedback: the terms with the highest weights in the
+# centroid of the top documents are added to the query, with their scores
+# scaled down by the feedback weight
+FEEDBACK_DOCS = 10
+FEEDBACK_TERMS = 10  # terms added per field
+FEEDBACK_WEIGHT = 0.5
+WORD_PATTERN = re.compile(r"\w+", re.UNICODE)
+# Query words prefixed with "+", such as "+pump" or "+hydro*", are required
+REQUIRED_PATTERN = re.compile(r"(?<!\S)\+([\w*]+)", re.UNICODE)
 
 
-def docIDs_decreasing_score(doc_scores):
+def docIDs_decreasing_score(doc_scores, count=None):
     """Returns the list of docIDs, sorted by descending document scores. The
     docIDs are also converted to strings here.
 
     :param doc_scores: A dictionary of docID to its corresponding document's
     score.
+    :param count: If given, only the count highest-scoring docIDs are
+    returned, selected with a heap of that size instead of a full sort.
     :return: List of str(docIDs) sorted by descending document scores.
     """
-    sorted_scores = sorted(doc_scores.iteritems(),
-                           key=lambda score_entry: score_entry[1],
-                           reverse=True)
+    if count is None:
+        sorted_scores = sorted(doc_scores.iteritems(),
+                               key=lambda score_entry: score_entry[1],
+                               reverse=True)
+    else:
+        sorted_scores = nlargest(count, doc_scores.iteritems(),
+                                 key=lambda score_entry: score_entry[1])
     return [str(docID) for docID, score in sorted_scores]
 
 
-def expand_query(sorted_docIDs, doc_scores, docs_metadata):
+def expand_query(sorted_docIDs, doc_scores, docs_metadata, limit=None):
     """Expands the query by retrieving the IPC classes of high-scoring
     documents, then adds all documents under the same IPC class to the result.
 
     :param sorted_docIDs: The list of all document IDs with nonzero tf-idf
-    score against the query, sorted in descending score.
+    score against the query, sorted in descending score. Only the first
+    EXPANSION_DOCS are used.
     :param doc_scores: Dictionary mapping from document ID to tf-idf score.
     :param docs_metadata: Dictionary of document metadata, including IPC classes
+    :param limit: If given, only the limit highest-scoring documents of the
+    IPC classes are kept, in a heap of that size, while streaming through the
+    documents.
+    :return: Generator of docIDs in descending score.
     """
-    top_20_docIDs = sorted_docIDs[:20]
-    top_20_IPCs = set([docs_metadata[docID][2] for docID in top_20_docIDs])
-    docs_in_IPCs = [docID for docID, doc_metadata in docs_metadata.iteritems()
-                    if doc_metadata[2] in top_20_IPCs]
-    docs_IPCs_scores = [(docID, doc_scores[docID])
+    top_docIDs = sorted_docIDs[:EXPANSION_DOCS]
+    top_IPCs = set([docs_metadata[docID][2] for docID in top_docIDs])
+    docs_in_IPCs = (docID for docID, doc_metadata in docs_metadata.iteritems()
+                    if doc_metadata[2] in top_IPCs)
+    docs_IPCs_scores = ((docID, doc_scores[docID])
                         if docID in doc_scores
-                        else (docID, float(0)) for docID in docs_in_IPCs]
-    sorted_docs_IPCs_scores = sorted(docs_IPCs_scores,
-                                     key=lambda score_entry: score_entry[1],
-                                     reverse=True)
-    sorted_docs = [docID for docID, doc_score in sorted_docs_IPCs_scores]
-    return sorted_docs
+                        else (docID, float(0)) for docID in docs_in_IPCs)
+    if limit is None:
+        sorted_docs_IPCs_scores = sorted(docs_IPCs_scores,
+                                         key=lambda score_entry:
+                                         score_entry[1],
+                                         reverse=True)
+    else:
+        sorted_docs_IPCs_scores = nlargest(limit, docs_IPCs_scores,
+                                           key=lambda score_entry:
+                                           score_entry[1])
+    for docID, doc_score in sorted_docs_IPCs_scores:
+        yield docID
 
 
-def process_queries(dictionary_file, postings_file, query_file, output_file):
-    # load dictionary
-    begin = time.time() * 1000.0
+def write_results(output, docIDs):
+    """Streams docIDs to the output file as one space separated line, without
+    joining them into one string first.
+
+    :param output: The output file object, opened for writing
+    :param docIDs: Iterable of docIDs in ranked order
+    """
+    separator = ""
+    for docID in docIDs:
+        # Remove .xml file extension
+        output.write(separator + docID[:-4])
+        separator = " "
+    output.write("\n")
+
+
+def snippet(text, query_terms, stems, width=SNIPPET_WORDS):
+    """Returns the window of width words of a text with the most query term
+    matches, with the matching words in brackets.
+
+    :param text: The text, e.g. the abstract of a document
+    :param query_terms: Set of normalized query terms, possibly wildcards
+    :param stems: Mapping of surface form to stem built by index.py.
+    :param width: The number of words in the snippet
+    """
+    words = list(WORD_PATTERN.finditer(text))
+    wildcards = [term for term in query_terms if is_wildcard(term)]
+    hits = []
+    for position, word in enumerate(words):
+        # Words missing from the stem table are not indexed, so they are
+        # not stemmed for nothing
+        term = stems.get(word.group().lower())
+        if term is not None and (term in query_terms or
+                                 any(fnmatchcase(term, pattern)
+                                     for pattern in wildcards)):
+            hits.append(position)
+    start = 0
+    best_hits = 0
+    for first, position in enumerate(hits):
+        window_hits = bisect_left(hits, position + width) - first
+        if window_hits > best_hits:
+            start, best_hits = position, window_hits
+    end = min(start + width, len(words))
+    if start >= end:
+        return u""
+    hit_set = set(hits)
+    pieces = [u"..." if start > 0 else u""]
+    previous_end = words[start].start()
+    for position in xrange(start, end):
+        word = words[position]
+        pieces.append(text[previous_end:word.start()])
+        pieces.append(u"[%s]" % word.group() if position in hit_set
+                      else word.group())
+        previous_end = word.end()
+    pieces.append(u"..." if end < len(words) else u"")
+    return u"".join(pieces)
+
+
+def print_snippets(docIDs, doc_store, docs_metadata, query_terms, stems):
+    """Prints the title, IPC class, publication date and abstract snippet of
+    results from the document store.
+
+    :param docIDs: List of docIDs in ranked order
+    :param doc_store: The DocumentStore of the index
+    :param docs_metadata: Dictionary of document metadata, including the
+    ordinals of the documents
+    :param query_terms: Set of normalized query terms
+    :param stems: Mapping of surface form to stem built by index.py.
+    """
+    for rank, docID in enumerate(docIDs, 1):
+        doc = doc_store.get(docs_metadata[docID][ORDINAL_INDEX])
+        line = u"%d. %s %s (%s, %s)\n   %s" % (
+            rank, docID[:-4], doc["Title"], doc["IPC Class"],
+            doc["Publication Date"],
+            snippet(doc["Abstract"], query_terms, stems))
+        print line.encode("utf-8")
+
+
+def collapse_families(sorted_docIDs, docs_metadata):
+    """Collapses a ranked list of documents to the best-ranked document of each
+    patent family, while streaming through it. Only the family IDs already
+    seen are kept in memory. Documents from a dictionary file written without
+    family IDs are treated as their own family.
+
+    :param sorted_docIDs: Iterable of docIDs sorted in descending score.
+    :param docs_metadata: Dictionary of document metadata, including family IDs
+    :return: Generator of the docIDs of the best-ranked member of each family.
+    """
+    seen_families = set()
+    for docID in sorted_docIDs:
+        doc_metadata = docs_metadata[docID]
+        # [3] is family ID
+        family = doc_metadata[3] if len(doc_metadata) > 3 else docID
+        if family not in seen_families:
+            seen_families.add(family)
+            yield docID
+
+
+def duplicate_group(docID, docs_metadata):
+    """Returns the near-duplicate group ID of a document. Documents from a
+    dictionary file written without group IDs are their own group.
+
+    :param docID: The docID of the document
+    :param docs_metadata: Dictionary of document metadata
+    """
+    doc_metadata = docs_metadata[docID]
+    # [6] is near-duplicate group ID
+    return doc_metadata[6] if len(doc_metadata) > 6 else docID
+
+
+def suppress_duplicates(sorted_docIDs, docs_metadata):
+    """Suppresses the near-duplicates of better-ranked documents from a ranked
+    list, while streaming through it.
+
+    :param sorted_docIDs: Iterable of docIDs sorted in descending score.
+    :param docs_metadata: Dictionary of document metadata
+    :return: Generator of the docIDs of the best-ranked member of each
+    near-duplicate group.
+    """
+    seen_groups = set()
+    for docID in sorted_docIDs:
+        group = duplicate_group(docID, docs_metadata)
+        if group not in seen_groups:
+            seen_groups.add(group)
+            yield docID
+
+
+def group_duplicates(sorted_docIDs, docs_metadata):
+    """Moves the near-duplicates in a ranked list right after the best-ranked
+    member of their group.
+
+    :param sorted_docIDs: Iterable of docIDs sorted in descending score.
+    :param docs_metadata: Dictionary of document metadata
+    :return: Generator of docIDs, each near-duplicate group in one run.
+    """
+    groups = {}
+    group_order = []
+    for docID in sorted_docIDs:
+        group = duplicate_group(docID, docs_metadata)
+        if group not in groups:
+            groups[group] = []
+            group_order.append(group)
+        groups[group].append(docID)
+    for group in group_order:
+        for docID in groups[group]:
+            yield docID
+
+
+def load_dictionary(dictionary_file):
+    """Loads the dictionary file written by index.py.
+
+    :param dictionary_file: The file path of the dictionary file
+    :return: The Index of the dictionary file.
+    """
     with open(dictionary_file) as dict_file:
+        read_dictionary_header(dict_file)
         temp = json.load(dict_file)
-        docs_metadata = temp[0]
-        dictionary = temp[1]
+    docs_metadata = temp[0]
+    dictionary = temp[1]
+    stopwords, stems = load_normalization(temp)
+    statistics = temp[3] if len(temp) > 3 else None
+    wildcard_index = WildcardIndex(dictionary_file + WILDCARD_SUFFIX,
+                                   dictionary)
+    forward_index = ForwardIndex(dictionary_file + FORWARD_SUFFIX)
+    return Index(docs_metadata, dictionary, stopwords, stems, statistics,
+                 wildcard_index, forward_index)
+
+
+def read_dictionary_header(dict_file):
+    """Reads the header line of a dictionary file, leaving the file at the
+    start of its contents.
+
+    :param dict_file: The dictionary file object, at its start
+    :return: The header as a dictionary; format 1 files get a header saying
+    they hold no statistics, as their header cannot vouch for them.
+    """
+    # The contents are a JSON list, the header a JSON object
+    if dict_file.read(1) != "{":
+        dict_file.seek(0)
+        return {"format": 1, "statistics": False}
+    dict_file.seek(0)
+    return json.loads(dict_file.readline())
+
+
+def has_statistics(dictionary_file):
+    """Checks whether a dictionary file holds the collection statistics,
+    reading only its header.
+
+    :param dictionary_file: The file path of the dictionary file
+    """
+    with open(dictionary_file) as dict_file:
+        return read_dictionary_header(dict_file)["statistics"]
+
+
+def check_model(model, statistics_stored):
+    """Checks that a scoring model can score the documents of an index.
+
+    :param model: The name of the scoring model
+    :param statistics_stored: Whether the dictionary file of the index holds
+    the collection statistics, see has_statistics
+    :return: None, or the reason why the model cannot be used.
+    """
+    if model not in SCORERS:
+        return "unknown scoring model " + model
+    if SCORERS[model].needs_statistics and not statistics_stored:
+        return "scoring model %s needs an index built with collection " \
+               "statistics, rebuild it with index.py" % model
+    return None
+
+
+def score_query(scorer, index, postings, title_terms, description_terms,
+                matches=None):
+    """Reads the postings the scorer needs, then scores every document
+    against the query. The query title is matched against patent titles, and
+    the description against patent abstracts.
+
+    :param scorer: The scoring model, a scoring.Scorer
+    :param index: The Index returned by load_dictionary
+    :param postings: File object of the postings file
+    :param title_terms: Normalized query title terms
+    :param description_terms: Normalized query description terms
+    :param matches: Sorted list of the docIDs matching the required terms of
+    the query, the only ones scored, or None to score every document
+    :return: Dictionary mapping from document ID to score.
+    """
+    field_terms = {"Title": title_terms, "Abstract": description_terms}
+    field_postings = read_field_postings(
+        scorer.required_terms(field_terms), index, postings,
+        matches if scorer.restrictable else None, scorer.wildcard_dfs)
+    doc_scores = scorer.score(field_terms, field_postings)
+    if matches is None:
+        return doc_scores
+    return dict((docID, doc_scores.get(docID, 0)) for docID in matches)
+
+
+def reduce_query(field_terms, scorer, max_terms=None, score_mass=None):
+    """Query reduction: ranks the distinct terms of a query by the bound of
+    their contribution under the scoring model, and keeps the best ones until
+    max_terms are kept, or until their bounds add up to the score_mass
+    fraction of the bounds of all terms, whichever comes first. Wildcard
+    terms have no bound and are always kept.
+
+    :param field_terms: Mapping of field to the normalized query terms
+    :param scorer: The Scorer of the scoring model
+    :param max_terms: The maximum number of terms kept, or None
+    :param score_mass: The fraction of the total bound kept, or None
+    :return: Mapping of field to the normalized query terms kept, in query
+    order.
+    """
+    bounds = sorted(((scorer.term_bound(field, term, tf_in_query),
+                      field, term)
+                     for field, terms in field_terms.iteritems()
+                     for term, tf_in_query in Counter(terms).iteritems()
+                     if not is_wildcard(term)),
+                    reverse=True)
+    total_bound = sum(bound for bound, field, term in bounds)
+    kept = set()
+    kept_bound = 0.0
+    for bound, field, term in bounds:
+        if max_terms is not None and len(kept) >= max_terms:
+            break
+        if score_mass is not None and kept_bound >= score_mass * total_bound:
+            break
+        kept.add((field, term))
+        kept_bound += bound
+    return dict((field, [term for term in terms
+                         if is_wildcard(term) or (field, term) in kept])
+                for field, terms in field_terms.iteritems())
+
+
+def rank_results(doc_scores, docs_metadata, collapse=False, limit=None,
+                 duplicates=None):
+    """Ranks documents by score, expands the ranking with the IPC classes of
+    the top documents, and optionally collapses patent families, suppresses
+    or groups near-duplicates and limits the number of results.
+
+    :param doc_scores: Dictionary mapping from document ID to score.
+    :param docs_metadata: Dictionary of document metadata
+    :param collapse: Whether to keep only the best member of each family
+    :param limit: The maximum number of results, or None for no limit
+    :param duplicates: "suppress" to keep only the best member of each
+    near-duplicate group, "group" to move near-duplicates right after it, or
+    None to leave them
+    :return: Iterable of docIDs in ranked order.
+    """
+    results = docIDs_decreasing_score(doc_scores, EXPANSION_DOCS)
+    # Collapsing families and near-duplicates drops or moves documents, so
+    # the limit can only bound the expansion heap when they are kept.
+    reordered = collapse or duplicates is not None
+    expanded_results = expand_query(results, doc_scores, docs_metadata,
+                                    None if reordered else limit)
+    if collapse:
+        expanded_results = collapse_families(expanded_results, docs_metadata)
+    if duplicates == "suppress":
+        expanded_results = suppress_duplicates(expanded_results,
+                                               docs_metadata)
+    elif duplicates == "group":
+        expanded_results = group_duplicates(expanded_results, docs_metadata)
+    if reordered and limit is not None:
+        expanded_results = islice(expanded_results, limit)
+    return expanded_results
+
+
+def feedback_terms(doc_scores, field_terms, forward_index, dictionary,
+                   docs_metadata):
+    """Rocchio-style pseudo-relevance feedback: picks the terms with the
+    highest weights in the centroid of the vectors of the top scored
+    documents, read from the forward index, which are not query terms yet.
+    The forward index stores lnc weights, so the centroid weights are
+    multiplied by the idf of their terms, for discriminative terms to win
+    over the frequent ones every document shares.
+
+    :param doc_scores: Dictionary mapping from document ID to score.
+    :param field_terms: Mapping of field to the normalized query terms
+    :param forward_index: The ForwardIndex of the index
+    :param dictionary: Dictionary of field to term to postings pointer
+    :param docs_metadata: Dictionary of document metadata, including the
+    ordinals of the documents
+    :return: Mapping of field to the list of feedback terms.
+    """
+    top_docIDs = nlargest(FEEDBACK_DOCS, doc_scores, key=doc_scores.get)
+    centroid = {"Title": Counter(), "Abstract": Counter()}
+    for docID in top_docIDs:
+        ordinal = docs_metadata[docID][ORDINAL_INDEX]
+        for field, term, weight in forward_index.vector(ordinal):
+            if term in dictionary[field]:
+                centroid[field][term] += weight \
+                    * dictionary[field][term][IDF_INDEX] / len(top_docIDs)
+    return dict((field,
+                 [term for term, weight in nlargest(
+                     FEEDBACK_TERMS,
+                     ((term, weight) for term, weight
+                      in centroid[field].iteritems()
+                      if term not in field_terms[field]),
+                     key=itemgetter(1))])
+                for field in centroid)
+
+
+def pseudo_relevance_feedback(scorer, index, postings, doc_scores,
+                              title_terms, description_terms, matches=None):
+    """Scores documents against the feedback terms of the first pass, and
+    adds these scores, scaled by FEEDBACK_WEIGHT, to those of the first pass.
+
+    :param scorer: The scoring model, a scoring.Scorer
+    :param index: The Index returned by load_dictionary
+    :param postings: File object of the postings file
+    :param doc_scores: Dictionary mapping from document ID to its first pass
+    score.
+    :param title_terms: Normalized query title terms
+    :param description_terms: Normalized query description terms
+    :param matches: Sorted list of the docIDs matching the required terms of
+    the query, or None
+    :return: Dictionary mapping from document ID to score.
+    """
+    expansion = feedback_terms(doc_scores, {"Title": title_terms,
+                                            "Abstract": description_terms},
+                               index.forward_index, index.dictionary,
+                               index.docs_metadata)
+    if not expansion["Title"] and not expansion["Abstract"]:
+        return doc_scores
+    feedback_scores = score_query(scorer, index, postings,
+                                  expansion["Title"], expansion["Abstract"],
+                                  matches)
+    # Documents matching only feedback terms are retrieved as well
+    doc_scores = dict(doc_scores)
+    for docID, score in feedback_scores.iteritems():
+        doc_scores[docID] = doc_scores.get(docID, 0) + FEEDBACK_WEIGHT * score
+    return doc_scores
+
+
+def run_query(index, postings, query_title, query_description, model="vsm",
+              collapse=False, limit=None, feedback=False,
+              conjunctive=False, duplicates=None, max_terms=None,
+              score_mass=None):
+    """Runs the whole search pipeline for one query: normalization, reading
+    postings, scoring and ranking. Only documents containing every required
+    term, in their title or abstract, are ranked.
+
+    :param index: The Index returned by load_dictionary
+    :param postings: File object of the postings file
+    :param query_title: The title of the information need
+    :param query_description: The description of the information need
+    :param model: The name of the scoring model, a key of scoring.SCORERS
+    :param collapse: Whether to keep only the best member of each family
+    :param limit: The maximum number of results, or None for no limit
+    :param feedback: Whether to re-score with pseudo-relevance feedback
+    :param conjunctive: Whether every term of the query title is required,
+    besides the terms marked with "+"
+    :param duplicates: "suppress" or "group" near-duplicates, or None
+    :param max_terms: The term budget of query reduction, or None
+    :param score_mass: The score mass budget of query reduction, between 0
+    and 1, or None
+    :return: Iterable of docIDs in ranked order.
+    """
+    title_terms = normalize(query_title, index.stopwords, index.stems)
+    description_terms = normalize(query_description, index.stopwords,
+                                  index.stems)
+    required = required_query_terms(query_title + " " + query_description,
+                                    index.stopwords, index.stems)
+    if conjunctive:
+        required += title_terms
+    scorer = SCORERS[model](index.docs_metadata, index.dictionary,
+                            index.statistics)
+    if max_terms is not None or score_mass is not None:
+        reduced = reduce_query({"Title": title_terms,
+                                "Abstract": description_terms},
+                               scorer, max_terms, score_mass)
+        title_terms = reduced["Title"]
+        description_terms = reduced["Abstract"]
+    matches = None
+    docs_metadata = index.docs_metadata
+    if required:
+        matches = conjunctive_matches(required, index, postings)
+        # Only matching documents are added by the IPC class expansion
+        docs_metadata = dict((docID, docs_metadata[docID])
+                             for docID in matches)
+    doc_scores = score_query(scorer, index, postings, title_terms,
+                             description_terms, matches)
+    if feedback:
+        begin = time.time() * 1000.0
+        doc_scores = pseudo_relevance_feedback(scorer, index, postings,
+                                               doc_scores, title_terms,
+                                               description_terms, matches)
+        if show_time:
+            print "feedback: %.3f ms" % (time.time() * 1000.0 - begin)
+    return rank_results(doc_scores, docs_metadata, collapse, limit,
+                        duplicates)
+
+
+def process_queries(dictionary_file, postings_file, query_file, output_file,
+                    collapse=False, lsi_prefix=None, model="vsm",
+                    limit=None, snippets=0, feedback=False,
+                    conjunctive=False, duplicates=None, max_terms=None,
+                    score_mass=None):
+    # load dictionary
+    index = load_dictionary(dictionary_file)
+    stopwords, stems = index.stopwords, index.stems
+    ready = time.time() * 1000.0
 
     # open queries
     postings = file(postings_file)
@@ -68,93 +559,397 @@ def process_queries(dictionary_file, postings_file, query_file, output_file):
     query_title = q["title"]
     query_description = q["description"]
 
-    title_terms = normalize(query_title)
-    description_terms = normalize(query_description)
-
-    single_term_title = len(title_terms) == 1
-    single_term_description = len(description_terms) == 1
-    
-    title_scores = {}
-    for term in title_terms:
-        title_scores = update_relevance(title_scores, dictionary, postings,
-                                        title_terms, term, single_term_title,
-                                        "Title")
-    for docID in title_scores:
-        # [0] is title_length, [1] abstract_length, [2] is IPC
-        title_scores[docID] /= docs_metadata[str(docID)][0]
-
-    description_scores = {}
-    for term in description_terms:
-        description_scores = update_relevance(description_scores, dictionary,
-                                              postings, description_terms,
-                                              term, single_term_description,
-                                              "Abstract")
-    for docID in description_scores:
-        # [0] is title_length, [1] abstract_length, [2] is IPC
-        description_scores[docID] /= docs_metadata[str(docID)][1]
-    doc_scores = {}
-    for docID in docs_metadata:
-        doc_scores[docID] = (title_scores.get(docID, 0) * 0.05) \
-                            + (description_scores.get(docID, 0) * 0.95)
-    
-    results = docIDs_decreasing_score(doc_scores)
-    expanded_results = expand_query(results, doc_scores, docs_metadata)
-
-    # Remove .xml file extension
-    output.write(" ".join([docID[:-4] for docID in expanded_results]))
-    output.write("\n")
+    if lsi_prefix is None:
+        expanded_results = run_query(index, postings, query_title,
+                                     query_description, model, collapse,
+                                     limit, feedback, conjunctive,
+                                     duplicates, max_terms, score_mass)
+    else:
+        # Only loads numpy when the LSI engine is actually used
+        from lsi import LatentSemanticIndex, TOP_K
+        lsi = LatentSemanticIndex(lsi_prefix)
+        title_terms = normalize(query_title, stopwords, stems)
+        description_terms = normalize(query_description, stopwords, stems)
+        doc_scores = dict(lsi.search(title_terms, description_terms, TOP_K))
+        expanded_results = rank_results(doc_scores, index.docs_metadata,
+                                        collapse, limit, duplicates)
+
+    if snippets:
+        shown = list(islice(expanded_results, snippets))
+        expanded_results = chain(shown, expanded_results)
+        doc_store = DocumentStore(dictionary_file + DOC_STORE_SUFFIX)
+        query_terms = set(normalize(query_title, stopwords, stems)
+                          + normalize(query_description, stopwords, stems))
+        print_snippets(shown, doc_store, index.docs_metadata, query_terms,
+                       stems)
+        doc_store.close()
+
+    write_results(output, expanded_results)
 
     postings.close()
     output.close()
     after = time.time() * 1000.0
-    if show_time: print after-begin
+    if show_time:
+        # Cold start covers module imports and loading the dictionary
+        print "cold start: %.3f ms" % (ready - start_time)
+        print "query: %.3f ms" % (after - ready)
+
+
+def load_normalization(dictionary_data):
+    """Loads the stopwords and the surface form to stem table stored in the
+    dictionary file by index.py. Dictionary files written before the tables
+    were stored fall back to nltk's stopwords.
+
+    :param dictionary_data: The list loaded from the dictionary file.
+    :return: Tuple of the set of stopwords and the stem table.
+    """
+    if len(dictionary_data) > 2:
+        normalization = dictionary_data[2]
+        return set(normalization["stopwords"]), normalization["stems"]
+    import nltk
+    return set(nltk.corpus.stopwords.words(LANG)), {}
+
+
+def stem(word, stems):
+    """Looks the stem of a lowercased word up in the stem table. Only words
+    which never appeared in the corpus are stemmed, with the Porter stemmer
+    vendored from nltk, so that queries never import nltk.
+
+    :param word: Lowercased word to stem.
+    :param stems: Mapping of surface form to stem built by index.py.
+    :return: The stem of the word.
+    """
+    if word in stems:
+        return stems[word]
+    return FALLBACK_STEMMER.stem(word)
 
 
-def normalize(query):
+def normalize(query, stopwords, stems):
     """ Tokenize and stem query, also removes punctuations and stopwords.
+    Wildcard terms such as "hydro*" are only lowercased, as they are matched
+    against the stemmed terms of the index.
 
     :param query: Query to tokenize and stem.
+    :param stopwords: Set of stopwords to remove.
+    :param stems: Mapping of surface form to stem built by index.py.
     :return: List of normalized query tokens.
     """
-    query_tokens = nltk.word_tokenize(query)
+    query_tokens = tokenize(query, wildcards=True)
     punctuation_removed = [word for word in query_tokens
                            if word not in string.punctuation]
     stopwords_removed = [token.lower() for token in punctuation_removed
-                         if token.lower()
-                         not in set(nltk.corpus.stopwords.words(LANG))]
-    stemmer = nltk.stem.PorterStemmer()
-    query_terms = map(lambda word : stemmer.stem(word), stopwords_removed)
+                         if token.lower() not in stopwords]
+    query_terms = map(lambda word : word if is_wildcard(word)
+                      else stem(word, stems), stopwords_removed)
     return query_terms
 
 
-def update_relevance(doc_scores, dictionary, postings_file, query_terms,
-                     term, single_term_query, field):
+def required_query_terms(query, stopwords, stems):
+    """Finds the words of a query marked as required with a "+" prefix.
 
-    postings = read_postings(term, dictionary, postings_file, field)
-    
-    for docID_and_tf in postings:
-        docID, tf_in_doc = docID_and_tf
-        tf_in_query = query_terms.count(term)
-        term_idf = dictionary[field][term][2]
+    :param query: Query text.
+    :param stopwords: Set of stopwords to remove.
+    :param stems: Mapping of surface form to stem built by index.py.
+    :return: List of normalized required terms.
+    """
+    return normalize(" ".join(REQUIRED_PATTERN.findall(query)), stopwords,
+                     stems)
 
-        weight_of_term_in_doc = tf_in_doc
-        weight_of_term_in_query = 1 \
-            if single_term_query \
-            else (1 + math.log10(tf_in_query)) * term_idf
 
-        if docID not in doc_scores:
-            doc_scores[docID] = 0
+def tf_from_lnc(weight):
+    """Recovers the raw tf of a posting from its lnc weight 1 + log(tf), for
+    postings files written before the raw tf was stored next to the weight.
 
-        doc_scores[docID] += weight_of_term_in_doc \
-            if single_term_query \
-            else weight_of_term_in_doc * weight_of_term_in_query
+    :param weight: The lnc weight of the posting.
+    """
+    return int(round(10 ** (weight - 1)))
 
-    return doc_scores
+
+def read_field_postings(required_terms, index, postings_file, docIDs=None,
+                        wildcard_dfs=None):
+    """Reads the postings of every term a scorer needs to score a query.
+    Wildcard terms are expanded, and get the union of the postings of the
+    terms they expand to. All postings are fetched up front with
+    fetch_postings_text.
+
+    :param required_terms: Mapping of field to the set of terms to read.
+    :param index: The Index returned by load_dictionary
+    :param postings_file: File object of the postings file
+    :param docIDs: Sorted list of docIDs, looked up through the skip tables,
+    to which the postings of terms other than wildcards are restricted, or
+    None to read all postings
+    :param wildcard_dfs: Dictionary of (field, wildcard term) to its
+    estimated document frequency, see wildcard_frequency, updated in place,
+    or None
+    :return: Mapping of field to term to its postings.
+    """
+    dictionary = index.dictionary
+    field_expansions = {}
+    for field, terms in required_terms.iteritems():
+        field_expansions[field] = dict(
+            (term, index.wildcard_index.expand(term, field)
+             if is_wildcard(term) else [term])
+            for term in terms)
+    fetched = fetch_postings_text(
+        [(field, expansion)
+         for field, expansions in field_expansions.iteritems()
+         for term_expansions in expansions.itervalues()
+         for expansion in term_expansions],
+        dictionary, postings_file)
+    field_postings = {}
+    for field, expansions in field_expansions.iteritems():
+        field_postings[field] = {}
+        for term, term_expansions in expansions.iteritems():
+            if is_wildcard(term):
+                expansion_postings = [parse_postings(fetched[(field,
+                                                              expansion)])
+                                      for expansion in term_expansions]
+                postings = union_postings(expansion_postings)
+                if wildcard_dfs is not None:
+                    wildcard_dfs[(field, term)] = wildcard_frequency(
+                        [dictionary[field][expansion][IDF_INDEX]
+                         for expansion in term_expansions],
+                        expansion_postings, len(postings),
+                        len(index.docs_metadata))
+            elif docIDs is None:
+                postings = parse_postings(fetched[(field, term)])
+            else:
+                postings = SkipPostings(fetched[(field, term)]).select(docIDs)
+            field_postings[field][term] = postings
+    return field_postings
+
+
+def wildcard_frequency(idfs, expansion_postings, union_length, big_N):
+    """Estimates the document frequency of a wildcard term, the number of
+    documents containing any of the terms it expands to. The size of the
+    union of their postings is scaled up by the fraction of their postings
+    which static pruning removed, recovered from their stored idfs. Without
+    pruning, it is the size of the union.
+
+    :param idfs: The stored idfs of the terms the wildcard expands to
+    :param expansion_postings: The postings read for each of these terms
+    :param union_length: The number of postings in the union of these
+    :param big_N: The total number of documents
+    """
+    kept = sum(len(postings) for postings in expansion_postings)
+    if not kept:
+        return union_length
+    stored = sum(int(round(big_N / 10 ** idf)) for idf in idfs)
+    return min(int(round(float(union_length) * stored / kept)), big_N)
+
+
+def plan_postings_reads(field_terms, dictionary):
+    """Plans the reads fetching the postings of many terms: the postings
+    ranges are sorted by file offset, and ranges close enough to each other
+    are coalesced into one sequential read.
+
+    :param field_terms: Iterable of (field, term) pairs
+    :param dictionary: Dictionary of field to term to postings pointer
+    :return: List of reads in file order, each a tuple of the start offset,
+    the end offset, and the list of (field, term, pointer, length) it covers
+    """
+    ranges = sorted((dictionary[field][term][POINTER_INDEX],
+                     dictionary[field][term][LENGTH_INDEX],
+                     field, term)
+                    for field, term in set(field_terms)
+                    if term in dictionary[field])
+    reads = []
+    for pointer, length, field, term in ranges:
+        end = pointer + length
+        if reads and pointer - reads[-1][1] <= COALESCE_GAP \
+                and end - reads[-1][0] <= MAX_READ:
+            start, read_end, covered = reads[-1]
+            reads[-1] = (start, max(read_end, end), covered)
+        else:
+            reads.append((pointer, end, []))
+        reads[-1][2].append((field, term, pointer, length))
+    return reads
+
+
+def fetch_postings_text(field_terms, dictionary, postings_file):
+    """Reads the text of the postings of many terms with the reads planned
+    by plan_postings_reads, instead of one seek per term in query order.
+
+    :param field_terms: Iterable of (field, term) pairs
+    :param dictionary: Dictionary of field to term to postings pointer
+    :param postings_file: File object of the postings file
+    :return: Mapping of (field, term) to the text of its postings list.
+    Terms missing from the dictionary have empty postings.
+    """
+    fetched = dict((field_term, "") for field_term in field_terms)
+    for start, end, covered in plan_postings_reads(fetched, dictionary):
+        postings_file.seek(start)
+        block = postings_file.read(end - start)
+        for field, term, pointer, length in covered:
+            fetched[(field, term)] = \
+                block[pointer - start:pointer - start + length]
+    return fetched
+
+
+def prefetch_postings(field_terms, dictionary, postings_file):
+    """Reads and parses the postings of many terms with
+    fetch_postings_text.
+
+    :param field_terms: Iterable of (field, term) pairs
+    :param dictionary: Dictionary of field to term to postings pointer
+    :param postings_file: File object of the postings file
+    :return: Mapping of (field, term) to its postings. Terms missing from
+    the dictionary have empty postings.
+    """
+    return dict((field_term, parse_postings(postings_text))
+                for field_term, postings_text
+                in fetch_postings_text(field_terms, dictionary,
+                                       postings_file).iteritems())
+
+
+class SkipPostings:
+    """Postings list looked up through its skip table: a block of postings is
+    only parsed once a lookup falls in it."""
+
+    def __init__(self, postings_text):
+        """Reads the skip table of a postings list.
+
+        :param postings_text: The text of the postings list, as written by
+        index.py
+        """
+        self.first_docIDs, self.offsets, self.postings_text = \
+            split_skip_table(postings_text)
+        self.blocks = {}
+
+    def block(self, number):
+        """Returns the docIDs and the postings of a block, parsed on first
+        use.
+
+        :param number: The number of the block
+        """
+        if number not in self.blocks:
+            postings = parse_postings(self.postings_text[
+                self.offsets[number]:self.offsets[number + 1] - 1])
+            self.blocks[number] = ([posting[0] for posting in postings],
+                                   postings)
+        return self.blocks[number]
+
+    def find(self, docID):
+        """Returns the posting of a document, or None if the document is not
+        in the postings list.
+
+        :param docID: The docID of the document
+        """
+        number = bisect_right(self.first_docIDs, docID) - 1
+        if number < 0:
+            return None
+        docIDs, postings = self.block(number)
+        position = bisect_left(docIDs, docID)
+        if position < len(docIDs) and docIDs[position] == docID:
+            return postings[position]
+        return None
+
+    def __contains__(self, docID):
+        return self.find(docID) is not None
+
+    def docIDs(self):
+        """Returns all docIDs of the postings list, in order."""
+        return list(chain.from_iterable(
+            self.block(number)[0]
+            for number in xrange(len(self.first_docIDs))))
+
+    def intersect(self, docIDs):
+        """Returns the given docIDs which are in the postings list. Fewer
+        docIDs than blocks are looked up one by one through the skip table.
+        More would parse nearly every block anyway, so they are merged with
+        all docIDs of the postings list instead.
+
+        :param docIDs: Sorted list of docIDs
+        """
+        if len(docIDs) < len(self.first_docIDs):
+            return [docID for docID in docIDs if docID in self]
+        return merge_intersection(docIDs, self.docIDs())
+
+    def select(self, docIDs):
+        """Returns the postings of the given documents which are in the
+        postings list.
+
+        :param docIDs: Iterable of docIDs
+        """
+        return [posting for posting in map(self.find, docIDs)
+                if posting is not None]
+
+
+def merge_intersection(docIDs, other_docIDs):
+    """Intersects two sorted lists of docIDs by walking both in one linear
+    merge.
+
+    :param docIDs: Sorted list of docIDs
+    :param other_docIDs: Sorted list of docIDs
+    :return: Sorted list of the docIDs in both lists
+    """
+    intersection = []
+    i = j = 0
+    while i < len(docIDs) and j < len(other_docIDs):
+        if docIDs[i] == other_docIDs[j]:
+            intersection.append(docIDs[i])
+            i += 1
+            j += 1
+        elif docIDs[i] < other_docIDs[j]:
+            i += 1
+        else:
+            j += 1
+    return intersection
+
+
+def conjunctive_matches(required, index, postings_file):
+    """Finds the documents containing every required term in their title or
+    abstract. The docIDs of the term with the shortest postings are the
+    candidates, which are then intersected with the postings of the other
+    terms, shortest first, with SkipPostings.intersect.
+
+    :param required: List of normalized required terms
+    :param index: The Index returned by load_dictionary
+    :param postings_file: File object of the postings file
+    :return: Sorted list of the matching docIDs.
+    """
+    term_lists = [[(field, expansion) for field in FIELDS
+                   for expansion in (index.wildcard_index.expand(term, field)
+                                     if is_wildcard(term) else [term])]
+                  for term in set(required)]
+    fetched = fetch_postings_text(chain.from_iterable(term_lists),
+                                  index.dictionary, postings_file)
+    term_postings = sorted(([SkipPostings(fetched[field_term])
+                             for field_term in field_terms]
+                            for field_terms in term_lists),
+                           key=lambda postings_lists: sum(
+                               len(postings.postings_text)
+                               for postings in postings_lists))
+    candidates = sorted(set(chain.from_iterable(
+        postings.docIDs() for postings in term_postings[0])))
+    for postings_lists in term_postings[1:]:
+        # A candidate contains the term if any of its postings lists has it
+        candidates = [docID for docID, group in groupby(merge(
+            *[postings.intersect(candidates)
+              for postings in postings_lists]))]
+    return candidates
+
+
+def union_postings(postings_lists):
+    """Merges postings lists sorted by docID into one, with a heap-based k-way
+    merge. The tfs of a document in several lists are summed, and its lnc
+    weight is computed from the summed tf.
+
+    :param postings_lists: List of postings lists, each sorted by docID
+    :return: The merged postings list, sorted by docID
+    """
+    merged_postings = []
+    for docID, postings in groupby(merge(*postings_lists),
+                                   key=itemgetter(0)):
+        tf = sum(posting[2] for posting in postings)
+        merged_postings.append([docID, 1 + math.log10(tf), tf])
+    return merged_postings
 
 
 def read_postings(term, dictionary, postings_file, field):
         """ Gets own postings list from file and stores it in its attribute.
-        For search token nodes only.
+        For search token nodes only. Each posting is returned as
+        [docID, lnc_weight, tf].
 
         :param term: Term to search
         :param postings_file: File object referencing the file containing the
@@ -168,61 +963,167 @@ def read_postings(term, dictionary, postings_file, field):
         """
 
         if term in dictionary[field]:
-            term_pointer = dictionary[field][term][0]
-            postings_length = dictionary[field][term][1]
+            term_pointer = dictionary[field][term][POINTER_INDEX]
+            postings_length = dictionary[field][term][LENGTH_INDEX]
             postings_file.seek(term_pointer)
-            postings = postings_file.read(postings_length).split()
-            postings = map(lambda docID_and_tf :
-                           docID_and_tf.split(","), postings)
-            postings = map(lambda docID_and_tf :
-                           [docID_and_tf[0], float(docID_and_tf[1])], postings)
-            return postings
+            return parse_postings(postings_file.read(postings_length))
         else:
             return []
 
 
+def parse_postings(postings_text):
+    """Parses the text of a postings list into a list of [docID, lnc_weight,
+    tf] postings.
+
+    :param postings_text: The postings list as written by index.py
+    """
+    postings = split_skip_table(postings_text)[2].split()
+    postings = map(lambda docID_and_tf :
+                   docID_and_tf.split(","), postings)
+    postings = map(lambda docID_and_tf :
+                   [docID_and_tf[0], float(docID_and_tf[1]),
+                    int(docID_and_tf[2]) if len(docID_and_tf) > 2
+                    else tf_from_lnc(float(docID_and_tf[1]))],
+                   postings)
+    return postings
+
+
 def main():
     # Get inputs
-    dictionary_file, postings_file, query_file, output_file = load_args()
+    dictionary_file, postings_file, query_file, output_file, collapse, \
+        lsi_prefix, model, limit, snippets, feedback, conjunctive, \
+        duplicates, max_terms, score_mass = load_args()
     # Runs search function
-    process_queries(dictionary_file, postings_file, query_file, output_file)
+    process_queries(dictionary_file, postings_file, query_file, output_file,
+                    collapse, lsi_prefix, model, limit, snippets, feedback,
+                    conjunctive, duplicates, max_terms, score_mass)
+
+
+def positive_int(text):
+    """Parses a count given on the command line, raising ValueError unless
+    it is a positive integer.
+
+    :param text: The text of the count
+    """
+    count = int(text)
+    if count <= 0:
+        raise ValueError("%s is not a positive integer" % text)
+    return count
 
 
 def load_args():
     """Attempts to parse command line arguments fed into the script when it was
     called. Notifies the user of the correct format if parsing failed.
     """
+    global show_time
     dictionary_file = postings_file = query_file = output_file = None
+    index_root = None
+    collapse = False
+    lsi_prefix = None
+    model = "vsm"
+    limit = None
+    snippets = 0
+    feedback = False
+    conjunctive = False
+    duplicates = None
+    max_terms = score_mass = None
 
     try:
-        opts, args = getopt.getopt(sys.argv[1:], 'd:p:q:o:')
-    except getopt.GetoptError, err:
+        opts, args = getopt.getopt(sys.argv[1:],
+                                   'd:p:r:q:o:tfl:m:k:s:Fau:n:M:')
+        for o, a in opts:
+            if o == '-d':
+                dictionary_file = a
+            elif o == '-p':
+                postings_file = a
+            elif o == '-r':
+                index_root = a
+            elif o == '-q':
+                query_file = a
+            elif o == '-o':
+                output_file = a
+            elif o == '-t':
+                show_time = True
+            elif o == '-f':
+                collapse = True
+            elif o == '-l':
+                lsi_prefix = a
+            elif o == '-m':
+                model = a
+            elif o == '-k':
+                limit = positive_int(a)
+            elif o == '-s':
+                snippets = positive_int(a)
+            elif o == '-F':
+                feedback = True
+            elif o == '-a':
+                conjunctive = True
+            elif o == '-u':
+                duplicates = a
+            elif o == '-n':
+                max_terms = positive_int(a)
+            elif o == '-M':
+                score_mass = float(a)
+            else:
+                assert False, "unhandled option"
+    except (getopt.GetoptError, ValueError), err:
         usage()
         sys.exit(2)
-    for o, a in opts:
-        if o == '-d':
-            dictionary_file = a
-        elif o == '-p':
-            postings_file = a
-        elif o == '-q':
-            query_file = a
-        elif o == '-o':
-            output_file = a
-        else:
-            assert False, "unhandled option"
+    if index_root is not None:
+        # The current version is resolved once; its files never change, and
+        # it is leased until the search exits, as they are opened lazily
+        version, lease = versions.lease_current_version(index_root)
+        atexit.register(versions.release_lease, lease)
+        dictionary_file = versions.version_file(index_root, version,
+                                                versions.DICTIONARY)
+        postings_file = versions.version_file(index_root, version,
+                                              versions.POSTINGS)
     if dictionary_file is None or postings_file is None \
-            or query_file is None or output_file is None:
+            or query_file is None or output_file is None \
+            or model not in SCORERS \
+            or duplicates not in (None, "suppress", "group") \
+            or (score_mass is not None and not 0 < score_mass <= 1):
+        usage()
+        sys.exit(2)
+    # The LSI engine does not use the scoring model, and scores every
+    # document against the whole query itself
+    if lsi_prefix is None:
+        problem = check_model(model, has_statistics(dictionary_file))
+    elif conjunctive or feedback or max_terms is not None \
+            or score_mass is not None:
+        problem = "-a, -F, -n and -M cannot be used with the LSI engine (-l)"
+    else:
+        problem = None
+    # Document stores and forward indexes of the current formats come with
+    # document ordinals
+    if problem is None and snippets \
+            and not has_document_store(dictionary_file + DOC_STORE_SUFFIX):
+        problem = "snippets need an index built with a document store, " \
+                  "rebuild it with index.py"
+    if problem is None and feedback \
+            and not has_forward_index(dictionary_file + FORWARD_SUFFIX):
+        problem = "feedback needs an index built with a forward index, " \
+                  "rebuild it with index.py"
+    if problem is not None:
+        print problem
         usage()
         sys.exit(2)
-    return dictionary_file, postings_file, query_file, output_file
+    return dictionary_file, postings_file, query_file, output_file, \
+        collapse, lsi_prefix, model, limit, snippets, feedback, conjunctive, \
+        duplicates, max_terms, score_mass
 
 
 def usage():
     """Prints the proper format for calling this script."""
-    print "usage: " + sys.argv[0] + " -d dictionary-file " \
-                                    "-p postings-file " \
+    print "usage: " + sys.argv[0] + " (-d dictionary-file " \
+                                    "-p postings-file | -r index-root) " \
                                     "-q file-of-queries " \
-                                    "-o output-file-of-results"
+                                    "-o output-file-of-results " \
+                                    "[-t] [-f] [-l lsi-prefix] " \
+                                    "[-m vsm|bm25|bm25f] " \
+                                    "[-k max-results] [-s snippets] " \
+                                    "[-F] [-a] [-u suppress|group] " \
+                                    "[-n max-terms] [-M score-mass]"
 
 
 if __name__ == "__main__":
@@ -0,0 +1,357 @@
+import getopt
+import sys
+import json
+import multiprocessing
+import SocketServer
+import threading
+import time
+from search import check_model, load_dictionary, run_query
+import versions
+
+"""
+Concurrent query front end over the search pipeline of search.py.
+
+Clients connect over TCP and send one JSON request per line, e.g.
+{"title": "...", "description": "...", "model": "bm25", "collapse": true,
+"limit": 100},
+and receive one JSON response per line, with "status" set to "ok" (and the
+ranked patent numbers in "results"), "busy", "timeout" or "error". A request
+for a scoring model the index cannot serve, such as bm25 on an index built
+without collection statistics, is answered with "error".
+
+Connections are served by threads, which only wait on sockets and results.
+Normalization, postings reads and scoring run in a pool of worker processes
+forked after the dictionary is loaded, so the workers share it copy-on-write
+and scoring is not serialized by the GIL. The number of workers bounds how
+many queries run at once. Requests beyond the in-flight limit are rejected
+straight away with "busy" instead of queueing without bound, and every
+request is answered with "timeout" if its result is not ready in time. A
+timed out query keeps its in-flight slot until its worker finishes it, so
+that the pool's queue never outgrows the in-flight limit.
+
+Served from an index root, the server polls its CURRENT version. Once a new
+version is published and matches its manifest, a new worker pool is forked
+over it and new requests go to that pool, while requests already running
+finish on the old one. The old pool is shut down when its last request is
+answered. Every generation leases its version until it is shut down, so that
+index.py does not delete it under the workers.
+"""
+
+ADDRESS = ("localhost", 8245)
+WORKERS = multiprocessing.cpu_count()  # queries scored at once
+MAX_IN_FLIGHT = 4 * WORKERS  # queries running or queued before "busy"
+TIMEOUT = 10.0  # seconds a request may wait for its result
+LIMIT = 1000  # default maximum number of results per response
+RELOAD_INTERVAL = 5.0  # seconds between checks for a new index version
+
+index = None  # loaded before the worker pool is forked
+postings = None  # opened in each worker process
+
+
+def init_worker(postings_file_name):
+    """Opens the postings file in a freshly forked worker process.
+
+    :param postings_file_name: The file path of the postings file
+    """
+    global postings
+    postings = open(postings_file_name)
+
+
+def handle_query(query_title, query_description, model, collapse, limit):
+    """Runs the search pipeline for one query in a worker process. Errors
+    are returned rather than raised, as the pool only calls back on results.
+
+    :return: Tuple of "ok" and the list of at most limit patent numbers in
+    ranked order, or of "error" and the error message.
+    """
+    try:
+        results = run_query(index, postings, query_title, query_description,
+                            model, collapse, limit)
+        # Remove .xml file extension
+        return "ok", [docID[:-4] for docID in results]
+    except Exception, err:
+        return "error", str(err)
+
+
+class IndexGeneration:
+    """A loaded index version and the worker pool forked over it, counting
+    the requests still using it."""
+
+    def __init__(self, dictionary_file, postings_file, workers, version=None,
+                 lease=None):
+        """Loads the dictionary and forks a worker pool sharing it.
+
+        :param dictionary_file: The file path of the dictionary file
+        :param postings_file: The file path of the postings file
+        :param workers: The number of worker processes
+        :param version: The name of the index version, if served from an
+        index root
+        :param lease: The lease file of the version, released once the
+        generation is shut down
+        """
+        global index
+        index = load_dictionary(dictionary_file)
+        self.pool = multiprocessing.Pool(workers, init_worker,
+                                         (postings_file,))
+        self.version = version
+        self.lease = lease
+        self.statistics_stored = index.statistics is not None
+        self.readers = 0
+        self.retired = False
+
+    def close(self):
+        """Shuts the worker pool down once its queued queries are done, and
+        releases the lease of its version."""
+        self.pool.close()
+        self.pool.join()
+        if self.lease is not None:
+            versions.release_lease(self.lease)
+
+
+class QueryServer(SocketServer.ThreadingMixIn, SocketServer.TCPServer):
+    """TCP server handing queries to a pool of worker processes."""
+
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, generation, max_in_flight=MAX_IN_FLIGHT,
+                 timeout=TIMEOUT):
+        """Binds the server to the address.
+
+        :param address: Tuple of host and port to listen on
+        :param generation: The IndexGeneration to serve queries from
+        :param max_in_flight: The number of queries running or waiting for a
+        worker beyond which requests are rejected
+        :param timeout: Seconds a request may wait for its result
+        """
+        SocketServer.TCPServer.__init__(self, address, QueryRequestHandler)
+        self.generation = generation
+        self.generation_lock = threading.Lock()
+        self.max_in_flight = max_in_flight
+        self.request_timeout = timeout
+        self.in_flight = 0
+        self.in_flight_lock = threading.Lock()
+
+    def admit(self):
+        """Takes an in-flight slot for a request, unless all are taken.
+
+        :return: Whether the request was admitted.
+        """
+        with self.in_flight_lock:
+            if self.in_flight >= self.max_in_flight:
+                return False
+            self.in_flight += 1
+            return True
+
+    def release(self, result=None):
+        """Gives back the in-flight slot of a finished request.
+
+        :param result: The result of the query, when called back by the
+        worker pool
+        """
+        with self.in_flight_lock:
+            self.in_flight -= 1
+
+    def acquire_generation(self):
+        """Returns the current IndexGeneration, counting the caller as one
+        of its readers until it calls release_generation."""
+        with self.generation_lock:
+            self.generation.readers += 1
+            return self.generation
+
+    def release_generation(self, generation):
+        """Stops counting a reader of a generation, shutting the generation
+        down if it was replaced and this was its last reader."""
+        with self.generation_lock:
+            generation.readers -= 1
+            finished = generation.retired and generation.readers == 0
+        if finished:
+            generation.close()
+
+    def swap_generation(self, generation):
+        """Serves new requests from another generation. The replaced one is
+        shut down once the requests still using it are answered."""
+        with self.generation_lock:
+            retired = self.generation
+            self.generation = generation
+            retired.retired = True
+            finished = retired.readers == 0
+        if finished:
+            retired.close()
+
+    def process(self, line):
+        """Processes one request line into a response.
+
+        :param line: The JSON request line
+        :return: The response as a dictionary
+        """
+        if not self.admit():
+            return {"status": "busy"}
+        generation = self.acquire_generation()
+        submitted = False
+        try:
+            request = json.loads(line)
+            model = request.get("model", "vsm")
+            problem = check_model(model, generation.statistics_stored)
+            if problem is not None:
+                return {"status": "error", "message": problem}
+            pending = generation.pool.apply_async(
+                handle_query, (request["title"], request["description"],
+                               model,
+                               request.get("collapse", False),
+                               request.get("limit", LIMIT)),
+                callback=self.release)
+            # From here on, the slot is given back once the worker is done
+            # with the query, even if the request times out before that
+            submitted = True
+            status, value = pending.get(self.request_timeout)
+            if status != "ok":
+                return {"status": status, "message": value}
+            return {"status": "ok", "results": value}
+        except multiprocessing.TimeoutError:
+            return {"status": "timeout"}
+        except Exception, err:
+            return {"status": "error", "message": str(err)}
+        finally:
+            self.release_generation(generation)
+            if not submitted:
+                self.release()
+
+
+class QueryRequestHandler(SocketServer.StreamRequestHandler):
+    """Serves the requests of one connection, one per line, in order."""
+
+    def handle(self):
+        for line in iter(self.rfile.readline, ""):
+            if not line.strip():
+                continue
+            response = self.server.process(line)
+            self.wfile.write(json.dumps(response) + "\n")
+            self.wfile.flush()
+
+
+def version_files(index_root, version):
+    """Returns the file paths of the dictionary and postings of a version."""
+    return versions.version_file(index_root, version, versions.DICTIONARY), \
+        versions.version_file(index_root, version, versions.POSTINGS)
+
+
+def watch_index_root(server, index_root, workers):
+    """Polls the index root for a newly published version, and swaps the
+    server to it once it is loaded. Runs in a daemon thread.
+
+    :param server: The QueryServer
+    :param index_root: The index root directory
+    :param workers: The number of worker processes of each generation
+    """
+    while True:
+        time.sleep(RELOAD_INTERVAL)
+        try:
+            version = versions.current_version(index_root)
+            if version == server.generation.version:
+                continue
+            lease = versions.lease_version(index_root, version)
+            try:
+                versions.load_manifest(index_root, version, verify=True)
+                dictionary_file, postings_file = version_files(index_root,
+                                                               version)
+                generation = IndexGeneration(dictionary_file, postings_file,
+                                             workers, version, lease)
+            except:
+                versions.release_lease(lease)
+                raise
+            server.swap_generation(generation)
+            print "Switched to index version {0}".format(version)
+        except (versions.VersionError, IOError, ValueError), err:
+            print "Not switching index version: {0}".format(err)
+        sys.stdout.flush()
+
+
+def usage():
+    """Prints the proper format for calling this script."""
+    print "usage: " + sys.argv[0] + " (-d dictionary-file " \
+                                    "-p postings-file | -r index-root) " \
+                                    "[-a host:port] [-w workers] " \
+                                    "[-n max-in-flight] [-T timeout]"
+
+
+def parse_args():
+    """Attempts to parse command line arguments fed into the script when it was
+    called. Notifies the user of the correct format if parsing failed.
+    """
+    dictionary_file = postings_file = index_root = None
+    address = ADDRESS
+    workers = WORKERS
+    max_in_flight = None
+    timeout = TIMEOUT
+    try:
+        opts, args = getopt.getopt(sys.argv[1:], 'd:p:r:a:w:n:T:')
+        for o, a in opts:
+            if o == '-d':
+                dictionary_file = a
+            elif o == '-p':
+                postings_file = a
+            elif o == '-r':
+                index_root = a
+            elif o == '-a':
+                host, port = a.rsplit(":", 1)
+                address = (host, int(port))
+            elif o == '-w':
+                workers = int(a)
+            elif o == '-n':
+                max_in_flight = int(a)
+            elif o == '-T':
+                timeout = float(a)
+            else:
+                assert False, "unhandled option"
+    except (getopt.GetoptError, ValueError), err:
+        usage()
+        sys.exit(2)
+    if (index_root is None) == (dictionary_file is None
+                                or postings_file is None):
+        usage()
+        sys.exit(2)
+    if max_in_flight is None:
+        max_in_flight = 4 * workers
+    return dictionary_file, postings_file, index_root, address, workers, \
+        max_in_flight, timeout
+
+
+def main():
+    """Loads the dictionary, forks the worker pool and serves queries until
+    interrupted."""
+    dictionary_file, postings_file, index_root, address, workers, \
+        max_in_flight, timeout = parse_args()
+    version = lease = None
+    if index_root is not None:
+        version, lease = versions.lease_current_version(index_root)
+        dictionary_file, postings_file = version_files(index_root, version)
+
+    print "Loading dictionary from {0}...".format(dictionary_file),
+    sys.stdout.flush()
+    generation = IndexGeneration(dictionary_file, postings_file, workers,
+                                 version, lease)
+    print "DONE"
+
+    server = QueryServer(address, generation, max_in_flight, timeout)
+    if index_root is not None:
+        watcher = threading.Thread(target=watch_index_root,
+                                   args=(server, index_root, workers))
+        watcher.daemon = True
+        watcher.start()
+    print "Serving queries on {0}:{1} with {2} workers...".format(
+        address[0], address[1], workers)
+    sys.stdout.flush()
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        server.generation.pool.terminate()
+        if server.generation.lease is not None:
+            versions.release_lease(server.generation.lease)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,211 @@
+import json
+import os
+import shutil
+import tempfile
+import unittest
+from math import sqrt
+
+"""
+Skip tables of postings lists, written by index.py and read by search.py.
+
+A postings list of at least MIN_SKIP_POSTINGS postings is split into blocks
+of about sqrt(df) postings, and its text starts with a skip table holding the
+first docID of every block and the offset of the block in the postings text
+following the table, e.g. "!EP1.xml:0;EP7.xml:162 EP1.xml,1.000000000,1 ...".
+A lookup bisects the first docIDs and only parses the block the docID falls
+in, so intersecting a short postings list with a long one leaps over most of
+the long one instead of parsing and walking all of it. Shorter lists, and
+lists written before skip tables, have no table and are a single block.
+Running this python module on its own just runs the unit tests defined within.
+"""
+
+SKIP_MARK = "!"  # starts the skip table, docIDs never start with it
+MIN_SKIP_POSTINGS = 64  # shorter postings lists are read whole
+
+
+def join_postings(formatted_postings, docIDs):
+    """Joins formatted postings into the text of a postings list, starting
+    with a skip table if the list is long enough.
+
+    :param formatted_postings: List of the postings of a term, formatted as
+    written in the postings file, sorted by docID
+    :param docIDs: The docIDs of the postings, in the same order
+    :return: The text of the postings list
+    """
+    if len(formatted_postings) < MIN_SKIP_POSTINGS:
+        return " ".join(formatted_postings)
+    step = int(sqrt(len(formatted_postings)))
+    entries = []
+    blocks = []
+    offset = 0
+    for start in xrange(0, len(formatted_postings), step):
+        block = " ".join(formatted_postings[start:start + step])
+        entries.append("%s:%d" % (docIDs[start], offset))
+        blocks.append(block)
+        offset += len(block) + 1
+    return SKIP_MARK + ";".join(entries) + " " + " ".join(blocks)
+
+
+def split_skip_table(postings_text):
+    """Splits the text of a postings list into its skip table and its
+    postings. A list without skip table is a single block, whose first docID
+    is the empty string, as it sorts before every docID.
+
+    :param postings_text: The text of a postings list, as written by
+    join_postings
+    :return: Tuple of the list of the first docIDs of the blocks, the list of
+    the offsets of the blocks in the postings text, ending with the length of
+    the text plus one, and the postings text.
+    """
+    if not postings_text.startswith(SKIP_MARK):
+        return [""], [0, len(postings_text) + 1], postings_text
+    table, postings_text = postings_text.split(" ", 1)
+    first_docIDs = []
+    offsets = []
+    for entry in table[len(SKIP_MARK):].split(";"):
+        docID, offset = entry.rsplit(":", 1)
+        first_docIDs.append(docID)
+        offsets.append(int(offset))
+    offsets.append(len(postings_text) + 1)
+    return first_docIDs, offsets, postings_text
+
+
+class TestSkipTable(unittest.TestCase):
+    """Test case ensuring skip tables point at the start of their blocks"""
+
+    def test_round_trip(self):
+        docIDs = ["EP%04d.xml" % number for number in xrange(100)]
+        formatted_postings = [docID + ",1.000000000,1" for docID in docIDs]
+        first_docIDs, offsets, postings_text = split_skip_table(
+            join_postings(formatted_postings, docIDs))
+        self.assertEqual(postings_text, " ".join(formatted_postings))
+        self.assertEqual(len(first_docIDs), 10)
+        for number, docID in enumerate(first_docIDs):
+            block = postings_text[offsets[number]:offsets[number + 1] - 1]
+            self.assertEqual(block.split(), formatted_postings[
+                number * 10:number * 10 + 10])
+            self.assertTrue(block.startswith(docID + ","))
+
+    def test_short_lists_have_no_table(self):
+        text = join_postings(["EP1.xml,1.000000000,1"], ["EP1.xml"])
+        self.assertEqual(text, "EP1.xml,1.000000000,1")
+        self.assertEqual(split_skip_table(text),
+                         ([""], [0, len(text) + 1], text))
+
+
+def formatted(docIDs):
+    """Formats postings of the given docIDs with tf 1, for the tests."""
+    return [docID + ",1.000000000,1" for docID in docIDs]
+
+
+class TestSkipPostings(unittest.TestCase):
+    """Test case ensuring lookups through skip tables find the same postings
+    as reading the whole list, and conjunctive queries match every required
+    term"""
+
+    def setUp(self):
+        # Imported here, as search.py imports this module
+        from search import SkipPostings
+        # Even numbers only, in blocks of 10 postings
+        self.docIDs = ["EP%04d.xml" % number for number in xrange(0, 200, 2)]
+        self.postings = SkipPostings(join_postings(formatted(self.docIDs),
+                                                   self.docIDs))
+
+    def test_find_at_block_boundaries(self):
+        self.assertEqual(len(self.postings.first_docIDs), 10)
+        for number in xrange(10):
+            # The first docID of a block, and the last of the block before
+            first = self.docIDs[number * 10]
+            self.assertEqual(self.postings.find(first)[0], first)
+            if number:
+                last = self.docIDs[number * 10 - 1]
+                self.assertEqual(self.postings.find(last)[0], last)
+        self.assertEqual(self.postings.find(self.docIDs[-1])[0],
+                         self.docIDs[-1])
+        # Between the last docID of a block and the first of the next
+        self.assertEqual(self.postings.find("EP0019.xml"), None)
+        self.assertEqual(self.postings.find("EP9999.xml"), None)
+
+    def test_docIDs_before_first_block(self):
+        self.assertEqual(self.postings.find("EP.xml"), None)
+        self.assertFalse("A0000.xml" in self.postings)
+        self.assertEqual(self.postings.blocks, {})
+
+    def test_intersect_switches_to_merging(self):
+        few = ["EP0002.xml", "EP0003.xml", "EP0150.xml"]
+        self.assertEqual(self.postings.intersect(few),
+                         ["EP0002.xml", "EP0150.xml"])
+        # Only the blocks of the docIDs looked up were parsed
+        self.assertEqual(sorted(self.postings.blocks), [0, 7])
+        many = ["EP%04d.xml" % number for number in xrange(0, 200, 3)]
+        self.assertEqual(self.postings.intersect(many),
+                         [docID for docID in many if docID in self.docIDs])
+        self.assertEqual(len(self.postings.blocks), 10)
+
+
+class TestConjunctiveMatches(unittest.TestCase):
+    """Test case ensuring conjunctive queries keep the documents holding
+    every required term, in either field"""
+
+    def setUp(self):
+        from search import Index
+        from wildcard import WILDCARD_SUFFIX, WildcardIndex, \
+            build_wildcard_index
+        self.directory = tempfile.mkdtemp()
+        field_docIDs = {"Title": {u"pump": ["EP1.xml", "EP2.xml"]},
+                        "Abstract": {u"pump": ["EP3.xml"],
+                                     u"foam": ["EP1.xml", "EP3.xml"],
+                                     u"foamer": ["EP2.xml"],
+                                     u"water": ["EP4.xml"]}}
+        dictionary = {}
+        postings_file_name = os.path.join(self.directory, "postings.txt")
+        with open(postings_file_name, 'w') as postings_file:
+            for field, terms in sorted(field_docIDs.iteritems()):
+                dictionary[field] = {}
+                for term, docIDs in sorted(terms.iteritems()):
+                    pointer = postings_file.tell()
+                    postings_file.write(join_postings(formatted(docIDs),
+                                                      docIDs))
+                    dictionary[field][term] = (
+                        pointer, postings_file.tell() - pointer, 1.0)
+                    postings_file.write("\n")
+        dictionary_file_name = os.path.join(self.directory,
+                                            "dictionary.txt")
+        with open(dictionary_file_name + WILDCARD_SUFFIX, 'w') \
+                as wildcard_file:
+            json.dump(dict((field, build_wildcard_index(terms))
+                           for field, terms in dictionary.iteritems()),
+                      wildcard_file)
+        self.index = Index(None, dictionary, None, None, None,
+                           WildcardIndex(dictionary_file_name
+                                         + WILDCARD_SUFFIX, dictionary),
+                           None)
+        self.postings_file = open(postings_file_name)
+
+    def tearDown(self):
+        self.postings_file.close()
+        shutil.rmtree(self.directory)
+
+    def matches(self, required):
+        from search import conjunctive_matches
+        return conjunctive_matches(required, self.index, self.postings_file)
+
+    def test_terms_match_in_either_field(self):
+        self.assertEqual(self.matches([u"pump"]),
+                         ["EP1.xml", "EP2.xml", "EP3.xml"])
+        self.assertEqual(self.matches([u"pump", u"foam"]),
+                         ["EP1.xml", "EP3.xml"])
+
+    def test_wildcard_required_terms(self):
+        # Any expansion of the wildcard satisfies it
+        self.assertEqual(self.matches([u"pump", u"foam*"]),
+                         ["EP1.xml", "EP2.xml", "EP3.xml"])
+        self.assertEqual(self.matches([u"wat*", u"foam*"]), [])
+
+    def test_unknown_required_term_empties_result(self):
+        self.assertEqual(self.matches([u"pump", u"impeller"]), [])
+        self.assertEqual(self.matches([u"impel*"]), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,76 @@
+import re
+import unittest
+
+"""
+Lightweight, regular-expression based word tokenizer shared by index.py and
+search.py.
+
+It follows the conventions of nltk's Treebank word tokenizer closely enough
+for our normalization (punctuation split off from words, clitics such as
+"n't" and "'s" split into their own tokens, hyphenated words, abbreviations
+and numbers kept whole), but loads in microseconds instead of pulling in nltk
+and its punkt models on every search invocation.
+Running this python module on its own just runs the unit tests defined within.
+"""
+
+TOKEN_PATTERN = re.compile(r"""
+      [a-z]+(?=n't\b)               # "do" of "don't"
+    | n't\b                         # negation clitic
+    | '(?:s|m|d|ll|re|ve)\b         # other clitics
+    | \d+(?:[.,]\d+)+               # numbers such as 1,000 or 3.5
+    | \w+(?:[-.]\w+)*               # words, hyphenated words, abbreviations
+    | [^\w\s]                       # punctuation, one character each
+    """, re.VERBOSE | re.UNICODE | re.IGNORECASE)
+# Same as TOKEN_PATTERN, but also keeps truncated words with "*" wildcards,
+# e.g. "hydro*" or "*phosph*", whole. Only used for queries.
+WILDCARD_TOKEN_PATTERN = re.compile(r"(?:\w+\*|\*\w)[\w*]*|" +
+                                    TOKEN_PATTERN.pattern,
+                                    re.VERBOSE | re.UNICODE | re.IGNORECASE)
+
+
+def tokenize(text, wildcards=False):
+    """Splits text into a list of word and punctuation tokens.
+
+    :param text: The text to tokenize.
+    :param wildcards: Whether words with "*" wildcards are kept as tokens.
+    :return: List of tokens in the order they appear in the text.
+    """
+    if wildcards:
+        return WILDCARD_TOKEN_PATTERN.findall(text)
+    return TOKEN_PATTERN.findall(text)
+
+
+class TestTokenizer(unittest.TestCase):
+    """Test case ensuring text is split into Treebank-like tokens"""
+
+    def test_tokenize_words_and_punctuation(self):
+        """Ensures punctuation is split off, while hyphenated words and
+        numbers stay whole."""
+        self.assertEqual(tokenize(u"A high-pressure (3.5 bar) washer, "
+                                  u"with 1,000 jets."),
+                         [u"A", u"high-pressure", u"(", u"3.5", u"bar",
+                          u")", u"washer", u",", u"with", u"1,000",
+                          u"jets", u"."])
+
+    def test_tokenize_punctuation_runs(self):
+        """Ensures runs of punctuation are split into single characters, so
+        that they are all removed as punctuation."""
+        self.assertEqual(tokenize(u"A pump (see FIG. 1), and a valve."),
+                         [u"A", u"pump", u"(", u"see", u"FIG", u".", u"1",
+                          u")", u",", u"and", u"a", u"valve", u"."])
+
+    def test_tokenize_clitics(self):
+        """Ensures clitics are split the way nltk's word_tokenize does."""
+        self.assertEqual(tokenize(u"The washer's drum doesn't leak"),
+                         [u"The", u"washer", u"'s", u"drum", u"does",
+                          u"n't", u"leak"])
+
+    def test_tokenize_wildcards(self):
+        """Ensures wildcard words are only kept whole when asked for."""
+        self.assertEqual(tokenize(u"hydro* and *phosph*", wildcards=True),
+                         [u"hydro*", u"and", u"*phosph*"])
+        self.assertEqual(tokenize(u"hydro*"), [u"hydro", u"*"])
+
+
+if __name__ == '__main__':
+    unittest.main()
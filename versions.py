@@ -0,0 +1,328 @@
+import errno
+import json
+import hashlib
+import os
+import shutil
+import tempfile
+import time
+import unittest
+
+"""
+Versioned index directories, published atomically.
+
+An index root holds one directory per index build and a CURRENT file naming
+the published one. index.py writes a build into a fresh version directory,
+records the size and checksum of every file and the number of documents in
+its MANIFEST.json, and only then publishes it by renaming a new CURRENT file
+over the old one. A version directory is never written again once published,
+so a reader that resolved CURRENT keeps a consistent dictionary and postings
+file however many builds are published after it.
+
+Readers lease the version they use with a lease file in its directory, named
+after their process ID, and remove it when they are done. Old versions are
+only deleted once no live process holds a lease on them, as readers open the
+postings and the wildcard, forward and document store files lazily. A version
+is first renamed out of the way and checked for leases again, so that a
+reader leasing it at the same time either finds it gone, and leases the
+current version instead, or keeps it from being deleted. Leases of processes
+which died without removing them are ignored, so leases only protect readers
+on the same host.
+Running this python module on its own just runs the unit tests defined within.
+"""
+
+CURRENT = "CURRENT"  # file in the index root naming the published version
+MANIFEST = "MANIFEST.json"  # file in each version directory
+DICTIONARY = "dictionary.txt"
+POSTINGS = "postings.txt"
+KEEP_VERSIONS = 2  # published versions kept on disk, including the current
+LEASE_PREFIX = "reader-"  # lease files in a version directory
+# Prefix a version directory is renamed with before it is deleted
+REMOVING_PREFIX = ".removing-"
+BLOCK_SIZE = 1 << 20  # bytes read at a time when computing checksums
+
+
+class VersionError(Exception):
+    """Raised when a version is missing or does not match its manifest."""
+    pass
+
+
+def create_version(index_root):
+    """Creates a new, empty version directory in the index root. Version names
+    sort in the order the versions were created.
+
+    :param index_root: The index root directory, created if missing
+    :return: The name of the version
+    """
+    if not os.path.isdir(index_root):
+        os.makedirs(index_root)
+    version = time.strftime("%Y%m%d%H%M%S") + "-%d" % os.getpid()
+    os.mkdir(os.path.join(index_root, version))
+    return version
+
+
+def version_file(index_root, version, file_name):
+    """Returns the path of a file of a version."""
+    return os.path.join(index_root, version, file_name)
+
+
+def file_checksum(file_name):
+    """Returns the SHA-1 hex digest of the contents of a file."""
+    digest = hashlib.sha1()
+    with open(file_name, 'rb') as f:
+        for block in iter(lambda: f.read(BLOCK_SIZE), ""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+def write_durably(file_name, contents):
+    """Writes a file and flushes it to disk before returning."""
+    with open(file_name, 'w') as f:
+        f.write(contents)
+        f.flush()
+        os.fsync(f.fileno())
+
+
+def publish_version(index_root, version, doc_count):
+    """Writes the manifest of a fully written version, then atomically makes
+    it the current version of the index root.
+
+    :param index_root: The index root directory
+    :param version: The name of the version
+    :param doc_count: The number of documents indexed in the version
+    """
+    version_dir = os.path.join(index_root, version)
+    files = {}
+    for file_name in sorted(os.listdir(version_dir)):
+        path = os.path.join(version_dir, file_name)
+        files[file_name] = {"size": os.path.getsize(path),
+                            "sha1": file_checksum(path)}
+    manifest = {"version": version,
+                "doc_count": doc_count,
+                "created": time.time(),
+                "files": files}
+    write_durably(os.path.join(version_dir, MANIFEST), json.dumps(manifest))
+    # rename is atomic, so readers see either the old or the new CURRENT
+    temp_current = os.path.join(index_root, CURRENT + ".%d" % os.getpid())
+    write_durably(temp_current, version + "\n")
+    os.rename(temp_current, os.path.join(index_root, CURRENT))
+
+
+def current_version(index_root):
+    """Returns the name of the current version of the index root.
+
+    :param index_root: The index root directory
+    """
+    try:
+        with open(os.path.join(index_root, CURRENT)) as f:
+            return f.read().strip()
+    except IOError:
+        raise VersionError("no published version in " + index_root)
+
+
+def load_manifest(index_root, version, verify=False):
+    """Loads the manifest of a version.
+
+    :param index_root: The index root directory
+    :param version: The name of the version
+    :param verify: Whether to check every file against its recorded size and
+    checksum
+    :return: The manifest as a dictionary
+    """
+    try:
+        with open(version_file(index_root, version, MANIFEST)) as f:
+            manifest = json.load(f)
+    except (IOError, ValueError):
+        raise VersionError("version %s has no valid manifest" % version)
+    if verify:
+        for file_name, entry in manifest["files"].iteritems():
+            path = version_file(index_root, version, file_name)
+            if not os.path.isfile(path) \
+                    or os.path.getsize(path) != entry["size"] \
+                    or file_checksum(path) != entry["sha1"]:
+                raise VersionError("%s of version %s does not match its "
+                                   "manifest" % (file_name, version))
+    return manifest
+
+
+def lease_version(index_root, version):
+    """Leases a published version, so that it is not deleted while the
+    calling process reads it.
+
+    :param index_root: The index root directory
+    :param version: The name of the version
+    :return: The path of the lease file, to be passed to release_lease
+    """
+    version_dir = os.path.join(index_root, version)
+    try:
+        handle, lease = tempfile.mkstemp(
+            prefix=LEASE_PREFIX + "%d-" % os.getpid(), dir=version_dir)
+    except OSError:
+        raise VersionError("version %s was removed" % version)
+    os.close(handle)
+    # The version may have been renamed for removal before it was leased
+    if not os.path.isfile(os.path.join(version_dir, MANIFEST)):
+        release_lease(lease)
+        raise VersionError("version %s was removed" % version)
+    return lease
+
+
+def lease_current_version(index_root, attempts=3):
+    """Resolves and leases the current version of the index root.
+
+    :param index_root: The index root directory
+    :param attempts: The number of times the current version is resolved
+    again if it is removed before it could be leased
+    :return: Tuple of the name of the version and the path of its lease file
+    """
+    for attempt in xrange(attempts - 1):
+        version = current_version(index_root)
+        try:
+            return version, lease_version(index_root, version)
+        except VersionError:
+            pass
+    version = current_version(index_root)
+    return version, lease_version(index_root, version)
+
+
+def release_lease(lease):
+    """Releases a lease taken by lease_version.
+
+    :param lease: The path of the lease file
+    """
+    try:
+        os.remove(lease)
+    except OSError:
+        pass  # the version was already removed
+
+
+def process_alive(pid):
+    """Returns whether a process with the process ID is running."""
+    try:
+        os.kill(pid, 0)
+    except OSError, err:
+        return err.errno == errno.EPERM
+    return True
+
+
+def has_readers(version_dir):
+    """Returns whether a live process holds a lease on a version.
+
+    :param version_dir: The directory of the version
+    """
+    for file_name in os.listdir(version_dir):
+        if file_name.startswith(LEASE_PREFIX):
+            pid = file_name[len(LEASE_PREFIX):].split("-", 1)[0]
+            if pid.isdigit() and process_alive(int(pid)):
+                return True
+    return False
+
+
+def remove_old_versions(index_root, keep=KEEP_VERSIONS):
+    """Deletes the published versions older than the newest ones, once no
+    process leases them any more. Directories of builds which were never
+    published, whether still being written or abandoned, are left alone.
+
+    :param index_root: The index root directory
+    :param keep: The number of versions kept, including the current one
+    :return: List of the names of the versions deleted
+    """
+    current = current_version(index_root)
+    names = sorted(os.listdir(index_root))
+    for name in names:
+        # Left over by a removal which was interrupted
+        if name.startswith(REMOVING_PREFIX):
+            shutil.rmtree(os.path.join(index_root, name), ignore_errors=True)
+    published = [name for name in names if name <= current
+                 and not name.startswith(".")
+                 and os.path.isfile(version_file(index_root, name, MANIFEST))]
+    removed = []
+    for version in published[:-keep]:
+        version_dir = os.path.join(index_root, version)
+        if has_readers(version_dir):
+            continue
+        removing_dir = os.path.join(index_root, REMOVING_PREFIX + version)
+        os.rename(version_dir, removing_dir)
+        # A reader may have leased the version before it was renamed
+        if has_readers(removing_dir):
+            os.rename(removing_dir, version_dir)
+            continue
+        shutil.rmtree(removing_dir)
+        removed.append(version)
+    return removed
+
+
+class TestVersions(unittest.TestCase):
+    """Test case ensuring versions are published atomically and verified"""
+
+    def setUp(self):
+        self.index_root = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.index_root)
+
+    def build(self, contents):
+        version = create_version(self.index_root)
+        # Versions created within the same second would not sort
+        os.rename(os.path.join(self.index_root, version),
+                  os.path.join(self.index_root, contents))
+        write_durably(version_file(self.index_root, contents, POSTINGS),
+                      contents)
+        return contents
+
+    def test_publish(self):
+        self.assertRaises(VersionError, current_version, self.index_root)
+        first = self.build("v1")
+        publish_version(self.index_root, first, 3)
+        second = self.build("v2")
+        self.assertEqual(current_version(self.index_root), first)
+        publish_version(self.index_root, second, 4)
+        self.assertEqual(current_version(self.index_root), second)
+        manifest = load_manifest(self.index_root, second, verify=True)
+        self.assertEqual(manifest["doc_count"], 4)
+
+    def test_verify_detects_corruption(self):
+        version = self.build("v1")
+        publish_version(self.index_root, version, 3)
+        write_durably(version_file(self.index_root, version, POSTINGS), "v2")
+        self.assertRaises(VersionError, load_manifest, self.index_root,
+                          version, True)
+
+    def test_remove_old_versions(self):
+        for version in ("v1", "v2", "v3"):
+            publish_version(self.index_root, self.build(version), 1)
+        # An unpublished build, older than the current version
+        self.build("v2a")
+        self.assertEqual(remove_old_versions(self.index_root, keep=2),
+                         ["v1"])
+        self.assertEqual(sorted(os.listdir(self.index_root)),
+                         [CURRENT, "v2", "v2a", "v3"])
+
+    def test_leased_versions_are_kept(self):
+        for version in ("v1", "v2"):
+            publish_version(self.index_root, self.build(version), 1)
+        version, lease = lease_current_version(self.index_root)
+        self.assertEqual(version, "v2")
+        publish_version(self.index_root, self.build("v3"), 1)
+        publish_version(self.index_root, self.build("v4"), 1)
+        self.assertEqual(remove_old_versions(self.index_root, keep=1),
+                         ["v1", "v3"])
+        release_lease(lease)
+        self.assertEqual(remove_old_versions(self.index_root, keep=1),
+                         ["v2"])
+        self.assertRaises(VersionError, lease_version, self.index_root, "v2")
+
+    def test_leases_of_dead_processes_are_ignored(self):
+        publish_version(self.index_root, self.build("v1"), 1)
+        pid = os.fork()
+        if pid == 0:
+            os._exit(0)
+        os.waitpid(pid, 0)
+        write_durably(version_file(self.index_root, "v1",
+                                   LEASE_PREFIX + "%d-x" % pid), "")
+        publish_version(self.index_root, self.build("v2"), 1)
+        self.assertEqual(remove_old_versions(self.index_root, keep=1),
+                         ["v1"])
+
+
+if __name__ == '__main__':
+    unittest.main()
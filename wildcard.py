@@ -0,0 +1,247 @@
+import json
+import os
+import re
+import sys
+import tempfile
+import unittest
+from bisect import bisect_left
+from collections import defaultdict
+from cStringIO import StringIO
+from scoring import IDF_INDEX
+
+"""
+Wildcard term index, used to expand truncated query terms such as "hydro*" or
+"*phosph*" to the indexed terms they match.
+
+For each field, index.py stores the sorted array of terms, which answers
+prefix patterns with a binary search, and a k-gram index mapping every k-gram
+of "$term$" to the positions of the terms containing it, which narrows down
+candidates for patterns with a leading wildcard. Candidates are then checked
+against the full pattern. A pattern matching more than MAX_EXPANSIONS terms
+expands to the ones with the highest document frequencies, with a warning.
+Running this python module on its own just runs the unit tests defined within.
+"""
+
+WILDCARD_SUFFIX = ".wildcard"  # appended to the dictionary file path
+K = 3  # length of the k-grams
+MAX_EXPANSIONS = 50  # maximum number of terms one wildcard expands to
+WILDCARD = "*"
+
+
+def kgrams(text):
+    """Returns the set of k-grams of a string.
+
+    :param text: The string, with "$" marking the term boundaries if needed
+    """
+    return set(text[i:i + K] for i in xrange(len(text) - K + 1))
+
+
+def build_wildcard_index(terms):
+    """Builds the wildcard index of the terms of one field.
+
+    :param terms: Iterable of the terms of the field
+    :return: Dictionary with the sorted list of terms under "terms", and the
+    mapping of k-gram to sorted positions in that list under "kgrams"
+    """
+    sorted_terms = sorted(terms)
+    kgram_index = defaultdict(list)
+    for position, term in enumerate(sorted_terms):
+        for kgram in kgrams("$" + term + "$"):
+            kgram_index[kgram].append(position)
+    return {"terms": sorted_terms, "kgrams": kgram_index}
+
+
+def is_wildcard(term):
+    """Returns whether a query term is a wildcard pattern."""
+    return WILDCARD in term
+
+
+def prefix_range(sorted_terms, prefix):
+    """Returns the range of positions of the terms starting with prefix.
+
+    :param sorted_terms: The sorted list of terms
+    :param prefix: The prefix
+    :return: Tuple of the first position and one past the last position
+    """
+    start = bisect_left(sorted_terms, prefix)
+    # Every term starting with prefix sorts before the prefix with its last
+    # character incremented, every other term after it
+    end = bisect_left(sorted_terms,
+                      prefix[:-1] + unichr(ord(prefix[-1]) + 1), start)
+    return start, end
+
+
+def expand_wildcard(pattern, field_index):
+    """Expands a wildcard pattern to all the indexed terms it matches.
+
+    :param pattern: The lowercased pattern, with "*" matching any string
+    :param field_index: The wildcard index of the field, as built by
+    build_wildcard_index
+    :return: List of matching terms, in sorted order
+    """
+    sorted_terms = field_index["terms"]
+    pieces = pattern.split(WILDCARD)
+    matcher = re.compile("^" + ".*".join(re.escape(piece)
+                                          for piece in pieces) + "$",
+                         re.UNICODE)
+    if pieces[0]:
+        # A literal prefix narrows candidates to a contiguous range
+        start, end = prefix_range(sorted_terms, pieces[0])
+        candidates = xrange(start, end)
+    else:
+        bounded = "*".join(pieces[:-1]) + "*" + \
+            (pieces[-1] + "$" if pieces[-1] else "")
+        pattern_kgrams = set()
+        for piece in bounded.split(WILDCARD):
+            pattern_kgrams.update(kgrams(piece))
+        if pattern_kgrams:
+            candidate_sets = [set(field_index["kgrams"].get(kgram, ()))
+                              for kgram in pattern_kgrams]
+            candidates = sorted(set.intersection(*candidate_sets))
+        else:
+            # Pieces too short to have k-grams, check every term
+            candidates = xrange(len(sorted_terms))
+    return [sorted_terms[position] for position in candidates
+            if matcher.match(sorted_terms[position])]
+
+
+def most_frequent(terms, field_dictionary, max_expansions=MAX_EXPANSIONS):
+    """Keeps the terms with the highest document frequencies, that is the
+    lowest idfs, so that a capped wildcard still covers the most documents.
+
+    :param terms: List of terms, in sorted order
+    :param field_dictionary: Dictionary of term to its dictionary entry
+    :param max_expansions: The maximum number of terms kept
+    :return: List of the kept terms, in sorted order
+    """
+    if len(terms) <= max_expansions:
+        return terms
+    # Sorting is stable, so terms of equal idfs are kept in sorted order
+    return sorted(sorted(terms,
+                         key=lambda term: field_dictionary[term][IDF_INDEX])
+                  [:max_expansions])
+
+
+class WildcardIndex:
+    """Wildcard index file written by index.py, loaded on first use so that
+    queries without wildcards never pay for it. Indexes built before wildcard
+    indexes were written, or whose wildcard index cannot be read, expand every
+    pattern to nothing, which is reported on stderr the first time. So is
+    every pattern matching more terms than it is expanded to."""
+
+    def __init__(self, wildcard_file_name, dictionary):
+        """Remembers the path of the wildcard index file.
+
+        :param wildcard_file_name: The file path of the wildcard index file
+        :param dictionary: Dictionary of field to term to its dictionary
+        entry, whose idfs rank the terms of capped expansions
+        """
+        self.wildcard_file_name = wildcard_file_name
+        self.dictionary = dictionary
+        self.fields = None
+        self.capped = set()
+
+    def expand(self, pattern, field, max_expansions=MAX_EXPANSIONS):
+        """Expands a wildcard pattern to the terms of the field it matches,
+        keeping the most frequent ones beyond max_expansions.
+
+        :param pattern: The lowercased pattern, with "*" matching any string
+        :param field: The field whose terms are matched
+        :param max_expansions: The maximum number of terms returned
+        :return: List of matching terms, in sorted order
+        """
+        if self.fields is None:
+            try:
+                with open(self.wildcard_file_name) as wildcard_file:
+                    self.fields = json.load(wildcard_file)
+            except IOError, err:
+                sys.stderr.write("warning: wildcard terms expand to nothing, "
+                                 "cannot read the wildcard index: %s\n"
+                                 % err)
+                self.fields = {}
+        if field not in self.fields:
+            return []
+        expansions = expand_wildcard(pattern, self.fields[field])
+        if len(expansions) > max_expansions \
+                and (field, pattern) not in self.capped:
+            self.capped.add((field, pattern))
+            sys.stderr.write("warning: %s matches %d terms of the %s, only "
+                             "the %d most frequent are searched\n"
+                             % (pattern.encode("utf-8"), len(expansions),
+                                field, max_expansions))
+        return most_frequent(expansions, self.dictionary[field],
+                             max_expansions)
+
+
+class TestWildcard(unittest.TestCase):
+    """Test case ensuring wildcard patterns expand to the matching terms"""
+
+    def setUp(self):
+        self.field_index = build_wildcard_index(
+            [u"hydrogen", u"hydrolysi", u"hydroxid", u"phosphat",
+             u"polyphosphat", u"pump", u"hy"])
+
+    def test_prefix(self):
+        self.assertEqual(expand_wildcard(u"hydro*", self.field_index),
+                         [u"hydrogen", u"hydrolysi", u"hydroxid"])
+
+    def test_infix(self):
+        self.assertEqual(expand_wildcard(u"*phosph*", self.field_index),
+                         [u"phosphat", u"polyphosphat"])
+        self.assertEqual(expand_wildcard(u"h*d", self.field_index),
+                         [u"hydroxid"])
+
+    def test_suffix(self):
+        self.assertEqual(expand_wildcard(u"*at", self.field_index),
+                         [u"phosphat", u"polyphosphat"])
+        self.assertEqual(len(expand_wildcard(u"*", self.field_index)), 7)
+
+    def test_prefix_range(self):
+        sorted_terms = self.field_index["terms"]
+        self.assertEqual(prefix_range(sorted_terms, u"hy"), (0, 4))
+        self.assertEqual(prefix_range(sorted_terms, u"hydrox"), (3, 4))
+        self.assertEqual(prefix_range(sorted_terms, u"pump"), (6, 7))
+        self.assertEqual(prefix_range(sorted_terms, u"q"), (7, 7))
+        self.assertEqual(prefix_range(sorted_terms, u"a"), (0, 0))
+
+    def test_cap_keeps_most_frequent(self):
+        field_dictionary = {u"hydrogen": (0, 0, 2.0),
+                            u"hydrolysi": (0, 0, 0.5),
+                            u"hydroxid": (0, 0, 1.0)}
+        self.assertEqual(most_frequent([u"hydrogen", u"hydrolysi",
+                                        u"hydroxid"], field_dictionary, 2),
+                         [u"hydrolysi", u"hydroxid"])
+        handle, wildcard_file_name = tempfile.mkstemp()
+        os.close(handle)
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            with open(wildcard_file_name, 'w') as wildcard_file:
+                json.dump({"Title": self.field_index}, wildcard_file)
+            wildcard_index = WildcardIndex(wildcard_file_name,
+                                           {"Title": field_dictionary})
+            for repeat in xrange(2):
+                self.assertEqual(wildcard_index.expand(u"hydro*", "Title", 1),
+                                 [u"hydrolysi"])
+            self.assertEqual(wildcard_index.expand(u"hydrog*", "Title", 1),
+                             [u"hydrogen"])
+            # Reported once per pattern
+            self.assertEqual(sys.stderr.getvalue().count("warning"), 1)
+        finally:
+            sys.stderr = stderr
+            os.remove(wildcard_file_name)
+
+    def test_missing_index_is_reported(self):
+        stderr = sys.stderr
+        sys.stderr = StringIO()
+        try:
+            wildcard_index = WildcardIndex("missing" + WILDCARD_SUFFIX, {})
+            self.assertEqual(wildcard_index.expand(u"hydro*", "Title"), [])
+            self.assertEqual(wildcard_index.expand(u"pump*", "Title"), [])
+            self.assertEqual(sys.stderr.getvalue().count("warning"), 1)
+        finally:
+            sys.stderr = stderr
+
+
+if __name__ == '__main__':
+    unittest.main()